@@ -34,6 +34,8 @@ except ImportError:
     sys.path.append(PARTTOOL_DIR)
     from parttool import PartitionName, PartitionType, ParttoolTarget, PARTITION_TABLE_OFFSET
 
+import gen_esp32part as gen  # next to parttool
+
 __version__ = '2.0'
 
 SPI_FLASH_SEC_SIZE = 0x2000
@@ -47,6 +49,9 @@ def status(msg):
 
 
 class OtatoolTarget():
+    """ OTA partitions of a device. As with ParttoolTarget, the device is connected to once and the partition
+    table and otadata are read once, so several operations (ie write an OTA partition, switch to it and verify
+    it) run in the same connection. Call close() (or use the target in a 'with' statement) after the last one. """
 
     OTADATA_PARTITION = PartitionType("data", "ota")
 
@@ -68,6 +73,15 @@ class OtatoolTarget():
         finally:
             os.unlink(temp_file.name)
 
+    def close(self):
+        self.target.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def _check_otadata_partition(self):
         if not self.otadata:
             raise Exception("No otadata partition found")
@@ -75,6 +89,7 @@ class OtatoolTarget():
     def erase_otadata(self):
         self._check_otadata_partition()
         self.target.erase_partition(OtatoolTarget.OTADATA_PARTITION)
+        self.otadata = b"\xff" * len(self.otadata)
 
     def _get_otadata_info(self):
         info = []
@@ -103,9 +118,6 @@ class OtatoolTarget():
     def switch_ota_partition(self, ota_id):
         self._check_otadata_partition()
 
-        sys.path.append(PARTTOOL_DIR)
-        import gen_esp32part as gen
-
         def is_otadata_info_valid(status):
             seq = status.seq % (1 << 32)
             crc = hex(binascii.crc32(struct.pack("I", seq), 0xFFFFFFFF) % (1 << 32))
@@ -183,27 +195,25 @@ class OtatoolTarget():
         ota_seq_crc_next = binascii.crc32(ota_seq_next, 0xFFFFFFFF) % (1 << 32)
         ota_seq_crc_next = struct.pack("I", ota_seq_crc_next)
 
+        start = (1 if otadata_compute_base == 0 else 0) * (self.spi_flash_sec_size >> 1)
+        otadata_next = bytearray(self.otadata)
+        otadata_next[start:start + 4] = ota_seq_next
+        otadata_next[start + 28:start + 32] = ota_seq_crc_next
+
         temp_file = tempfile.NamedTemporaryFile(delete=False)
         temp_file.close()
 
         try:
             with open(temp_file.name, "wb") as otadata_next_file:
-                start = (1 if otadata_compute_base == 0 else 0) * (self.spi_flash_sec_size >> 1)
-
-                otadata_next_file.write(self.otadata)
-
-                otadata_next_file.seek(start)
-                otadata_next_file.write(ota_seq_next)
-
-                otadata_next_file.seek(start + 28)
-                otadata_next_file.write(ota_seq_crc_next)
-
-                otadata_next_file.flush()
+                otadata_next_file.write(otadata_next)
 
             self.target.write_partition(OtatoolTarget.OTADATA_PARTITION, temp_file.name)
         finally:
             os.unlink(temp_file.name)
 
+        # keep the cached copy up to date for the next operation on this target
+        self.otadata = bytes(otadata_next)
+
     def read_ota_partition(self, ota_id, output):
         self.target.read_partition(self._get_partition_id_from_ota_id(ota_id), output)
 
@@ -213,6 +223,9 @@ class OtatoolTarget():
     def erase_ota_partition(self, ota_id):
         self.target.erase_partition(self._get_partition_id_from_ota_id(ota_id))
 
+    def verify_ota_partition(self, ota_id, input):
+        self.target.verify_partition(self._get_partition_id_from_ota_id(ota_id), input)
+
 
 def _read_otadata(target):
     target._check_otadata_partition()
@@ -374,14 +387,17 @@ def main():
         except KeyError:
             pass
 
-    if quiet:
-        # If exceptions occur, suppress and exit quietly
-        try:
+    try:
+        if quiet:
+            # If exceptions occur, suppress and exit quietly
+            try:
+                op(**common_args)
+            except Exception:
+                sys.exit(2)
+        else:
             op(**common_args)
-        except Exception:
-            sys.exit(2)
-    else:
-        op(**common_args)
+    finally:
+        target.close()
 
 
 if __name__ == '__main__':
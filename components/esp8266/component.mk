@@ -52,6 +52,6 @@ $(COMPONENT_LIBRARY): esp8266_out.ld
 esp8266_out.ld: $(COMPONENT_PATH)/ld/esp8266.ld ../include/sdkconfig.h
 	$(CC) $(CFLAGS) -I ../include -C -P -x c -E $< -o $@
 
-COMPONENT_EXTRA_CLEAN := esp8266_out.ld $(COMPONENT_BUILD_DIR)/esp8266.project.ld
+COMPONENT_EXTRA_CLEAN := esp8266_out.ld $(COMPONENT_BUILD_DIR)/esp8266.project.ld $(COMPONENT_BUILD_DIR)/esp8266.project.ld.manifest
 
 endif
\ No newline at end of file
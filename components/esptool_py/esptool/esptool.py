@@ -21,14 +21,22 @@ from __future__ import division, print_function
 import argparse
 import base64
 import binascii
+import bisect
+import collections
 import copy
 import hashlib
+import hmac
 import inspect
 import io
+import json
+import mmap
 import os
 import shlex
+import shutil
+import socket
 import struct
 import sys
+import threading
 import time
 import zlib
 import string
@@ -597,7 +605,6 @@ class ESPLoader(object):
         else:
             write_size = erase_blocks * self.FLASH_WRITE_SIZE  # ROM expects rounded up to erase block size
             timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, write_size)  # ROM performs the erase up front
-        print("Compressed %d bytes to %d..." % (size, compsize))
         self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN,
                            struct.pack('<IIII', write_size, num_blocks, self.FLASH_WRITE_SIZE, offset),
                            timeout=timeout)
@@ -666,6 +673,14 @@ class ESPLoader(object):
 
     @stub_function_only
     def read_flash(self, offset, length, progress_fn=None):
+        return b''.join(self.read_flash_blocks(offset, length, progress_fn))
+
+    @stub_function_only
+    def read_flash_blocks(self, offset, length, progress_fn=None):
+        """ Generator version of read_flash(), yields the data one flash sector at a time.
+
+        The digest of the data is only checked once the last block has been read, so the
+        caller mustn't rely on the data until the generator finishes without an error. """
         # issue a standard bootloader command to trigger the read
         self.check_command("read flash", self.ESP_READ_FLASH,
                            struct.pack('<IIII',
@@ -674,25 +689,27 @@ class ESPLoader(object):
                                        self.FLASH_SECTOR_SIZE,
                                        64))
         # now we expect (length // block_size) SLIP frames with the data
-        data = b''
-        while len(data) < length:
+        received = 0
+        md5 = hashlib.md5()
+        while received < length:
             p = self.read()
-            data += p
-            self.write(struct.pack('<I', len(data)))
-            if progress_fn and (len(data) % 1024 == 0 or len(data) == length):
-                progress_fn(len(data), length)
+            received += len(p)
+            md5.update(p)
+            self.write(struct.pack('<I', received))
+            if received > length:
+                raise FatalError('Read more than expected')
+            if progress_fn and (received % 1024 == 0 or received == length):
+                progress_fn(received, length)
+            yield p
         if progress_fn:
-            progress_fn(len(data), length)
-        if len(data) > length:
-            raise FatalError('Read more than expected')
+            progress_fn(received, length)
         digest_frame = self.read()
         if len(digest_frame) != 16:
             raise FatalError('Expected digest, got: %s' % hexify(digest_frame))
         expected_digest = hexify(digest_frame).upper()
-        digest = hashlib.md5(data).hexdigest().upper()
+        digest = md5.hexdigest().upper()
         if digest != expected_digest:
             raise FatalError('Digest mismatch: expected %s, got %s' % (expected_digest, digest))
-        return data
 
     def flash_spi_attach(self, hspi_arg):
         """Send SPI attach command to enable the SPI flash pins
@@ -1243,11 +1260,47 @@ class ImageSegment(object):
 
 class ELFSection(ImageSegment):
     """ Wrapper class for a section in an ELF image, has a section
-    name as well as the common properties of an ImageSegment. """
+    name as well as the common properties of an ImageSegment.
+
+    'data' can be a memoryview into the ELF file, in which case it is
+    only copied (and padded) the first time the section's data is used. """
     def __init__(self, name, addr, data):
+        self._view = None
         super(ELFSection, self).__init__(addr, data)
         self.name = name.decode("utf-8")
 
+    @property
+    def data(self):
+        if self._view is not None:
+            self._data = pad_to(self._view.tobytes(), 4, b'\x00')
+            self._view = None
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        if isinstance(data, memoryview):
+            self._view = data
+            self._data = None
+        else:
+            self._view = None
+            self._data = data
+
+    @property
+    def view(self):
+        """ memoryview of the section data, without copying it if it hasn't been used yet """
+        return self._view if self._view is not None else memoryview(self.data)
+
+    def pad_to_alignment(self, alignment):
+        if self._view is not None and alignment == 4:
+            return  # done when the data is copied
+        super(ELFSection, self).pad_to_alignment(alignment)
+
+    def __deepcopy__(self, memo):
+        # a memoryview can't be copied, but the data bytes are immutable so can be shared
+        result = copy.copy(self)
+        result.data = self.data
+        return result
+
     def __repr__(self):
         return "%s %s" % (self.name, super(ELFSection, self).__repr__())
 
@@ -1884,32 +1937,82 @@ class ESP32FirmwareImage(BaseFirmwareImage):
         save_file.write(packed)
 
 
+# Header of any section of an ELF file, including those without data in the file (ie .bss)
+ELFSectionHeader = collections.namedtuple("ELFSectionHeader", ["name", "type", "flags", "addr", "size"])
+
+# Function or data symbol of an ELF file. 'section' is the index of its section header,
+# 'file' the source file name of a local symbol (None for global symbols).
+ELFSymbol = collections.namedtuple("ELFSymbol", ["name", "addr", "size", "type", "section", "file"])
+
+
 class ELFFile(object):
+    """ ELF file reader. The file is memory mapped, so section data is only
+    read when it is used (see ELFSection). The symbol table is indexed on
+    the first call to lookup_symbol().
+
+    close() (or using the ELFFile as a context manager) releases the map,
+    after which the sections can still be used but symbols can't be read. """
     SEC_TYPE_PROGBITS = 0x01
+    SEC_TYPE_SYMTAB = 0x02
     SEC_TYPE_STRTAB = 0x03
+    SEC_TYPE_NOBITS = 0x08
+
+    SEC_FLAG_ALLOC = 0x02
+
+    SYM_TYPE_OBJECT = 0x01
+    SYM_TYPE_FUNC = 0x02
+    SYM_TYPE_FILE = 0x04
+
+    SYM_BIND_LOCAL = 0x00
 
     LEN_SEC_HEADER = 0x28
+    LEN_SYMBOL = 0x10
 
     def __init__(self, name):
         # Load sections from the ELF file
         self.name = name
         with open(self.name, 'rb') as f:
-            self._read_elf_file(f)
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._data = memoryview(self._mmap)
+            except (ValueError, TypeError, EnvironmentError):
+                # empty file, or Python 2 (which can't make a memoryview of an mmap)
+                self._mmap = None
+                self._data = memoryview(f.read())
+        self._symbols = None
+        self._read_elf_file()
+
+    def close(self):
+        if self._data is None:
+            return
+        for section in self.sections:
+            section.data  # copy the data out of the map if it hasn't been used yet
+        if hasattr(self._data, "release"):  # Python 3
+            self._data.release()
+        self._data = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get_section(self, section_name):
-        for s in self.sections:
-            if s.name == section_name:
-                return s
-        raise ValueError("No section %s in ELF file" % section_name)
+        try:
+            return self._sections_by_name[section_name]
+        except KeyError:
+            raise ValueError("No section %s in ELF file" % section_name)
 
-    def _read_elf_file(self, f):
+    def _read_elf_file(self):
         # read the ELF file header
-        LEN_FILE_HEADER = 0x34
         try:
             (ident,_type,machine,_version,
              self.entrypoint,_phoff,shoff,_flags,
              _ehsize, _phentsize,_phnum, shentsize,
-             shnum,shstrndx) = struct.unpack("<16sHHLLLLLHHHHHH", f.read(LEN_FILE_HEADER))
+             shnum,shstrndx) = struct.unpack_from("<16sHHLLLLLHHHHHH", self._data, 0)
         except struct.error as e:
             raise FatalError("Failed to read a valid ELF header from %s: %s" % (self.name, e))
 
@@ -1921,12 +2024,11 @@ class ELFFile(object):
             raise FatalError("%s has unexpected section header entry size 0x%x (not 0x28)" % (self.name, shentsize, self.LEN_SEC_HEADER))
         if shnum == 0:
             raise FatalError("%s has 0 section headers" % (self.name))
-        self._read_sections(f, shoff, shnum, shstrndx)
+        self._read_sections(shoff, shnum, shstrndx)
 
-    def _read_sections(self, f, section_header_offs, section_header_count, shstrndx):
-        f.seek(section_header_offs)
+    def _read_sections(self, section_header_offs, section_header_count, shstrndx):
         len_bytes = section_header_count * self.LEN_SEC_HEADER
-        section_header = f.read(len_bytes)
+        section_header = self._data[section_header_offs:section_header_offs + len_bytes]
         if len(section_header) == 0:
             raise FatalError("No section header found at offset %04x in ELF file." % section_header_offs)
         if len(section_header) != (len_bytes):
@@ -1936,33 +2038,80 @@ class ELFFile(object):
         section_header_offsets = range(0, len(section_header), self.LEN_SEC_HEADER)
 
         def read_section_header(offs):
-            name_offs,sec_type,_flags,lma,sec_offs,size = struct.unpack_from("<LLLLLL", section_header[offs:])
-            return (name_offs, sec_type, lma, size, sec_offs)
+            name_offs,sec_type,flags,lma,sec_offs,size,link = struct.unpack_from("<LLLLLLL", section_header, offs)
+            return (name_offs, sec_type, lma, size, sec_offs, link, flags)
         all_sections = [read_section_header(offs) for offs in section_header_offsets]
         prog_sections = [s for s in all_sections if s[1] == ELFFile.SEC_TYPE_PROGBITS]
 
         # search for the string table section
         if not (shstrndx * self.LEN_SEC_HEADER) in section_header_offsets:
             raise FatalError("ELF file has no STRTAB section at shstrndx %d" % shstrndx)
-        _,sec_type,_,sec_size,sec_offs = read_section_header(shstrndx * self.LEN_SEC_HEADER)
+        _,sec_type,_,sec_size,sec_offs,_,_ = all_sections[shstrndx]
         if sec_type != ELFFile.SEC_TYPE_STRTAB:
             print('WARNING: ELF file has incorrect STRTAB section type 0x%02x' % sec_type)
-        f.seek(sec_offs)
-        string_table = f.read(sec_size)
+        string_table = self._data[sec_offs:sec_offs + sec_size].tobytes()
 
-        # build the real list of ELFSections by reading the actual section names from the
-        # string table section, and actual data for each section from the ELF file itself
+        # build the real list of ELFSections from the section names in the string
+        # table section, each section's data is a view of the mapped ELF file
         def lookup_string(offs):
             raw = string_table[offs:]
             return raw[:raw.index(b'\x00')]
 
-        def read_data(offs,size):
-            f.seek(offs)
-            return f.read(size)
-
-        prog_sections = [ELFSection(lookup_string(n_offs), lma, read_data(offs, size)) for (n_offs, _type, lma, size, offs) in prog_sections
-                         if lma != 0]
-        self.sections = prog_sections
+        self.sections = [ELFSection(lookup_string(n_offs), lma, self._data[offs:offs + size])
+                         for (n_offs, _type, lma, size, offs, _link, _flags) in prog_sections if lma != 0]
+        self._sections_by_name = dict((s.name, s) for s in reversed(self.sections))  # first section wins
+        # every section header, in order so that a symbol's section index can be looked up
+        self.section_headers = [ELFSectionHeader(lookup_string(n_offs).decode("utf-8", "replace"), sec_type, flags, lma, size)
+                                for (n_offs, sec_type, lma, size, _offs, _link, flags) in all_sections]
+
+        # remember where the symbol table and its string table are, for read_symbols()
+        self._symtab = None
+        for (_, sec_type, _, size, offs, link, _) in all_sections:
+            if sec_type == ELFFile.SEC_TYPE_SYMTAB and link < len(all_sections):
+                _, _, _, str_size, str_offs, _, _ = all_sections[link]
+                self._symtab = (offs, size, str_offs, str_size)
+                break
+
+    def read_symbols(self):
+        """ Return an ELFSymbol for each function and data symbol defined in the
+        symbol table, in the order of the table. """
+        symbols = []
+        if self._symtab is None:
+            return symbols
+        offs, size, str_offs, str_size = self._symtab
+        string_table = self._data[str_offs:str_offs + str_size].tobytes()
+
+        def lookup_string(name_offs):
+            return string_table[name_offs:string_table.index(b'\x00', name_offs)].decode("utf-8", "replace")
+        file_name = None  # local symbols follow the FILE symbol of their source file
+        unpack_symbol = struct.Struct("<LLLBBH").unpack_from
+        for sym_offs in range(offs, offs + size - self.LEN_SYMBOL + 1, self.LEN_SYMBOL):
+            name_offs, value, sym_size, info, _other, shndx = unpack_symbol(self._data, sym_offs)
+            sym_type = info & 0xf
+            if sym_type == ELFFile.SYM_TYPE_FILE:
+                file_name = lookup_string(name_offs)
+            elif sym_type in (ELFFile.SYM_TYPE_OBJECT, ELFFile.SYM_TYPE_FUNC) and shndx != 0:
+                local = (info >> 4) == ELFFile.SYM_BIND_LOCAL
+                symbols.append(ELFSymbol(lookup_string(name_offs), value, sym_size, sym_type, shndx,
+                                         file_name if local else None))
+        return symbols
+
+    def _index_symbols(self):
+        symbols = sorted((s.addr, s.size, s.name) for s in self.read_symbols())
+        self._symbol_addrs = [value for value, _, _ in symbols]
+        self._symbols = symbols
+
+    def lookup_symbol(self, addr):
+        """ Return the (name, address, size) of the function or data symbol which
+        contains address 'addr', or None if there isn't one. """
+        if self._symbols is None:
+            self._index_symbols()
+        i = bisect.bisect_right(self._symbol_addrs, addr) - 1
+        if i >= 0:
+            value, size, name = self._symbols[i]
+            if addr < value + max(size, 1):
+                return (name, value, size)
+        return None
 
 
 def slip_reader(port, trace_function):
@@ -1971,9 +2120,13 @@ def slip_reader(port, trace_function):
 
     Designed to avoid too many calls to serial.read(1), which can bog
     down on slow systems.
+
+    Received data is split on the 0xC0 frame delimiters and each frame's
+    still-escaped content is accumulated in a bytearray, so the cost of
+    decoding is linear in the packet size. Escape sequences are undone
+    with bulk replace() calls once the whole frame has arrived.
     """
     partial_packet = None
-    in_escape = False
     while True:
         waiting = port.inWaiting()
         read_bytes = port.read(1 if waiting == 0 else waiting)
@@ -1982,35 +2135,51 @@ def slip_reader(port, trace_function):
             trace_function("Timed out waiting for packet %s", waiting_for)
             raise FatalError("Timed out waiting for packet %s" % waiting_for)
         trace_function("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
-        for b in read_bytes:
-            if type(b) is int:
-                b = bytes([b])  # python 2/3 compat
-
+        pos = 0
+        while pos < len(read_bytes):
             if partial_packet is None:  # waiting for packet header
-                if b == b'\xc0':
-                    partial_packet = b""
-                else:
+                b = read_bytes[pos:pos + 1]
+                if b != b'\xc0':
                     trace_function("Read invalid data: %s", HexFormatter(read_bytes))
                     trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
                     raise FatalError('Invalid head of packet (0x%s)' % hexify(b))
-            elif in_escape:  # part-way through escape sequence
-                in_escape = False
-                if b == b'\xdc':
-                    partial_packet += b'\xc0'
-                elif b == b'\xdd':
-                    partial_packet += b'\xdb'
-                else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
-                    raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % (hexify(b)))
-            elif b == b'\xdb':  # start of escape sequence
-                in_escape = True
-            elif b == b'\xc0':  # end of packet
-                trace_function("Received full packet: %s", HexFormatter(partial_packet))
-                yield partial_packet
-                partial_packet = None
-            else:  # normal byte in packet
-                partial_packet += b
+                partial_packet = bytearray()
+                pos += 1
+                continue
+            end = read_bytes.find(b'\xc0', pos)
+            if end == -1:  # packet continues in the next read
+                partial_packet += read_bytes[pos:]
+                break
+            partial_packet += read_bytes[pos:end]
+            pos = end + 1
+            try:
+                packet = slip_unescape(bytes(partial_packet))
+            except FatalError:
+                trace_function("Read invalid data: %s", HexFormatter(read_bytes))
+                trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+                raise
+            trace_function("Received full packet: %s", HexFormatter(packet))
+            yield packet
+            partial_packet = None
+
+
+def slip_unescape(data):
+    """ Undo SLIP escaping on the content of a single frame (without delimiters)
+
+    Every 0xDB byte must start a 0xDB 0xDC or 0xDB 0xDD escape sequence,
+    otherwise FatalError is raised. A trailing 0xDB is reported as being
+    followed by 0xC0, as that is the frame delimiter which ended the frame.
+    """
+    if b'\xdb' not in data:
+        return data
+    escapes = data.count(b'\xdb')
+    if escapes != data.count(b'\xdb\xdc') + data.count(b'\xdb\xdd'):
+        offs = data.find(b'\xdb')
+        while data[offs + 1:offs + 2] in (b'\xdc', b'\xdd'):
+            offs = data.find(b'\xdb', offs + 2)
+        b = data[offs + 1:offs + 2] or b'\xc0'
+        raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % (hexify(b)))
+    return data.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
 
 
 def arg_auto_int(x):
@@ -2214,61 +2383,316 @@ def _update_image_flash_params(esp, address, args, image):
     return image
 
 
-def write_flash(esp, args):
+def _read_image_chunks(argfile, header, md5, offset=0, size=None, chunk_size=0x10000):
+    """ Read 'size' bytes of argfile (default: up to the end) from 'offset', in chunks,
+    with the first bytes of the file replaced by 'header' and the end padded to 4 bytes.
+    Each chunk is also added to 'md5'. """
+    end = None if size is None else offset + size
+    pos = offset
+    argfile.seek(offset)
+    while end is None or pos < end:
+        chunk = argfile.read(chunk_size if end is None else min(chunk_size, end - pos))
+        if not chunk:
+            break
+        if pos < len(header):
+            chunk = header[pos:pos + len(chunk)] + chunk[len(header) - pos:]
+        pos += len(chunk)
+        chunk = pad_to(chunk, 4)
+        md5.update(chunk)
+        yield chunk
+
+
+def _deflate_chunks(chunks, level):
+    """ Compress an iterable of byte strings as one zlib stream """
+    compressor = zlib.compressobj(level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _deflate_bound(size):
+    """ Upper bound for the zlib compressed size of 'size' bytes (as zlib's deflateBound()) """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13 + 6
+
+
+def _split_blocks(chunks, block_size):
+    """ Re-chunk an iterable of byte strings into blocks of block_size bytes (the last one may be shorter) """
+    pending = b''
+    for data in chunks:
+        if pending:
+            data = pending + data
+        view = memoryview(data)
+        end = len(data) - len(data) % block_size
+        for offs in range(0, end, block_size):
+            yield view[offs:offs + block_size].tobytes()
+        pending = view[end:].tobytes()
+    if pending:
+        yield pending
+
+
+def _flash_blocks(esp, chunks, compress_level=None):
+    """ Generate (data, uncompressed size) pairs to send as flash data blocks, compressing
+    the image if compress_level is set. Uncompressed blocks are padded to FLASH_WRITE_SIZE. """
+    if compress_level is None:
+        for block in _split_blocks(chunks, esp.FLASH_WRITE_SIZE):
+            yield block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block)), len(block)
+        return
+    # decompress each block again to know how much it will write, in bounded steps
+    # as a single compressed block of 0xFF padding can expand to several megabytes
+    decompressor = zlib.decompressobj()
+    for block in _split_blocks(_deflate_chunks(chunks, compress_level), esp.FLASH_WRITE_SIZE):
+        size = 0
+        data = block
+        while data:
+            size += len(decompressor.decompress(data, 0x10000))
+            data = decompressor.unconsumed_tail
+        yield block, size
+
+
+def _print_write_progress(address, uncsize, offs, size):
+    print('\rWriting at 0x%08x... (%d %%)' % (address + offs, 100 * min(offs + size, uncsize) // uncsize), end='')
+    sys.stdout.flush()
+
+
+def _write_flash_blocks(esp, blocks, address, uncsize, compress, progress=_print_write_progress):
+    """ Send the (data, uncompressed size) pairs from _flash_blocks() to the loader after
+    flash_begin() or flash_defl_begin(). progress(address, uncsize, offset, size) is called for each block.
+    Returns the number of bytes sent.
+
+    Each block waits for the response to the previous one: the stub loader acknowledges a block before
+    writing it, and only has room to receive one more block meanwhile. """
+    sent = 0
+    offs = 0
+    for seq, (block, size) in enumerate(blocks):
+        progress(address, uncsize, offs, size)
+        if compress:
+            # compressed blocks can take a lot longer to write than to send
+            esp.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * max(1.0, size / len(block)))
+        else:
+            esp.flash_block(block, seq)
+        offs += size
+        sent += len(block)
+    return sent
+
+
+def _write_flash_region(esp, args, address, uncsize, compsize, blocks, progress=_print_write_progress):
+    """ Erase and write 'uncsize' bytes of flash at 'address' from the (data, uncompressed size)
+    blocks, as from _flash_blocks(). If args.compress is set, 'compsize' is the size of the
+    compressed data (or an upper bound for it, with the stub loader).
+
+    Returns (bytes sent, seconds taken).
+    """
+    if args.compress:
+        esp.flash_defl_begin(uncsize, compsize, address)
+    else:
+        esp.flash_begin(uncsize, address)
+    t = time.time()
+    written = _write_flash_blocks(esp, blocks, address, uncsize, args.compress, progress)
+    t = time.time() - t
+    if args.compress:
+        # only known once the stream is sent, as the image is compressed while it is written
+        print('\rCompressed %d bytes to %d...' % (uncsize, written))
+    return written, t
+
+
+def _write_flash_stream(esp, args, address, uncsize, read_chunks, compress_level):
+    """ Erase and write 'uncsize' bytes of flash at 'address', compressing as the data is sent.
+    read_chunks(md5) returns the image data to write, as from _read_image_chunks().
+
+    Returns (bytes sent, MD5 of the data written, seconds taken).
+    """
+    compsize = None
+    if args.compress:
+        if esp.IS_STUB:
+            # the stub only uses the compressed size to tell when the stream ends,
+            # so an upper bound lets us send blocks while the image is still compressing
+            compsize = _deflate_bound(uncsize)
+        else:
+            compsize = sum(len(data) for data in _deflate_chunks(read_chunks(hashlib.md5()), compress_level))
+    md5 = hashlib.md5()
+    blocks = _flash_blocks(esp, read_chunks(md5), compress_level)
+    written, t = _write_flash_region(esp, args, address, uncsize, compsize, blocks)
+    return written, md5.hexdigest(), t
+
+
+class FlashCache(object):
+    """ Local record of the MD5 of each flash region last written by write_flash --incremental,
+    stored as one JSON file per device (by MAC address) in 'cache_dir'.
+
+    This lets write_flash --incremental skip regions which haven't changed since the last
+    write without asking the device for their MD5. Flash written by anything else makes
+    the cache stale, so the result still needs verifying (see write_flash()).
+    """
+    def __init__(self, cache_dir, mac):
+        self.path = os.path.join(cache_dir, "%s.json" % "".join("%02x" % b for b in mac))
+        try:
+            with open(self.path) as f:
+                self._regions = dict((tuple(int(x, 16) for x in key.split(':')), md5)
+                                     for key, md5 in json.load(f).items())
+        except (IOError, ValueError):
+            self._regions = {}  # no cache yet, or unreadable
+
+    def get(self, address, size):
+        return self._regions.get((address, size))
+
+    def set(self, address, size, md5):
+        self.forget(address, size)
+        self._regions[(address, size)] = md5
+
+    def forget(self, address, size):
+        """ Drop the cached MD5s of any regions overlapping address to address + size """
+        for (r_address, r_size) in list(self._regions):
+            if r_address < address + size and address < r_address + r_size:
+                del self._regions[(r_address, r_size)]
+
+    def save(self):
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.path, "w") as f:
+            json.dump(dict(("0x%08x:0x%x" % key, md5) for key, md5 in self._regions.items()), f, indent=1, sort_keys=True)
+
+
+def _write_flash_incremental(esp, args, address, argfile, header, uncsize, compress_level, cache=None):
+    """ Write only the regions of the image which differ from the flash contents at 'address'.
+
+    Regions are args.incremental_region_size bytes long. A region is unchanged if its MD5
+    matches the one in 'cache' (if any), or the device's flash_md5sum() for it. Runs of
+    changed regions are written together.
+
+    Returns (bytes written, bytes sent, MD5 of the whole image, seconds taken).
+    """
+    region_size = args.incremental_region_size
+    md5 = hashlib.md5()
+    regions = [hashlib.md5(data).hexdigest()
+               for data in _split_blocks(_read_image_chunks(argfile, header, md5), region_size)]
+    calcmd5 = md5.hexdigest()
+
+    t = time.time()
+    changed = []
+    for i, region_md5 in enumerate(regions):
+        offs = i * region_size
+        size = min(region_size, uncsize - offs)
+        if cache is not None and cache.get(address + offs, size) == region_md5:
+            continue
+        if esp.flash_md5sum(address + offs, size) != region_md5:
+            changed.append(i)
+        elif cache is not None:
+            cache.set(address + offs, size, region_md5)
+    print('%d of %d regions at 0x%08x changed' % (len(changed), len(regions), address))
+
+    # write consecutive changed regions as one run
+    runs = []
+    for i in changed:
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+
+    uncwritten = 0
+    written = 0
+    for first, last in runs:
+        offs = first * region_size
+        size = min(last * region_size, uncsize) - offs
+
+        def read_chunks(md5, offs=offs, size=size):
+            return _read_image_chunks(argfile, header, md5, offs, size)
+        run_written, _, _ = _write_flash_stream(esp, args, address + offs, size, read_chunks, compress_level)
+        print('\rWrote %d bytes at 0x%08x...' % (size, address + offs))
+        uncwritten += size
+        written += run_written
+        if cache is not None:
+            for i in range(first, last):
+                cache.set(address + i * region_size, min(region_size, uncsize - i * region_size), regions[i])
+    return uncwritten, written, calcmd5, time.time() - t
+
+
+def _write_flash_defaults(args):
+    """ Apply the defaults of the write_flash data transfer options """
     # set args.compress based on default behaviour:
     # -> if either --compress or --no-compress is set, honour that
     # -> otherwise, set --compress unless --no-stub is set
     if args.compress is None and not args.no_compress:
         args.compress = not args.no_stub
 
-    # verify file sizes fit in flash
+
+def _check_files_fit(args, file_sizes):
+    """ Verify the (address, name, size) files fit in flash """
     flash_end = flash_size_bytes(args.flash_size)
-    for address, argfile in args.addr_filename:
-        argfile.seek(0,2)  # seek to end
-        if address + argfile.tell() > flash_end:
+    for address, name, size in file_sizes:
+        if address + size > flash_end:
             raise FatalError(("File %s (length %d) at offset %d will not fit in %d bytes of flash. " +
                              "Use --flash-size argument, or change flashing address.")
-                             % (argfile.name, argfile.tell(), address, flash_end))
+                             % (name, size, address, flash_end))
+
+
+def _leave_flash_mode(esp, args):
+    if esp.IS_STUB:
+        # skip sending flash_finish to ROM loader here,
+        # as it causes the loader to exit and run user code
+        esp.flash_begin(0, 0)
+        if args.compress:
+            esp.flash_defl_finish(False)
+        else:
+            esp.flash_finish(False)
+
+
+def write_flash(esp, args):
+    _write_flash_defaults(args)
+
+    # verify file sizes fit in flash
+    file_sizes = []
+    for address, argfile in args.addr_filename:
+        argfile.seek(0,2)  # seek to end
+        file_sizes.append((address, argfile.name, argfile.tell()))
         argfile.seek(0)
+    _check_files_fit(args, file_sizes)
+
+    compress_level = args.compress_level if args.compress else None
+
+    cache = None
+    if args.incremental:
+        if args.incremental_region_size <= 0 or args.incremental_region_size % esp.FLASH_SECTOR_SIZE != 0:
+            raise FatalError("--incremental-region-size must be a multiple of the flash sector size (0x%x)" % esp.FLASH_SECTOR_SIZE)
+        if not (esp.IS_STUB or esp.CHIP_NAME == "ESP32"):
+            print("WARNING: --incremental needs the flash MD5 command, which the %s ROM doesn't support. "
+                  "Writing whole images." % esp.CHIP_NAME)
+            args.incremental = False
+        elif args.incremental_cache:
+            cache = FlashCache(args.incremental_cache, esp.read_mac())
 
     for address, argfile in args.addr_filename:
         if args.no_stub:
             print('Erasing flash...')
-        image = pad_to(argfile.read(), 4)
-        if len(image) == 0:
+        argfile.seek(0, 2)
+        uncsize = (argfile.tell() + 3) & ~3  # padded to 4 bytes
+        if uncsize == 0:
             print('WARNING: File %s is empty' % argfile.name)
             continue
-        image = _update_image_flash_params(esp, address, args, image)
-        calcmd5 = hashlib.md5(image).hexdigest()
-        uncsize = len(image)
-        if args.compress:
-            uncimage = image
-            image = zlib.compress(uncimage, 9)
-            ratio = uncsize / len(image)
-            blocks = esp.flash_defl_begin(uncsize, len(image), address)
+        argfile.seek(0)
+        header = _update_image_flash_params(esp, address, args, argfile.read(8))
+        incremental = args.incremental
+        if incremental and address % esp.FLASH_SECTOR_SIZE != 0:
+            # erasing the first sector of a changed region would also erase part of the previous one
+            print('WARNING: 0x%08x is not a multiple of the flash sector size, writing whole image.' % address)
+            incremental = False
+        if incremental:
+            uncwritten, written, calcmd5, t = _write_flash_incremental(esp, args, address, argfile, header, uncsize,
+                                                                       compress_level, cache)
         else:
-            ratio = 1.0
-            blocks = esp.flash_begin(uncsize, address)
+            written, calcmd5, t = _write_flash_stream(esp, args, address, uncsize,
+                                                      lambda md5: _read_image_chunks(argfile, header, md5),
+                                                      compress_level)
+            uncwritten = uncsize
+            if cache is not None:
+                cache.forget(address, uncsize)
         argfile.seek(0)  # in case we need it again
-        seq = 0
-        written = 0
-        t = time.time()
-        while len(image) > 0:
-            print('\rWriting at 0x%08x... (%d %%)' % (address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks), end='')
-            sys.stdout.flush()
-            block = image[0:esp.FLASH_WRITE_SIZE]
-            if args.compress:
-                esp.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * ratio)
-            else:
-                # Pad the last block
-                block = block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block))
-                esp.flash_block(block, seq)
-            image = image[esp.FLASH_WRITE_SIZE:]
-            seq += 1
-            written += len(block)
-        t = time.time() - t
         speed_msg = ""
-        if args.compress:
+        if incremental:
+            print('Wrote %d of %d bytes at 0x%08x in %.1f seconds...' % (uncwritten, uncsize, address, t))
+        elif args.compress:
             if t > 0.0:
                 speed_msg = " (effective %.1f kbit/s)" % (uncsize / t * 8 / 1000)
             print('\rWrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % (uncsize, written, address, t, speed_msg))
@@ -2278,6 +2702,13 @@ def write_flash(esp, args):
             print('\rWrote %d bytes at 0x%08x in %.1f seconds%s...' % (written, address, t, speed_msg))
         try:
             res = esp.flash_md5sum(address, uncsize)
+            if res != calcmd5 and cache is not None:
+                # something else has written the flash since the cache was updated
+                print('Flash contents do not match the flash cache, checking all regions on the device...')
+                cache.forget(address, uncsize)
+                _write_flash_incremental(esp, args, address, argfile, header, uncsize, compress_level, cache)
+                argfile.seek(0)
+                res = esp.flash_md5sum(address, uncsize)
             if res != calcmd5:
                 print('File  md5: %s' % calcmd5)
                 print('Flash md5: %s' % res)
@@ -2287,17 +2718,11 @@ def write_flash(esp, args):
                 print('Hash of data verified.')
         except NotImplementedInROMError:
             pass
+        if cache is not None:
+            cache.save()
 
     print('\nLeaving...')
-
-    if esp.IS_STUB:
-        # skip sending flash_finish to ROM loader here,
-        # as it causes the loader to exit and run user code
-        esp.flash_begin(0, 0)
-        if args.compress:
-            esp.flash_defl_finish(False)
-        else:
-            esp.flash_finish(False)
+    _leave_flash_mode(esp, args)
 
     if args.verify:
         print('Verifying just-written flash...')
@@ -2305,6 +2730,156 @@ def write_flash(esp, args):
         verify_flash(esp, args)
 
 
+class _PrefixedOutput(object):
+    """ Replacement for sys.stdout while write_flash_multi runs, which prefixes each
+    line printed by a device's thread with that device's port """
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def set_prefix(self, prefix):
+        """ Set the prefix for lines printed by the current thread """
+        self._local.prefix = prefix
+        self._local.line = ''
+
+    def write(self, data):
+        prefix = getattr(self._local, 'prefix', None)
+        with self._lock:
+            if prefix is None:
+                self._stream.write(data)
+                return
+            # complete lines only, so lines from different threads don't get mixed up
+            lines = (self._local.line + data).replace('\r', '\n').split('\n')
+            self._local.line = lines.pop()
+            for line in lines:
+                if line:
+                    self._stream.write('[%s] %s\n' % (prefix, line))
+
+    def flush(self):
+        with self._lock:
+            self._stream.flush()
+
+
+class _PreparedImages(object):
+    """ Flash data for write_flash_multi, compressed and hashed once and then shared by
+    all devices which need the same data (same flash parameters and write block size) """
+    def __init__(self, compress_level):
+        self._compress_level = compress_level
+        self._lock = threading.Lock()
+        self._prepared = {}
+
+    def get(self, esp, args, address, image):
+        """ Return (blocks, uncompressed size, compressed size, MD5) of 'image' written at
+        'address' by 'esp', where blocks are (data, uncompressed size) pairs """
+        header = _update_image_flash_params(esp, address, args, image[:8])
+        key = (address, header, esp.FLASH_WRITE_SIZE, len(image))
+        with self._lock:
+            if key not in self._prepared:
+                md5 = hashlib.md5()
+                blocks = list(_flash_blocks(esp, _read_image_chunks(io.BytesIO(image), header, md5), self._compress_level))
+                self._prepared[key] = (blocks, (len(image) + 3) & ~3, sum(len(data) for data, _ in blocks), md5.hexdigest())
+            return self._prepared[key]
+
+
+class _DeviceResult(object):
+    def __init__(self, port):
+        self.port = port
+        self.mac = None
+        self.error = None
+        self.written = 0
+        self.seconds = 0.0
+
+
+def _write_flash_device(args, images, prepared, result):
+    """ Connect to one device and write the images to it, for write_flash_multi """
+    esp = None
+    t = time.time()
+    try:
+        initial_baud = _initial_baud(args)
+        esp = _connect_esp(result.port, args, initial_baud)
+        esp = _configure_esp(esp, args, initial_baud)
+        result.mac = esp.read_mac()
+        _check_files_fit(args, [(address, name, len(image)) for address, name, image in images])
+
+        for address, name, image in images:
+            if len(image) == 0:
+                print('WARNING: File %s is empty' % name)
+                continue
+            blocks, uncsize, compsize, calcmd5 = prepared.get(esp, args, address, image)
+            # report progress in 10% steps, a line per block would be too much with many devices
+            last_step = [-1]
+
+            def progress(address, uncsize, offs, size):
+                percent = 100 * min(offs + size, uncsize) // uncsize
+                if percent // 10 != last_step[0]:
+                    last_step[0] = percent // 10
+                    print('Writing at 0x%08x... (%d %%)' % (address + offs, percent))
+            _write_flash_region(esp, args, address, uncsize, compsize, blocks, progress)
+            result.written += uncsize
+            try:
+                if esp.flash_md5sum(address, uncsize) != calcmd5:
+                    raise FatalError("MD5 of file %s does not match data in flash at 0x%08x!" % (name, address))
+                print('Hash of data at 0x%08x verified.' % address)
+            except NotImplementedInROMError:
+                pass
+
+        _leave_flash_mode(esp, args)
+        _after_operation(esp, args, write_flash_multi)
+    except Exception as e:  # one failed device shouldn't stop the others
+        result.error = e
+        print('A fatal error occurred: %s' % e)
+        if esp is not None:
+            esp._port.close()
+    result.seconds = time.time() - t
+
+
+def write_flash_multi(args):
+    _write_flash_defaults(args)
+    compress_level = args.compress_level if args.compress else None
+
+    images = []
+    for address, argfile in args.addr_filename:
+        images.append((address, argfile.name, argfile.read()))
+        argfile.close()
+    prepared = _PreparedImages(compress_level)
+
+    results = []
+    threads = []
+    output = _PrefixedOutput(sys.stdout)
+    saved_stdout, sys.stdout = sys.stdout, output
+    try:
+        for port in args.ports:
+            result = _DeviceResult(port)
+            # each device has its own copy of args, as connecting can update it (ie detected flash size)
+            device_args = copy.copy(args)
+
+            def run(device_args=device_args, result=result):
+                output.set_prefix(result.port)
+                _write_flash_device(device_args, images, prepared, result)
+            thread = threading.Thread(target=run, name=port)
+            thread.start()
+            results.append(result)
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.stdout = saved_stdout
+
+    print('\nSummary:')
+    width = max(len(result.port) for result in results)
+    for result in results:
+        mac = ':'.join('%02x' % b for b in result.mac) if result.mac else '?'
+        if result.error is None:
+            status = 'OK, wrote %d bytes in %.1f seconds' % (result.written, result.seconds)
+        else:
+            status = 'FAILED: %s' % result.error
+        print('  %-*s  %-17s  %s' % (width, result.port, mac, status))
+    failed = sum(1 for result in results if result.error is not None)
+    if failed:
+        raise FatalError('%d of %d devices failed' % (failed, len(results)))
+
+
 def image_info(args):
     image = LoadFirmwareImage(args.chip, args.filename)
     print('Image version: %d' % image.version)
@@ -2343,31 +2918,31 @@ def make_image(args):
 
 
 def elf2image(args):
-    e = ELFFile(args.input)
-    if args.chip == 'auto':  # Default to ESP8266 for backwards compatibility
-        print("Creating image for ESP8266...")
-        args.chip = 'esp8266'
-
-    if args.chip == 'esp32':
-        image = ESP32FirmwareImage()
-    elif args.version == '1':  # ESP8266
-        image = ESP8266ROMFirmwareImage()
-    elif args.version == '2':  # ESP8266
-    	    image = ESP8266V2FirmwareImage()
-    else:
-        image = ESP8266V3FirmwareImage()
-    image.entrypoint = e.entrypoint
-    image.segments = e.sections  # ELFSection is a subclass of ImageSegment
-    image.flash_mode = {'qio':0, 'qout':1, 'dio':2, 'dout': 3}[args.flash_mode]
-    image.flash_size_freq = image.ROM_LOADER.FLASH_SIZES[args.flash_size]
-    image.flash_size_freq += {'40m':0, '26m':1, '20m':2, '80m': 0xf}[args.flash_freq]
-
-    if args.version == '1' and args.rom_print == 0:
-        image.close_rom_print()
-
-    if args.output is None:
-        args.output = image.default_output_name(args.input)
-    image.save(args.output)
+    with ELFFile(args.input) as e:
+        if args.chip == 'auto':  # Default to ESP8266 for backwards compatibility
+            print("Creating image for ESP8266...")
+            args.chip = 'esp8266'
+
+        if args.chip == 'esp32':
+            image = ESP32FirmwareImage()
+        elif args.version == '1':  # ESP8266
+            image = ESP8266ROMFirmwareImage()
+        elif args.version == '2':  # ESP8266
+            image = ESP8266V2FirmwareImage()
+        else:
+            image = ESP8266V3FirmwareImage()
+        image.entrypoint = e.entrypoint
+        image.segments = e.sections  # ELFSection is a subclass of ImageSegment
+        image.flash_mode = {'qio':0, 'qout':1, 'dio':2, 'dout': 3}[args.flash_mode]
+        image.flash_size_freq = image.ROM_LOADER.FLASH_SIZES[args.flash_size]
+        image.flash_size_freq += {'40m':0, '26m':1, '20m':2, '80m': 0xf}[args.flash_freq]
+
+        if args.version == '1' and args.rom_print == 0:
+            image.close_rom_print()
+
+        if args.output is None:
+            args.output = image.default_output_name(args.input)
+        image.save(args.output)
 
 
 def read_mac(esp, args):
@@ -2413,6 +2988,118 @@ def flash_id(esp, args):
     print('Detected flash size: %s' % (DETECTED_FLASH_SIZES.get(flid_lowbyte, "Unknown")))
 
 
+def _read_flash_to_file(esp, f, address, offs, size, flash_progress, total, done, md5=None):
+    """ Read 'size' bytes of flash at 'address + offs' into file 'f' at 'offs', writing each
+    block as it arrives (and adding it to 'md5', if given). 'done' is the number of bytes of
+    'total' already read, for progress. """
+    def progress(progress, length):
+        flash_progress(done + progress, total)
+    f.seek(offs)
+    for block in esp.read_flash_blocks(address + offs, size, progress if flash_progress else None):
+        f.write(block)
+        if md5 is not None:
+            md5.update(block)
+
+
+def _md5_file(f, size, chunk_size=0x10000):
+    """ MD5 of the first 'size' bytes of file 'f' """
+    md5 = hashlib.md5()
+    f.seek(0)
+    while size > 0:
+        data = f.read(min(chunk_size, size))
+        if not data:
+            break
+        md5.update(data)
+        size -= len(data)
+    return md5
+
+
+def _verify_read(esp, args, md5):
+    """ Compare the MD5 of the dump with the flash, if the loader can calculate it """
+    if not (esp.IS_STUB or esp.CHIP_NAME == "ESP32"):
+        return
+    if esp.flash_md5sum(args.address, args.size) != md5.hexdigest():
+        raise FatalError('Flash changed while it was being read')
+    print('Hash of data verified.')
+
+
+def _read_flash_changed(esp, args, flash_progress):
+    """ Read args.size bytes of flash at args.address into args.filename, reusing the
+    regions of the args.previous dump whose MD5 matches the flash contents.
+
+    Regions are args.region_size bytes long. Runs of changed regions are read together.
+    Returns the number of bytes read from flash.
+    """
+    region_size = args.region_size
+    regions = range(0, args.size, region_size)
+    changed = []
+    with open(args.previous, 'rb') as f:
+        for offs in regions:
+            size = min(region_size, args.size - offs)
+            old = f.read(size)
+            if len(old) != size or esp.flash_md5sum(args.address + offs, size) != hashlib.md5(old).hexdigest():
+                changed.append(offs)
+    print('%d of %d regions at 0x%08x changed' % (len(changed), len(regions), args.address))
+
+    # read consecutive changed regions as one run
+    runs = []
+    for offs in changed:
+        if runs and runs[-1][1] == offs:
+            runs[-1][1] = min(offs + region_size, args.size)
+        else:
+            runs.append([offs, min(offs + region_size, args.size)])
+
+    # patch the changed regions into a copy of the previous dump
+    if os.path.abspath(args.previous) != os.path.abspath(args.filename):
+        shutil.copyfile(args.previous, args.filename)
+    total = sum(end - start for start, end in runs)
+    done = 0
+    with open(args.filename, 'r+b') as f:
+        f.truncate(args.size)
+        for start, end in runs:
+            _read_flash_to_file(esp, f, args.address, start, end - start, flash_progress, total, done)
+            done += end - start
+        _verify_read(esp, args, _md5_file(f, args.size))
+    return done
+
+
+def _read_flash_resumable(esp, args, flash_progress):
+    """ Read args.size bytes of flash at args.address into args.filename, args.checkpoint_size
+    bytes at a time. After each piece is read and its digest checked, the offset reached is
+    saved in args.filename + '.checkpoint', so an interrupted read of the same region can carry on
+    from there. Returns the number of bytes read from flash. """
+    checkpoint_path = args.filename + '.checkpoint'
+    offs = 0
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if (checkpoint['address'], checkpoint['size']) == (args.address, args.size) and \
+           os.path.getsize(args.filename) >= checkpoint['offset']:
+            offs = checkpoint['offset']
+            print('Resuming read from 0x%08x...' % (args.address + offs))
+    except (IOError, OSError, ValueError, KeyError):
+        pass  # no checkpoint, or it isn't usable
+
+    with open(args.filename, 'r+b' if offs else 'wb') as f:
+        f.truncate(offs)
+        md5 = _md5_file(f, offs)  # running MD5 of the whole dump
+        start = offs
+        while offs < args.size:
+            size = min(args.checkpoint_size, args.size - offs)
+            _read_flash_to_file(esp, f, args.address, offs, size, flash_progress, args.size, offs, md5)
+            offs += size
+            f.flush()
+            os.fsync(f.fileno())
+            with open(checkpoint_path, 'w') as c:
+                json.dump({'address': args.address, 'size': args.size, 'offset': offs}, c)
+        try:
+            _verify_read(esp, args, md5)
+        finally:
+            # reading the same data again won't help if the flash changed
+            os.remove(checkpoint_path)
+    return args.size - start
+
+
 def read_flash(esp, args):
     if args.no_progress:
         flash_progress = None
@@ -2424,16 +3111,88 @@ def read_flash(esp, args):
                 padding = '\n'
             sys.stdout.write(msg + padding)
             sys.stdout.flush()
+    if args.checkpoint_size <= 0 or args.checkpoint_size % esp.FLASH_SECTOR_SIZE != 0:
+        raise FatalError("--checkpoint-size must be a multiple of the flash sector size (0x%x)" % esp.FLASH_SECTOR_SIZE)
+    previous = args.previous
+    if previous is not None:
+        if args.region_size <= 0 or args.region_size % esp.FLASH_SECTOR_SIZE != 0:
+            raise FatalError("--region-size must be a multiple of the flash sector size (0x%x)" % esp.FLASH_SECTOR_SIZE)
+        if not (esp.IS_STUB or esp.CHIP_NAME == "ESP32"):
+            print("WARNING: --previous needs the flash MD5 command, which the %s ROM doesn't support. "
+                  "Reading the whole region." % esp.CHIP_NAME)
+            previous = None
     t = time.time()
-    data = esp.read_flash(args.address, args.size, flash_progress)
-    t = time.time() - t
-    print('\rRead %d bytes at 0x%x in %.1f seconds (%.1f kbit/s)...'
-          % (len(data), args.address, t, len(data) / t * 8 / 1000))
-    open(args.filename, 'wb').write(data)
+    if previous is not None:
+        read = _read_flash_changed(esp, args, flash_progress)
+        t = time.time() - t
+        print('\rRead %d bytes (%d changed) at 0x%x in %.1f seconds...' % (args.size, read, args.address, t))
+    else:
+        read = _read_flash_resumable(esp, args, flash_progress)
+        t = time.time() - t
+        speed_msg = ""
+        if t > 0.0:
+            speed_msg = " (%.1f kbit/s)" % (read / t * 8 / 1000)
+        print('\rRead %d bytes at 0x%x in %.1f seconds%s...' % (args.size, args.address, t, speed_msg))
+
+
+def _diff_ranges(flash, image, chunk_size=0x1000):
+    """ Return the (offset, length) ranges where the equal length byte strings 'flash' and 'image' differ.
+
+    Chunks of 'chunk_size' bytes which compare equal are skipped without looking at individual bytes.
+    """
+    ranges = []
+    for offs in range(0, len(image), chunk_size):
+        flash_chunk = flash[offs:offs + chunk_size]
+        image_chunk = image[offs:offs + chunk_size]
+        if flash_chunk == image_chunk:
+            continue
+        # bytearray indexes to ints on both Python 2 & 3
+        for i, (f, b) in enumerate(zip(bytearray(flash_chunk), bytearray(image_chunk))):
+            if f == b:
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][1] == offs + i:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([offs + i, 1])
+    return [tuple(r) for r in ranges]
+
+
+def _diff_sector_counts(address, ranges, sector_size=0x1000):
+    """ Return an OrderedDict of sector address -> number of differing bytes, for the
+    ranges returned by _diff_ranges() of an image at 'address' """
+    counts = collections.OrderedDict()
+    for offs, length in ranges:
+        start = address + offs
+        end = start + length
+        while start < end:
+            sector = start - start % sector_size
+            n = min(end, sector + sector_size) - start
+            counts[sector] = counts.get(sector, 0) + n
+            start += n
+    return counts
+
+
+def _print_diff(address, flash, image, ranges, sector_size):
+    print('-- verify FAILED: %d differences in %d ranges, first @ 0x%08x'
+          % (sum(length for _, length in ranges), len(ranges), address + ranges[0][0]))
+    print('   Differing ranges (flash / file contents shown for up to 16 bytes):')
+    for offs, length in ranges:
+        if length == 1:
+            line = '   0x%08x             (1 byte)' % (address + offs)
+        else:
+            line = '   0x%08x-0x%08x  (%d bytes)' % (address + offs, address + offs + length - 1, length)
+        if length <= 16:
+            line += ' %s / %s' % (hexify(flash[offs:offs + length], False), hexify(image[offs:offs + length], False))
+        print(line)
+    print('   Differing bytes per %d KB sector:' % (sector_size // 1024))
+    for sector, count in _diff_sector_counts(address, ranges, sector_size).items():
+        print('   0x%08x %5d' % (sector, count))
 
 
 def verify_flash(esp, args):
     differences = False
+    diff = getattr(args, 'diff', 'no')
+    report = []
 
     for address, argfile in args.addr_filename:
         image = pad_to(argfile.read(), 4)
@@ -2443,29 +3202,34 @@ def verify_flash(esp, args):
 
         image_size = len(image)
         print('Verifying 0x%x (%d) bytes @ 0x%08x in flash against %s...' % (image_size, image_size, address, argfile.name))
+        file_report = collections.OrderedDict([('file', argfile.name), ('address', address), ('size', image_size)])
+        report.append(file_report)
         # Try digest first, only read if there are differences.
         digest = esp.flash_md5sum(address, image_size)
         expected_digest = hashlib.md5(image).hexdigest()
+        file_report['match'] = digest == expected_digest
         if digest == expected_digest:
             print('-- verify OK (digest matched)')
             continue
         else:
             differences = True
-            if getattr(args, 'diff', 'no') != 'yes':
+            if diff == 'no':
                 print('-- verify FAILED (digest mismatch)')
                 continue
 
         flash = esp.read_flash(address, image_size)
         assert flash != image
-        diff = [i for i in range(image_size) if flash[i] != image[i]]
-        print('-- verify FAILED: %d differences, first @ 0x%08x' % (len(diff), address + diff[0]))
-        for d in diff:
-            flash_byte = flash[d]
-            image_byte = image[d]
-            if PYTHON2:
-                flash_byte = ord(flash_byte)
-                image_byte = ord(image_byte)
-            print('   %08x %02x %02x' % (address + d, flash_byte, image_byte))
+        ranges = _diff_ranges(flash, image, esp.FLASH_SECTOR_SIZE)
+        if diff == 'json':
+            print('-- verify FAILED: %d differences' % sum(length for _, length in ranges))
+            file_report['differences'] = sum(length for _, length in ranges)
+            file_report['ranges'] = [[address + offs, length] for offs, length in ranges]
+            file_report['sectors'] = [[sector, count] for sector, count
+                                      in _diff_sector_counts(address, ranges, esp.FLASH_SECTOR_SIZE).items()]
+        else:
+            _print_diff(address, flash, image, ranges, esp.FLASH_SECTOR_SIZE)
+    if diff == 'json':
+        print(json.dumps(report))
     if differences:
         raise FatalError("Verify failed.")
 
@@ -2491,7 +3255,348 @@ def version(args):
 #
 
 
-def main():
+def _initial_baud(args):
+    if args.before != "no_reset_no_sync":
+        return min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
+    else:
+        return args.baud
+
+
+def _connect_esp(port, args, initial_baud):
+    """ Connect to the chip on 'port', detecting its type if --chip is 'auto' """
+    if args.chip == 'auto':
+        return ESPLoader.detect_chip(port, initial_baud, args.before, args.trace)
+    chip_class = {
+        'esp8266': ESP8266ROM,
+        'esp32': ESP32ROM,
+    }[args.chip]
+    esp = chip_class(port, initial_baud, args.trace)
+    esp.connect(args.before)
+    return esp
+
+
+def _configure_esp(esp, args, initial_baud):
+    """ Prepare a newly connected chip for an operation, as configured by the command line
+    arguments: run the stub, change baud rate, configure SPI flash. Returns the ESPLoader
+    to use, which is the stub loader unless --no-stub was given. """
+    print("Chip is %s" % (esp.get_chip_description()))
+
+    print("Features: %s" % ", ".join(esp.get_chip_features()))
+
+    read_mac(esp, args)
+
+    if not args.no_stub:
+        esp = esp.run_stub()
+
+    if args.override_vddsdio:
+        esp.override_vddsdio(args.override_vddsdio)
+
+    if args.baud > initial_baud:
+        try:
+            esp.change_baud(args.baud)
+        except NotImplementedInROMError:
+            print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
+
+    _configure_flash(esp, args)
+    return esp
+
+
+def _configure_flash(esp, args):
+    """ Configure the SPI flash of a connected chip for an operation, as configured by its arguments """
+    # override common SPI flash parameter stuff if configured to do so
+    if hasattr(args, "spi_connection") and args.spi_connection is not None:
+        if esp.CHIP_NAME != "ESP32":
+            raise FatalError("Chip %s does not support --spi-connection option." % esp.CHIP_NAME)
+        print("Configuring SPI flash mode...")
+        esp.flash_spi_attach(args.spi_connection)
+    elif args.no_stub:
+        print("Enabling default SPI flash mode...")
+        # ROM loader doesn't enable flash unless we explicitly do it
+        esp.flash_spi_attach(0)
+
+    if hasattr(args, "flash_size"):
+        print("Configuring flash size...")
+        detect_flash_size(esp, args)
+        esp.flash_set_parameters(flash_size_bytes(args.flash_size))
+
+
+def _open_esp(args):
+    """ Connect to the chip on --port and prepare it as configured by the command line arguments.
+    Returns the ESPLoader to use. """
+    initial_baud = _initial_baud(args)
+
+    ser_list = sorted(ports.device for ports in list_ports.comports())
+    if args.port is None:
+        raise FatalError('Cannot find target port named \'%s\'.' % args.port)
+
+    try:
+        esp = _connect_esp(args.port, args, initial_baud)
+    except FatalError as err:
+        if args.port is not None:
+            raise
+        print("%s failed to connect: %s" % (args.port, err))
+        esp = None
+    if esp is None:
+        raise FatalError("All of the %d available serial ports could not connect to a Espressif device." % len(ser_list))
+
+    return _configure_esp(esp, args, initial_baud)
+
+
+def _operation_takes_esp(operation_func):
+    """ Operation functions take either (esp, args) or only (args) """
+    if PYTHON2:
+        # This function is depreciated in Python3
+        operation_args = inspect.getargspec(operation_func).args
+    else:
+        operation_args = inspect.getfullargspec(operation_func).args
+    return operation_args[0] == 'esp'
+
+
+def _after_operation(esp, args, operation_func):
+    """ Handle post-operation behaviour (reset or other) """
+    if operation_func == load_ram:
+        # the ESP is now running the loaded image, so let it run
+        print('Exiting immediately.')
+    elif args.after == 'hard_reset':
+        print('Hard resetting via RTS pin...')
+        esp.hard_reset()
+    elif args.after == 'soft_reset':
+        print('Soft resetting...')
+        # flash_finish will trigger a soft reset
+        esp.soft_reset(False)
+    else:
+        print('Staying in bootloader.')
+        if esp.IS_STUB:
+            esp.soft_reset(True)  # exit stub back to ROM loader
+    esp._port.close()
+
+
+# global options which set up the connection to the chip, the session's are used for each command it runs
+_SESSION_OPTIONS = ['chip', 'port', 'baud', 'before', 'after', 'no_stub', 'trace', 'override_vddsdio', 'session']
+
+# operations after which the chip isn't running the loader any more, or which need their own connection
+_SESSION_EXCLUDED_OPERATIONS = ['load_ram', 'run', 'serve_session', 'write_flash_multi']
+
+
+class FlashSession(object):
+    """ Connection to a chip which is kept open, with the stub loader running and the baud rate changed,
+    to run several esptool.py commands one after another without connecting again for each:
+
+        with FlashSession.connect(["--port", "/dev/ttyUSB0", "--baud", "921600"]) as session:
+            session.run(["read_flash", "0x8000", "0xc00", "partitions.bin"])
+            session.run(["erase_region", "0x10000", "0x1000"])
+
+    The chip is reset as given by --after when the session is closed.
+
+    If --session or ESPTOOL_SESSION gives a serve_session of another esptool.py, connect() returns a
+    SessionClient running the commands in that session instead.
+    """
+
+    def __init__(self, esp, args):
+        """ Session of 'esp', a connected and configured ESPLoader. 'args' are the parsed
+        global options it was connected with """
+        self.esp = esp
+        self.args = args
+        self._parser = _build_parser()
+
+    @classmethod
+    def connect(cls, esptool_args=()):
+        """ Connect to the chip as configured by the global esptool.py options 'esptool_args' """
+        args = _build_parser().parse_args(list(esptool_args) + ['version'])
+        if args.session:
+            return SessionClient(args.session)
+        return cls(_open_esp(args), args)
+
+    def run(self, command):
+        """ Run the esptool.py command line 'command', a list of arguments. Any global options in it
+        which set up the connection are ignored (_SESSION_OPTIONS), those of the session are used. """
+        if self.esp is None:
+            raise FatalError("The session is closed")
+        args = self._parser.parse_args(command)
+        if args.operation is None:
+            raise FatalError("No esptool.py command given")
+        if args.operation in _SESSION_EXCLUDED_OPERATIONS:
+            raise FatalError("%s can't run in a session" % args.operation)
+        for name in _SESSION_OPTIONS:
+            setattr(args, name, getattr(self.args, name))
+        operation_func = globals()[args.operation]
+        if _operation_takes_esp(operation_func):
+            _configure_flash(self.esp, args)
+            operation_func(self.esp, args)
+        else:
+            operation_func(args)
+
+    def close(self):
+        if self.esp is not None:
+            _after_operation(self.esp, self.args, None)
+            self.esp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SessionClient(object):
+    """ Runs esptool.py commands in the serve_session of another esptool.py, given as TOKEN@HOST:PORT,
+    in the same way as FlashSession. Closing the client leaves that session running. """
+
+    def __init__(self, session):
+        _session_token_address(session)  # check it early
+        self.session = session
+
+    def run(self, command):
+        """ Run the esptool.py command line 'command', a list of arguments, in the session """
+        if self.session is None:
+            raise FatalError("The session is closed")
+        _run_in_session(self.session, {'argv': list(command), 'cwd': os.getcwd()})
+
+    def close(self):
+        self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _session_address(address):
+    """ (host, port) of a --listen HOST:PORT """
+    host, _, port = address.rpartition(':')
+    try:
+        return host or 'localhost', int(port)
+    except ValueError:
+        raise FatalError("%s is not a session address like localhost:6123" % address)
+
+
+def _session_token_address(session):
+    """ (token, (host, port)) of a --session TOKEN@HOST:PORT, as printed by serve_session """
+    token, _, address = session.rpartition('@')
+    if not token:
+        raise FatalError("%s is not a session like TOKEN@localhost:6123, as printed by serve_session" % session)
+    return token, _session_address(address)
+
+
+def _is_loopback(host):
+    """ True if 'host' is only reachable from this machine """
+    try:
+        return all(info[4][0].startswith('127.') for info in socket.getaddrinfo(host, None, socket.AF_INET))
+    except socket.gaierror:
+        return False
+
+
+def _send_message(conn, **message):
+    """ Session requests and replies are lines of JSON """
+    conn.sendall((json.dumps(message) + '\n').encode())
+
+
+class _SessionOutput(object):
+    """ Replacement for sys.stdout while a session runs a command sent by another esptool.py,
+    which sends what the command prints back to it """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def write(self, text):
+        if text:
+            _send_message(self._conn, output=text)
+
+    def flush(self):
+        pass
+
+
+def _serve_request(session, token, conn):
+    """ Run the command of one request to a session. Returns False once the session should stop """
+    request = json.loads(conn.makefile('rb').readline().decode())
+    if not hmac.compare_digest(str(request.get('token', '')).encode(), token.encode()):
+        _send_message(conn, status=2, error="Invalid session token")
+        return True
+    if request.get('close'):
+        _send_message(conn, status=0)
+        return False
+    stdout = sys.stdout
+    cwd = os.getcwd()
+    sys.stdout = _SessionOutput(conn)
+    error = None
+    try:
+        os.chdir(request['cwd'])  # relative file names in the command are those of the client
+        session.run(request['argv'])
+    except SystemExit as e:  # invalid arguments
+        error = "Invalid command line: %s" % " ".join(request['argv']) if e.code else None
+    except Exception as e:
+        error = str(e)
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+    if error is not None:
+        print("Command failed: %s" % error)
+    _send_message(conn, status=0 if error is None else 2, error=error)
+    return True
+
+
+def serve_session(esp, args):
+    """ Run the commands sent by other esptool.py processes given --session. Anyone who can connect to the
+    session can run any command, so it only listens on loopback addresses, and each request must carry the
+    session's random token. """
+    host, port = _session_address(args.listen)
+    if not _is_loopback(host):
+        raise FatalError("serve_session only listens on loopback addresses (ie localhost), not %s" % host)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((host, port))
+        server.listen(1)
+        session = FlashSession(esp, args)
+        token = binascii.hexlify(os.urandom(16)).decode()
+        session_arg = '%s@%s:%d' % ((token,) + server.getsockname()[:2])
+        print('Serving session on %s:%d. Set ESPTOOL_SESSION=%s to run esptool.py commands in it, '
+              'and run "esptool.py --session %s close_session" to end it.'
+              % (server.getsockname()[:2] + (session_arg, session_arg)))
+        sys.stdout.flush()
+        serving = True
+        while serving:
+            conn, _ = server.accept()
+            try:
+                serving = _serve_request(session, token, conn)
+            except (IOError, ValueError) as e:  # the client went away, or didn't send a request
+                print("Session request failed: %s" % e)
+            finally:
+                conn.close()
+    finally:
+        server.close()
+
+
+def close_session(args):
+    raise FatalError("close_session needs --session or ESPTOOL_SESSION")
+
+
+def _run_in_session(session, request):
+    """ Send 'request' to the serve_session of another esptool.py and print the output of its command """
+    token, (host, port) = _session_token_address(session)
+    address = '%s:%d' % (host, port)
+    try:
+        conn = socket.create_connection((host, port))
+    except socket.error as e:
+        raise FatalError("Can't connect to the session at %s: %s" % (address, e))
+    try:
+        _send_message(conn, token=token, **request)
+        for line in conn.makefile('rb'):
+            reply = json.loads(line.decode())
+            if 'output' in reply:
+                sys.stdout.write(reply['output'])
+                sys.stdout.flush()
+            elif reply['status'] != 0:
+                raise FatalError("Session at %s: %s" % (address, reply['error']))
+            else:
+                return
+        raise FatalError("Session at %s closed the connection" % address)
+    finally:
+        conn.close()
+
+
+def _build_parser():
     parser = argparse.ArgumentParser(description='esptool.py v%s - ESP8266 ROM Bootloader Utility' % __version__, prog='esptool')
 
     parser.add_argument('--chip', '-c',
@@ -2532,6 +3637,12 @@ def main():
         help="Enable trace-level output of esptool.py interactions.",
         action='store_true')
 
+    parser.add_argument(
+        '--session',
+        help="Run the command in this serve_session, which is already connected to the chip. "
+        "TOKEN@HOST:PORT, as printed by serve_session",
+        default=os.environ.get('ESPTOOL_SESSION', None))
+
     parser.add_argument(
         '--override-vddsdio',
         help="Override ESP32 VDDSDIO internal voltage regulator (use with care)",
@@ -2600,6 +3711,29 @@ def main():
     compress_args = parser_write_flash.add_mutually_exclusive_group(required=False)
     compress_args.add_argument('--compress', '-z', help='Compress data in transfer (default unless --no-stub is specified)',action="store_true", default=None)
     compress_args.add_argument('--no-compress', '-u', help='Disable data compression during transfer (default if --no-stub is specified)',action="store_true")
+    parser_write_flash.add_argument('--compress-level', help='zlib compression level used with --compress (default 9)',
+                                    type=int, choices=range(10), metavar='{0-9}', default=9)
+    parser_write_flash.add_argument('--incremental', help='Only erase and write the regions of each file which differ from the flash contents',
+                                    action='store_true')
+    parser_write_flash.add_argument('--incremental-region-size', help='Size of the regions compared by --incremental (default 0x10000)',
+                                    type=arg_auto_int, default=0x10000)
+    parser_write_flash.add_argument('--incremental-cache', help='Directory to record the regions written by --incremental for each device (by MAC), '
+                                    'so unchanged regions are skipped without reading them back. Set to an empty string to disable.',
+                                    default=os.environ.get('ESPTOOL_FLASH_CACHE', os.path.join(os.path.expanduser('~'), '.esptool', 'flash_cache')))
+
+    parser_write_flash_multi = subparsers.add_parser(
+        'write_flash_multi',
+        help='Write binary blobs to flash on several devices at once')
+    parser_write_flash_multi.add_argument('--ports', help='Comma separated list of serial ports, one per device',
+                                          type=lambda ports: [port for port in ports.split(',') if port], required=True)
+    parser_write_flash_multi.add_argument('addr_filename', metavar='<address> <filename>', help='Address followed by binary filename, separated by space',
+                                          action=AddrFilenamePairAction)
+    add_spi_flash_subparsers(parser_write_flash_multi, is_elf2image=False)
+    compress_args = parser_write_flash_multi.add_mutually_exclusive_group(required=False)
+    compress_args.add_argument('--compress', '-z', help='Compress data in transfer (default unless --no-stub is specified)',action="store_true", default=None)
+    compress_args.add_argument('--no-compress', '-u', help='Disable data compression during transfer (default if --no-stub is specified)',action="store_true")
+    parser_write_flash_multi.add_argument('--compress-level', help='zlib compression level used with --compress (default 9)',
+                                          type=int, choices=range(10), metavar='{0-9}', default=9)
 
     subparsers.add_parser(
         'run',
@@ -2665,14 +3799,22 @@ def main():
     parser_read_flash.add_argument('size', help='Size of region to dump', type=arg_auto_int)
     parser_read_flash.add_argument('filename', help='Name of binary dump')
     parser_read_flash.add_argument('--no-progress', '-p', help='Suppress progress output', action="store_true")
+    parser_read_flash.add_argument('--previous', help='Previous dump of the same region. Only the regions which have changed since '
+                                   'are read from the device, the rest are copied from this file')
+    parser_read_flash.add_argument('--region-size', help='Size of the regions compared by --previous (default 0x10000)',
+                                   type=arg_auto_int, default=0x10000)
+    parser_read_flash.add_argument('--checkpoint-size', help='Record progress in <filename>.checkpoint after each block of this size is read, '
+                                   'so an interrupted read resumes from there (default 0x40000)',
+                                   type=arg_auto_int, default=0x40000)
 
     parser_verify_flash = subparsers.add_parser(
         'verify_flash',
         help='Verify a binary blob against flash')
     parser_verify_flash.add_argument('addr_filename', help='Address and binary file to verify there, separated by space',
                                      action=AddrFilenamePairAction)
-    parser_verify_flash.add_argument('--diff', '-d', help='Show differences',
-                                     choices=['no', 'yes'], default='no')
+    parser_verify_flash.add_argument('--diff', '-d', help='Show differences. "json" prints the differing ranges and per-sector counts '
+                                     'for every file as one line of JSON',
+                                     choices=['no', 'yes', 'json'], default='no')
     add_spi_flash_subparsers(parser_verify_flash, is_elf2image=False)
 
     parser_erase_flash = subparsers.add_parser(
@@ -2690,10 +3832,27 @@ def main():
     subparsers.add_parser(
         'version', help='Print esptool version')
 
+    parser_serve_session = subparsers.add_parser(
+        'serve_session',
+        help='Stay connected, with the stub loader running and the baud rate changed, and run the commands of other '
+        'esptool.py processes given --session')
+    parser_serve_session.add_argument('--listen', help='Loopback address to accept commands on (default localhost:6123)',
+                                      default='localhost:6123')
+
+    subparsers.add_parser(
+        'close_session',
+        help='End the serve_session given by --session, resetting the chip as its --after says')
+
     # internal sanity check - every operation matches a module function of the same name
     for operation in subparsers.choices.keys():
         assert operation in globals(), "%s should be a module function" % operation
 
+    return parser
+
+
+def main():
+    parser = _build_parser()
+
     expand_file_arguments()
 
     args = parser.parse_args()
@@ -2709,93 +3868,19 @@ def main():
 
     operation_func = globals()[args.operation]
 
-    if PYTHON2:
-        # This function is depreciated in Python3
-        operation_args = inspect.getargspec(operation_func).args
-    else:
-        operation_args = inspect.getfullargspec(operation_func).args
-
-    if operation_args[0] == 'esp':  # operation function takes an ESPLoader connection object
-        if args.before != "no_reset_no_sync":
-            initial_baud = min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
-        else:
-            initial_baud = args.baud
+    if args.session and args.operation == 'close_session':
+        _run_in_session(args.session, {'close': True})
 
-        ser_list = sorted(ports.device for ports in list_ports.comports())
-        if args.port is None:
-            raise FatalError('Cannot find target port named \'%s\'.' % args.port)
+    elif (args.session and args.operation not in _SESSION_EXCLUDED_OPERATIONS
+          and _operation_takes_esp(operation_func)):
+        _run_in_session(args.session, {'argv': sys.argv[1:], 'cwd': os.getcwd()})
 
-        try:
-            if args.chip == 'auto':
-                esp = ESPLoader.detect_chip(args.port, initial_baud, args.before, args.trace)
-            else:
-                chip_class = {
-                    'esp8266': ESP8266ROM,
-                    'esp32': ESP32ROM,
-                }[args.chip]
-                esp = chip_class(args.port, initial_baud, args.trace)
-                esp.connect(args.before)
-        except FatalError as err:
-            if args.port is not None:
-                raise
-            print("%s failed to connect: %s" % (args.port, err))
-            esp = None
-        if esp is None:
-            raise FatalError("All of the %d available serial ports could not connect to a Espressif device." % len(ser_list))
-
-        print("Chip is %s" % (esp.get_chip_description()))
-
-        print("Features: %s" % ", ".join(esp.get_chip_features()))
-
-        read_mac(esp, args)
-
-        if not args.no_stub:
-            esp = esp.run_stub()
-
-        if args.override_vddsdio:
-            esp.override_vddsdio(args.override_vddsdio)
-
-        if args.baud > initial_baud:
-            try:
-                esp.change_baud(args.baud)
-            except NotImplementedInROMError:
-                print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
-
-        # override common SPI flash parameter stuff if configured to do so
-        if hasattr(args, "spi_connection") and args.spi_connection is not None:
-            if esp.CHIP_NAME != "ESP32":
-                raise FatalError("Chip %s does not support --spi-connection option." % esp.CHIP_NAME)
-            print("Configuring SPI flash mode...")
-            esp.flash_spi_attach(args.spi_connection)
-        elif args.no_stub:
-            print("Enabling default SPI flash mode...")
-            # ROM loader doesn't enable flash unless we explicitly do it
-            esp.flash_spi_attach(0)
-
-        if hasattr(args, "flash_size"):
-            print("Configuring flash size...")
-            detect_flash_size(esp, args)
-            esp.flash_set_parameters(flash_size_bytes(args.flash_size))
+    elif _operation_takes_esp(operation_func):  # operation function takes an ESPLoader connection object
+        esp = _open_esp(args)
 
         operation_func(esp, args)
 
-        # Handle post-operation behaviour (reset or other)
-        if operation_func == load_ram:
-            # the ESP is now running the loaded image, so let it run
-            print('Exiting immediately.')
-        elif args.after == 'hard_reset':
-            print('Hard resetting via RTS pin...')
-            esp.hard_reset()
-        elif args.after == 'soft_reset':
-            print('Soft resetting...')
-            # flash_finish will trigger a soft reset
-            esp.soft_reset(False)
-        else:
-            print('Staying in bootloader.')
-            if esp.IS_STUB:
-                esp.soft_reset(True)  # exit stub back to ROM loader
-
-        esp._port.close()
+        _after_operation(esp, args, operation_func)
 
     else:
         operation_func(args)
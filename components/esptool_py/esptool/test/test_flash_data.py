@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+"""
+Tests for flash data transfer: writing flash blocks, streaming compression,
+incremental writes (--incremental), writing several devices at once
+(write_flash_multi), verify_flash --diff and read_flash (--previous, and
+resuming an interrupted read) and flash sessions (FlashSession, serve_session
+and --session). Does not require an ESP8266, runs against an emulated stub
+loader on the other end of a pty.
+"""
+from __future__ import division, print_function
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import os.path
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+try:
+    ESPTOOL_PY = os.environ["ESPTOOL_PY"]
+except KeyError:
+    ESPTOOL_PY = os.path.join(TEST_DIR, "..", "esptool.py")
+
+# import the version of esptool we are testing with
+sys.path.append(os.path.dirname(ESPTOOL_PY))
+import esptool
+
+if not hasattr(unittest.TestCase, "assertRaisesRegex"):  # Python 2
+    unittest.TestCase.assertRaisesRegex = unittest.TestCase.assertRaisesRegexp
+
+
+class EmulatedStubLoader(threading.Thread):
+    """ Minimal ESP8266 stub loader emulation, writing into a bytearray 'flash'.
+
+    Like the real stub (see flasher_stub/stub_flasher.c), commands are received by
+    another thread (the UART interrupt) into two buffers used in turn, and flash data
+    commands are acknowledged before they are written, which takes 'write_time'
+    seconds. A command received before the previous one was picked up, or into the
+    buffer of the block being written, is lost (or corrupts that block) and is counted
+    in 'overruns', so a host which doesn't wait for each response loses data.
+
+    'fail_seqs' is a set of sequence numbers whose flash write fails once each. As
+    with the real stub, the failure is only reported in the response to the next
+    flash data command, or to flash end.
+    """
+    FLASH_SIZE = 0x100000
+
+    ESP_FAILED_SPI_OP = 0xC4
+    ESP_INFLATE_ERROR = 0xC7
+
+    def __init__(self, fd, fail_seqs=(), regs=None, bad_read_digests=(), write_time=0.002):
+        super(EmulatedStubLoader, self).__init__()
+        self.daemon = True
+        self.fd = fd
+        self.fail_seqs = set(fail_seqs)
+        self.bad_read_digests = set(bad_read_digests)  # indexes of read flash commands to corrupt
+        self.regs = regs or {}
+        self.write_time = write_time
+        self.flash = bytearray(b'\xff' * self.FLASH_SIZE)
+        self.overruns = 0
+        self.written = []  # (offset, size) of each flash_begin
+        self.md5_requests = []  # (offset, size) of each MD5 command
+        self.reads = []  # (offset, size) of each read flash command
+        self._received = threading.Condition()
+        self._command = None  # (buffer, packet) received but not picked up yet
+        self._receiving_buf = 0
+        self._processing_buf = None
+        self._corrupted = False
+        self._closed = False
+        self._flash_error = 0
+
+    def packets(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while buf.count(b'\xc0') >= 2:
+                start = buf.index(b'\xc0')
+                end = buf.index(b'\xc0', start + 1)
+                frame, buf = buf[start + 1:end], buf[end + 1:]
+                if frame:
+                    yield frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+
+    def send(self, pkt):
+        os.write(self.fd, b'\xc0' + pkt.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0')
+
+    def respond(self, op, status=0, value=b'', val=0):
+        body = value + struct.pack('<BB', 1 if status else 0, status)
+        self.send(struct.pack('<BBHI', 1, op, len(body), val) + body)
+
+    def receive(self):
+        for pkt in self.packets():
+            if len(pkt) < 8:
+                continue  # host acknowledging read flash data
+            with self._received:
+                if self._command is not None:
+                    self.overruns += 1  # never picked up
+                if self._receiving_buf == self._processing_buf:
+                    self.overruns += 1
+                    self._corrupted = True
+                self._command = (self._receiving_buf, pkt)
+                self._receiving_buf ^= 1
+                self._received.notify()
+        with self._received:
+            self._closed = True
+            self._received.notify()
+
+    def run(self):
+        receiver = threading.Thread(target=self.receive)
+        receiver.daemon = True
+        receiver.start()
+        while True:
+            with self._received:
+                while self._command is None and not self._closed:
+                    self._received.wait()
+                if self._command is None:
+                    return
+                self._processing_buf, pkt = self._command
+                self._command = None
+                self._corrupted = False
+            _, op, _, _ = struct.unpack('<BBHI', pkt[:8])
+            self.command(op, pkt[8:])
+            with self._received:
+                self._processing_buf = None
+
+    def write_block(self, op, seq, block):
+        time.sleep(self.write_time)
+        with self._received:
+            if self._corrupted:
+                block = b'\x00' * len(block)
+        if op == esptool.ESPLoader.ESP_FLASH_DEFL_DATA:
+            try:
+                block = self.inflate.decompress(block)
+            except zlib.error:
+                self._flash_error = self.ESP_INFLATE_ERROR
+                return
+        block = block[:self.remaining]
+        if seq in self.fail_seqs:
+            self.fail_seqs.remove(seq)
+            self._flash_error = self.ESP_FAILED_SPI_OP
+        else:
+            self.flash[self.write_offs:self.write_offs + len(block)] = block
+        self.write_offs += len(block)
+        self.remaining -= len(block)
+
+    def command(self, op, data):
+        if op in (esptool.ESPLoader.ESP_FLASH_BEGIN, esptool.ESPLoader.ESP_FLASH_DEFL_BEGIN):
+            self.remaining, _, _, self.write_offs = struct.unpack('<IIII', data[:16])
+            if self.remaining:
+                self.written.append((self.write_offs, self.remaining))
+            self.inflate = zlib.decompressobj() if op == esptool.ESPLoader.ESP_FLASH_DEFL_BEGIN else None
+            self._flash_error = 0
+            self.respond(op)
+        elif op in (esptool.ESPLoader.ESP_FLASH_DATA, esptool.ESPLoader.ESP_FLASH_DEFL_DATA):
+            size, seq, _, _ = struct.unpack('<IIII', data[:16])
+            self.respond(op, self._flash_error)  # before writing the block, like the real stub
+            self.write_block(op, seq, data[16:16 + size])
+        elif op in (esptool.ESPLoader.ESP_FLASH_END, esptool.ESPLoader.ESP_FLASH_DEFL_END):
+            self.respond(op, self._flash_error)
+        elif op == esptool.ESPLoader.ESP_ERASE_REGION:
+            addr, size = struct.unpack('<II', data[:8])
+            self.flash[addr:addr + size] = b'\xff' * size
+            self.respond(op)
+        elif op == esptool.ESPLoader.ESP_SYNC:
+            for _ in range(8):  # the ROM loader sends several responses to a sync
+                self.respond(op)
+        elif op == esptool.ESPLoader.ESP_READ_REG:
+            self.respond(op, val=self.regs.get(struct.unpack('<I', data[:4])[0], 0))
+        elif op == esptool.ESPLoader.ESP_MEM_END:
+            self.respond(op)
+            self.send(b'OHAI')  # stub loader is running
+        elif op == esptool.ESPLoader.ESP_SPI_FLASH_MD5:
+            addr, size, _, _ = struct.unpack('<IIII', data[:16])
+            self.md5_requests.append((addr, size))
+            self.respond(op, value=hashlib.md5(memoryview(self.flash)[addr:addr + size]).digest())
+        elif op == esptool.ESPLoader.ESP_READ_FLASH:
+            addr, size, block_size, _ = struct.unpack('<IIII', data[:16])
+            self.reads.append((addr, size))
+            self.respond(op)
+            md5 = hashlib.md5()
+            for offs in range(addr, addr + size, block_size):
+                block = bytes(self.flash[offs:min(offs + block_size, addr + size)])
+                md5.update(block)
+                self.send(block)
+            if len(self.reads) - 1 in self.bad_read_digests:
+                md5.update(b'\x00')
+            self.send(md5.digest())
+        else:
+            self.respond(op)
+
+
+class EmulatedLoaderTestCase(unittest.TestCase):
+
+    def check_overruns(self, loader):
+        self.assertEqual(0, loader.overruns, "commands were sent faster than the stub loader can receive them")
+
+    def start_loader(self, stub=True, **kwargs):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        loader = EmulatedStubLoader(master, **kwargs)
+        self.addCleanup(self.check_overruns, loader)
+        loader.start()
+        rom = esptool.ESP8266ROM(os.ttyname(slave))
+        os.close(slave)
+        self.addCleanup(rom._port.close)
+        return loader, esptool.ESP8266StubLoader(rom) if stub else rom
+
+    def start_device(self, mac, **kwargs):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+        loader = EmulatedStubLoader(master, regs={esptool.ESP8266ROM.ESP_OTP_MAC0: mac << 24}, **kwargs)
+        self.addCleanup(self.check_overruns, loader)
+        loader.start()
+        return loader, os.ttyname(slave)
+
+    def image_file(self, image):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        return path
+
+    def image(self, size, seed=0):
+        rand = random.Random(seed)
+        return bytes(bytearray(rand.randint(0, 255) for _ in range(size)))
+
+    def write_flash(self, esp, address, image, **kwargs):
+        argfile = io.BytesIO(image)
+        argfile.name = "image.bin"
+        args = argparse.Namespace(addr_filename=[(address, argfile)], flash_size='1MB',
+                                  compress=None, compress_level=9, no_compress=False, no_stub=False, verify=False,
+                                  incremental=False, incremental_region_size=0x10000, incremental_cache='')
+        for k, v in kwargs.items():
+            setattr(args, k, v)
+        esptool.write_flash(esp, args)
+
+
+class FlashDataTests(EmulatedLoaderTestCase):
+
+    def test_write_flash(self):
+        for compress in [True, False]:
+            loader, esp = self.start_loader()
+            image = self.image(100000, seed=compress)
+            self.write_flash(esp, 0x20000, image, compress=compress, no_compress=not compress)
+            self.assertEqual(image, bytes(loader.flash[0x20000:0x20000 + len(image)]))
+            self.assertEqual(0, loader.overruns)
+
+    def test_compressed_size_printed(self):
+        loader, esp = self.start_loader()
+        output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            self.write_flash(esp, 0x20000, self.image(100000), compress=True)
+        finally:
+            sys.stdout = stdout
+        compressed = re.search(r"Compressed 100000 bytes to (\d+)\.\.\.", output.getvalue()).group(1)
+        self.assertIn("Wrote 100000 bytes (%s compressed)" % compressed, output.getvalue())
+
+    def test_failure_reported_on_next_block(self):
+        loader, esp = self.start_loader(fail_seqs=[1])
+        with self.assertRaisesRegex(esptool.FatalError, "after seq 2"):
+            self.write_flash(esp, 0x20000, self.image(100000), compress=False, no_compress=True)
+
+    def test_overrun(self):
+        # sanity check of the emulator: the stub only has room for one more block
+        # while writing one, so blocks sent without waiting for the responses are lost
+        loader, esp = self.start_loader(write_time=0.05)
+        image = self.image(esp.FLASH_WRITE_SIZE * 4)
+        esp.flash_begin(len(image), 0x10000)
+        for seq in range(4):
+            block = image[seq * esp.FLASH_WRITE_SIZE:(seq + 1) * esp.FLASH_WRITE_SIZE]
+            esp.command(esp.ESP_FLASH_DATA, struct.pack('<IIII', len(block), seq, 0, 0) + block,
+                        esp.checksum(block), wait_response=False)
+        time.sleep(0.5)
+        self.assertGreater(loader.overruns, 0)
+        self.assertNotEqual(image, bytes(loader.flash[0x10000:0x10000 + len(image)]))
+        loader.overruns = 0
+
+
+class LazyImageFile(object):
+    """ Read-only file of 'size' bytes of a repeating pattern, generated as it is read """
+    def __init__(self, size, pattern=b'\x00\x11\x22\x33\xff\xff\xff\xff'):
+        self.name = "lazy.bin"
+        self._size = size
+        self._pattern = pattern
+        self._offs = 0
+
+    def seek(self, offs, whence=0):
+        self._offs = {0: offs, 1: self._offs + offs, 2: self._size + offs}[whence]
+
+    def tell(self):
+        return self._offs
+
+    def read(self, size):
+        size = min(size, self._size - self._offs)
+        start = self._offs % len(self._pattern)
+        data = (self._pattern * ((start + size) // len(self._pattern) + 1))[start:start + size]
+        self._offs += size
+        return data
+
+
+class StreamingWriteTests(EmulatedLoaderTestCase):
+
+    def test_split_blocks(self):
+        chunks = [b'a' * 5, b'', b'b' * 9, b'c']
+        self.assertEqual([b'aaaa', b'abbb', b'bbbb', b'bbc'], list(esptool._split_blocks(chunks, 4)))
+
+    def test_flash_blocks(self):
+        loader, esp = self.start_loader()
+        image = self.image(esp.FLASH_WRITE_SIZE * 3 + 10)
+        blocks = list(esptool._flash_blocks(esp, [image[:1000], image[1000:]]))
+        self.assertEqual([esp.FLASH_WRITE_SIZE] * 4, [len(b) for b, _ in blocks])
+        self.assertEqual([esp.FLASH_WRITE_SIZE] * 3 + [10], [size for _, size in blocks])
+        self.assertEqual(image + b'\xff' * (esp.FLASH_WRITE_SIZE - 10), b''.join(b for b, _ in blocks))
+        for level in [0, 1, 9]:
+            blocks = list(esptool._flash_blocks(esp, [image[:1000], image[1000:]], level))
+            self.assertEqual(image, zlib.decompress(b''.join(b for b, _ in blocks)))
+            self.assertEqual(len(image), sum(size for _, size in blocks))
+            self.assertLessEqual(sum(len(b) for b, _ in blocks), esptool._deflate_bound(len(image)))
+
+    def test_write_flash_compress_levels(self):
+        for level in [0, 1, 6, 9]:
+            loader, esp = self.start_loader()
+            image = self.image(50001, seed=level) + b'\xff' * 300000
+            self.write_flash(esp, 0x10000, image, compress=True, compress_level=level)
+            self.assertEqual(image + b'\xff' * 3, bytes(loader.flash[0x10000:0x10000 + len(image) + 3]))
+
+    def test_write_flash_bootloader_params(self):
+        loader, esp = self.start_loader()
+        image = b'\xe9\x03\x00\x00' + self.image(4000)
+        self.write_flash(esp, 0, image, compress=True, flash_mode='dio', flash_freq='40m', flash_size='1MB')
+        self.assertEqual(b'\xe9\x03\x02\x20' + image[4:], bytes(loader.flash[:len(image)]))
+
+    def test_memory_use(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            self.skipTest("needs tracemalloc")
+        loader, esp = self.start_loader()
+        size = 16 * 1024 * 1024
+        tracemalloc.start()
+        try:
+            blocks = esptool._flash_blocks(esp, esptool._read_image_chunks(LazyImageFile(size), b'', hashlib.md5()), 9)
+            self.assertEqual(size, sum(size for _, size in blocks))
+            self.assertLess(tracemalloc.get_traced_memory()[1], 2 * 1024 * 1024)
+        finally:
+            tracemalloc.stop()
+
+
+class IncrementalWriteTests(EmulatedLoaderTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def write_incremental(self, loader, esp, image, **kwargs):
+        loader.written = []
+        loader.md5_requests = []
+        self.write_flash(esp, 0x10000, image, incremental=True, incremental_region_size=0x4000, **kwargs)
+        self.assertEqual(image, bytes(loader.flash[0x10000:0x10000 + len(image)]))
+
+    def test_only_changed_regions(self):
+        loader, esp = self.start_loader()
+        image = bytearray(self.image(0x4000 * 6 + 100))
+        self.write_incremental(loader, esp, bytes(image))
+        self.assertEqual([(0x10000, 0x4000 * 6 + 100)], loader.written)
+        # change regions 1, 2 and 5
+        image[0x4000 + 10] ^= 1
+        image[0x8000 + 10] ^= 1
+        image[0x14000] ^= 1
+        self.write_incremental(loader, esp, bytes(image))
+        self.assertEqual([(0x14000, 0x8000), (0x24000, 0x4000)], loader.written)
+        self.assertEqual(7 + 1, len(loader.md5_requests))  # each region, then the whole image
+        self.write_incremental(loader, esp, bytes(image), compress=False, no_compress=True)
+        self.assertEqual([], loader.written)
+
+    def test_cache(self):
+        loader, esp = self.start_loader()
+        image = bytearray(self.image(0x4000 * 4))
+        self.write_incremental(loader, esp, bytes(image), incremental_cache=self.cache_dir)
+        self.assertEqual(["18fe34000000.json"], os.listdir(self.cache_dir))
+        image[0x4000] ^= 1
+        self.write_incremental(loader, esp, bytes(image), incremental_cache=self.cache_dir)
+        self.assertEqual([(0x14000, 0x4000)], loader.written)
+        # only the changed region is hashed on the device, then the whole image is verified
+        self.assertEqual([(0x14000, 0x4000), (0x10000, 0x4000 * 4)], loader.md5_requests)
+
+    def test_stale_cache(self):
+        loader, esp = self.start_loader()
+        image = self.image(0x4000 * 4)
+        self.write_incremental(loader, esp, image, incremental_cache=self.cache_dir)
+        loader.flash[0x18000] ^= 1  # written by something else
+        self.write_incremental(loader, esp, image, incremental_cache=self.cache_dir)
+        self.assertEqual([(0x18000, 0x4000)], loader.written)
+
+    def test_unaligned_address(self):
+        loader, esp = self.start_loader()
+        image = self.image(0x4000 * 2)
+        self.write_flash(esp, 0x10800, image, incremental=True, incremental_region_size=0x4000)
+        self.write_flash(esp, 0x10800, image, incremental=True, incremental_region_size=0x4000)
+        self.assertEqual([(0x10800, 0x8000)] * 2, loader.written)
+
+    def test_bad_region_size(self):
+        loader, esp = self.start_loader()
+        with self.assertRaisesRegex(esptool.FatalError, "multiple of the flash sector size"):
+            self.write_flash(esp, 0x10000, self.image(100), incremental=True, incremental_region_size=0x1800)
+
+    def test_read_image_chunks(self):
+        image = self.image(10001)
+        header = b'\xe9\x03\x02\x20' + image[4:8]
+        expected = header + image[8:] + b'\xff' * 3
+        for offs, size in [(0, None), (0, 4), (4, 4096), (4096, 10004 - 4096), (9000, None)]:
+            md5 = hashlib.md5()
+            data = b''.join(esptool._read_image_chunks(io.BytesIO(image), header, md5, offs, size, chunk_size=1000))
+            self.assertEqual(expected[offs:None if size is None else offs + size], data)
+            self.assertEqual(hashlib.md5(data).hexdigest(), md5.hexdigest())
+
+
+class MultiDeviceTests(EmulatedLoaderTestCase):
+
+    def run_esptool(self, args):
+        saved_argv = sys.argv
+        sys.argv = ["esptool.py", "--chip", "esp8266", "--before", "no_reset", "--after", "no_reset"] + args
+        try:
+            esptool.main()
+        finally:
+            sys.argv = saved_argv
+
+    def test_write_flash_multi(self):
+        loaders, ports = zip(*[self.start_device(i) for i in range(3)])
+        images = [self.image(50000, seed=1), self.image(20000, seed=2)]
+        self.run_esptool(["write_flash_multi", "--ports", ",".join(ports), "--flash_size", "1MB",
+                          "0x10000", self.image_file(images[0]), "0x40000", self.image_file(images[1])])
+        for loader in loaders:
+            self.assertEqual(images[0], bytes(loader.flash[0x10000:0x10000 + len(images[0])]))
+            self.assertEqual(images[1], bytes(loader.flash[0x40000:0x40000 + len(images[1])]))
+
+    def test_prepared_once(self):
+        loaders, ports = zip(*[self.start_device(i) for i in range(2)])
+        calls = []
+        flash_blocks = esptool._flash_blocks
+
+        def counting_flash_blocks(*args):
+            calls.append(args)
+            return flash_blocks(*args)
+        esptool._flash_blocks = counting_flash_blocks
+        try:
+            self.run_esptool(["write_flash_multi", "--ports", ",".join(ports), "--flash_size", "1MB",
+                              "0x10000", self.image_file(self.image(30000))])
+        finally:
+            esptool._flash_blocks = flash_blocks
+        self.assertEqual(1, len(calls))
+
+    def test_failures_are_isolated(self):
+        good, good_port = self.start_device(1)
+        bad, bad_port = self.start_device(2, fail_seqs=[0])
+        image = self.image(50000)
+        with self.assertRaisesRegex(esptool.FatalError, "2 of 3 devices failed"):
+            self.run_esptool(["write_flash_multi", "--ports", ",".join([bad_port, "/dev/nonexistent-port", good_port]),
+                              "--flash_size", "1MB", "0x10000", self.image_file(image)])
+        self.assertEqual(image, bytes(good.flash[0x10000:0x10000 + len(image)]))
+        self.assertNotEqual(image, bytes(bad.flash[0x10000:0x10000 + len(image)]))
+
+
+class VerifyDiffTests(EmulatedLoaderTestCase):
+
+    def test_diff_ranges(self):
+        image = self.image(0x3000)
+        flash = bytearray(image)
+        for offs in [5, 6, 7, 0xfff, 0x1000, 0x2ffe]:
+            flash[offs] ^= 0xff
+        flash = bytes(flash)
+        ranges = esptool._diff_ranges(flash, image)
+        self.assertEqual([(5, 3), (0xfff, 2), (0x2ffe, 1)], ranges)
+        self.assertEqual([(0x10000, 4), (0x11000, 1), (0x12000, 1)],
+                         list(esptool._diff_sector_counts(0x10000, ranges).items()))
+        self.assertEqual([], esptool._diff_ranges(image, image))
+
+    def verify_flash(self, esp, address, image, diff):
+        argfile = io.BytesIO(image)
+        argfile.name = "image.bin"
+        args = argparse.Namespace(addr_filename=[(address, argfile)], flash_size='keep', flash_mode='keep',
+                                  flash_freq='keep', diff=diff)
+        output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            with self.assertRaisesRegex(esptool.FatalError, "Verify failed"):
+                esptool.verify_flash(esp, args)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue()
+
+    def test_verify_diff(self):
+        loader, esp = self.start_loader()
+        image = self.image(0x4000)
+        loader.flash[0x20000:0x24000] = image
+        loader.flash[0x21010:0x21012] = b'\x00\x00'
+        loader.flash[0x23000:0x24000] = bytearray(b ^ 0xff for b in bytearray(image[0x3000:]))
+        output = self.verify_flash(esp, 0x20000, image, 'yes')
+        self.assertIn("0x00021010-0x00021011  (2 bytes) 0000 / %s" % esptool.hexify(image[0x1010:0x1012], False), output)
+        self.assertIn("0x00023000-0x00023fff  (4096 bytes)\n", output)
+        self.assertIn("   0x00021000     2\n", output)
+
+        report = json.loads(self.verify_flash(esp, 0x20000, image, 'json').splitlines()[-1])
+        self.assertEqual(1, len(report))
+        self.assertEqual(False, report[0]["match"])
+        self.assertEqual([[0x21010, 2], [0x23000, 0x1000]], report[0]["ranges"])
+        self.assertEqual([[0x21000, 2], [0x23000, 0x1000]], report[0]["sectors"])
+        self.assertEqual(0x1002, report[0]["differences"])
+
+    def test_full_flash_diff_speed(self):
+        image = self.image(0x10000) * 64  # 4MB
+        flash = bytearray(image)
+        for offs in range(0, len(flash), 0x10000):
+            flash[offs:offs + 0x1000] = bytearray(b ^ 0xff for b in flash[offs:offs + 0x1000])  # one sector in every 16
+        t = time.time()
+        ranges = esptool._diff_ranges(bytes(flash), image)
+        self.assertEqual(64, len(ranges))
+        self.assertLess(time.time() - t, 10)
+
+
+class ReadFlashTests(EmulatedLoaderTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def read_flash(self, esp, address, size, read_back=True, **kwargs):
+        args = argparse.Namespace(address=address, size=size, filename=os.path.join(self.tempdir, "dump.bin"),
+                                  no_progress=True, previous=None, region_size=0x10000, checkpoint_size=0x40000)
+        for k, v in kwargs.items():
+            setattr(args, k, v)
+        esptool.read_flash(esp, args)
+        if read_back:
+            with open(args.filename, 'rb') as f:
+                return f.read()
+
+    def test_read_flash(self):
+        loader, esp = self.start_loader()
+        image = self.image(0x5000)
+        loader.flash[0x1000:0x6000] = image
+        self.assertEqual(image, self.read_flash(esp, 0x1000, len(image)))
+
+    def test_no_stub(self):
+        loader, esp = self.start_loader(stub=False)
+        with self.assertRaises(esptool.NotImplementedInROMError):
+            self.read_flash(esp, 0x1000, 0x1000, read_back=False)
+        self.assertEqual([], loader.reads)
+
+    def test_previous(self):
+        loader, esp = self.start_loader()
+        image = self.image(0x50000)
+        loader.flash[0x10000:0x60000] = image
+        previous = os.path.join(self.tempdir, "previous.bin")
+        with open(previous, 'wb') as f:
+            f.write(image)
+        loader.flash[0x31000:0x31004] = b'\x00\x01\x02\x03'
+        loader.flash[0x5f000:0x60000] = b'\x55' * 0x1000
+        loader.md5_requests = []
+        dump = self.read_flash(esp, 0x10000, len(image), previous=previous)
+        self.assertEqual(bytes(loader.flash[0x10000:0x60000]), dump)
+        self.assertEqual([(0x10000 + offs, 0x10000) for offs in range(0, len(image), 0x10000)] + [(0x10000, len(image))],
+                         loader.md5_requests)
+        self.assertEqual([(0x30000, 0x10000), (0x50000, 0x10000)], loader.reads)
+
+    def test_previous_short(self):
+        # a shorter previous dump only saves reading the regions it covers
+        loader, esp = self.start_loader()
+        image = self.image(0x30000)
+        loader.flash[0:0x30000] = image
+        previous = os.path.join(self.tempdir, "previous.bin")
+        with open(previous, 'wb') as f:
+            f.write(image[:0x18000])
+        self.assertEqual(image, self.read_flash(esp, 0, len(image), previous=previous))
+        self.assertEqual([(0x10000, 0x20000)], loader.reads)
+
+    def test_bad_region_size(self):
+        loader, esp = self.start_loader()
+        with self.assertRaisesRegex(esptool.FatalError, "multiple of the flash sector size"):
+            self.read_flash(esp, 0, 0x1000, previous=os.devnull, region_size=0x800)
+
+    def test_resume(self):
+        loader, esp = self.start_loader(bad_read_digests=[2])
+        image = self.image(0x50000)
+        loader.flash[0x10000:0x60000] = image
+        with self.assertRaisesRegex(esptool.FatalError, "Digest mismatch"):
+            self.read_flash(esp, 0x10000, len(image), checkpoint_size=0x18000)
+        checkpoint = os.path.join(self.tempdir, "dump.bin.checkpoint")
+        with open(checkpoint) as f:
+            self.assertEqual({'address': 0x10000, 'size': len(image), 'offset': 0x30000}, json.load(f))
+        # a different region starts again
+        self.assertEqual(image[:0x1000], self.read_flash(esp, 0x10000, 0x1000))
+        self.assertFalse(os.path.exists(checkpoint))
+
+        loader.reads = []
+        loader.bad_read_digests = set([1])
+        with self.assertRaises(esptool.FatalError):
+            self.read_flash(esp, 0x10000, len(image), checkpoint_size=0x18000)
+        self.assertEqual(image, self.read_flash(esp, 0x10000, len(image), checkpoint_size=0x18000))
+        self.assertEqual([(0x10000, 0x18000), (0x28000, 0x18000), (0x28000, 0x18000), (0x40000, 0x18000), (0x58000, 0x8000)],
+                         loader.reads)
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_changed_during_read(self):
+        loader, esp = self.start_loader()
+        dump = os.path.join(self.tempdir, "dump.bin")
+        with open(dump + ".checkpoint", 'w') as f:
+            json.dump({'address': 0, 'size': 0x2000, 'offset': 0x2000}, f)
+        with open(dump, 'wb') as f:
+            f.write(b'\x00' * 0x2000)  # not what's in flash
+        with self.assertRaisesRegex(esptool.FatalError, "Flash changed"):
+            self.read_flash(esp, 0, 0x2000)
+        self.assertFalse(os.path.exists(dump + ".checkpoint"))
+        self.assertEqual(b'\xff' * 0x2000, self.read_flash(esp, 0, 0x2000))
+
+    def test_bounded_memory(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            self.skipTest("needs tracemalloc")
+        loader, esp = self.start_loader()
+        tracemalloc.start()
+        try:
+            self.read_flash(esp, 0, loader.FLASH_SIZE, read_back=False)
+            self.assertLess(tracemalloc.get_traced_memory()[1], loader.FLASH_SIZE // 4)
+        finally:
+            tracemalloc.stop()
+
+
+class SessionTests(EmulatedLoaderTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_flash_session(self):
+        loader, port = self.start_device(1)
+        image = self.image(30000)
+        run_stub = esptool.ESPLoader.run_stub
+        stubs = []
+
+        def counting_run_stub(*args):
+            stubs.append(args)
+            return run_stub(*args)
+        esptool.ESPLoader.run_stub = counting_run_stub
+        try:
+            with esptool.FlashSession.connect(["--chip", "esp8266", "--port", port, "--before", "no_reset",
+                                               "--after", "no_reset"]) as session:
+                session.run(["write_flash", "--flash_size", "1MB", "0x10000", self.image_file(image)])
+                session.run(["--port", "/dev/ignored", "read_flash", "0x10000", str(len(image)),
+                             os.path.join(self.tempdir, "dump.bin")])
+                session.run(["erase_region", "0x10000", "0x1000"])
+                with self.assertRaisesRegex(esptool.FatalError, "can't run in a session"):
+                    session.run(["run"])
+        finally:
+            esptool.ESPLoader.run_stub = run_stub
+        self.assertEqual(1, len(stubs))
+        with open(os.path.join(self.tempdir, "dump.bin"), "rb") as f:
+            self.assertEqual(image, f.read())
+        with self.assertRaisesRegex(esptool.FatalError, "closed"):
+            session.run(["erase_region", "0x10000", "0x1000"])
+
+    def test_serve_session(self):
+        loader, port = self.start_device(1)
+        s = socket.socket()
+        s.bind(("localhost", 0))
+        address = "localhost:%d" % s.getsockname()[1]
+        s.close()
+        esptool_py = [sys.executable, ESPTOOL_PY, "--chip", "esp8266", "--before", "no_reset", "--after", "no_reset"]
+        server = subprocess.Popen(esptool_py + ["--port", port, "serve_session", "--listen", address],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.addCleanup(server.stdout.close)
+        try:
+            output = b""
+            while b"Serving session" not in output:
+                line = server.stdout.readline()
+                self.assertTrue(line, output)
+                output += line
+            session = re.search(br"ESPTOOL_SESSION=([0-9a-f]+@[^ ]+)", output).group(1).decode()
+            self.assertTrue(session.endswith("@127.0.0.1:%s" % address.split(":")[1]), session)
+            # requests without the session's token are refused
+            for bad_session, error in [(address, b"is not a session like TOKEN@"),
+                                       ("0" * 32 + "@" + address, b"Invalid session token")]:
+                refused = subprocess.Popen(esptool_py + ["--session", bad_session, "read_flash", "0", "16", "refused.bin"],
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.tempdir)
+                self.assertIn(error, refused.communicate()[0])
+                self.assertEqual(2, refused.returncode)
+                self.assertFalse(os.path.exists(os.path.join(self.tempdir, "refused.bin")))
+            image = self.image(20000)
+            env = dict(os.environ, ESPTOOL_SESSION=session)
+            client = subprocess.check_output(esptool_py + ["write_flash", "--flash_size", "1MB", "0x20000",
+                                                           self.image_file(image)], env=env)
+            self.assertIn(b"Hash of data verified", client)
+            self.assertEqual(image, bytes(loader.flash[0x20000:0x20000 + len(image)]))
+            client = subprocess.check_output(esptool_py + ["read_flash", "0x20000", str(len(image)), "dump.bin"],
+                                             env=env, cwd=self.tempdir)
+            self.assertIn(b"Read %d bytes" % len(image), client)
+            with open(os.path.join(self.tempdir, "dump.bin"), "rb") as f:
+                self.assertEqual(image, f.read())
+            failed = subprocess.Popen(esptool_py + ["erase_region", "0x10001", "0x1000"], env=env,
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.assertIn(b"Session at 127.0.0.1", failed.communicate()[0])
+            self.assertEqual(2, failed.returncode)
+            subprocess.check_output(esptool_py + ["--session", session, "close_session"])
+            server.wait()
+            self.assertEqual(0, server.returncode)
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+
+    def test_listen_loopback_only(self):
+        self.assertTrue(esptool._is_loopback("localhost"))
+        self.assertTrue(esptool._is_loopback("127.0.0.1"))
+        self.assertFalse(esptool._is_loopback("0.0.0.0"))
+        self.assertFalse(esptool._is_loopback("192.0.2.1"))
+        args = esptool._build_parser().parse_args(["serve_session", "--listen", "0.0.0.0:6123"])
+        with self.assertRaisesRegex(esptool.FatalError, "loopback"):
+            esptool.serve_session(None, args)
+
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import copy
 import os
 import os.path
 import subprocess
@@ -254,6 +255,78 @@ class ESP32FlashHeaderTests(BaseTestCase):
         finally:
             try_delete(BIN)
 
+class ELFFileTests(BaseTestCase):
+    """ esptool's own ELF reader, compared with elftools """
+    ELFS = ["esp32-app-template.elf", "esp8266-nonossdkv20-at-v2.elf", "esp8266-openrtos-blink-v2.elf"]
+
+    def test_sections(self):
+        for elf in self.ELFS:
+            e = esptool.ELFFile(elf)
+            with open(elf, "rb") as f:
+                ref = ELFFile(f)
+                for section in e.sections:
+                    ref_section = ref.get_section_by_name(section.name)
+                    self.assertEqual(ref_section.header.sh_addr, section.addr)
+                    self.assertEqual(ref_section.data(), section.view.tobytes())
+                    self.assertTrue(segment_matches_section(section, ref_section))
+                    self.assertEqual(0, len(section.data) % 4)
+
+    def test_close(self):
+        for elf in self.ELFS:
+            with esptool.ELFFile(elf) as e:
+                contents = [esptool.pad_to(section.view.tobytes(), 4, b'\x00') for section in e.sections]
+            # the sections are still there after closing, whether their data was used or not
+            self.assertEqual(contents, [section.data for section in e.sections])
+            e.close()
+
+    def test_lookup_symbol(self):
+        for elf in self.ELFS:
+            e = esptool.ELFFile(elf)
+            with open(elf, "rb") as f:
+                symtab = ELFFile(f).get_section_by_name(".symtab")
+                symbols = [s for s in symtab.iter_symbols()
+                           if s["st_info"]["type"] == "STT_FUNC" and s["st_size"] > 0 and s["st_shndx"] != "SHN_UNDEF"]
+                self.assertTrue(len(symbols) > 10)
+                names = {}  # several symbols can share an address (ie C1/C2 constructors)
+                for s in symbols:
+                    names.setdefault((s["st_value"], s["st_size"]), set()).add(s.name)
+                for s in symbols[::max(1, len(symbols) // 200)]:
+                    for addr in [s["st_value"], s["st_value"] + s["st_size"] - 1]:
+                        name, value, size = e.lookup_symbol(addr)
+                        self.assertTrue(value <= addr < value + size)
+                        if (value, size) == (s["st_value"], s["st_size"]):
+                            self.assertIn(name, names[(value, size)])
+            self.assertIsNone(e.lookup_symbol(0))
+
+    def test_section_headers_and_symbols(self):
+        for elf in self.ELFS:
+            e = esptool.ELFFile(elf)
+            with open(elf, "rb") as f:
+                ref = ELFFile(f)
+                self.assertEqual(ref.num_sections(), len(e.section_headers))
+                for header, ref_section in zip(e.section_headers, ref.iter_sections()):
+                    self.assertEqual(ref_section.name, header.name)
+                    self.assertEqual(ref_section.header.sh_flags, header.flags)
+                    self.assertEqual(ref_section.header.sh_addr, header.addr)
+                    self.assertEqual(ref_section.header.sh_size, header.size)
+                ref_symbols = []
+                file_name = None
+                for s in ref.get_section_by_name(".symtab").iter_symbols():
+                    if s["st_info"]["type"] == "STT_FILE":
+                        file_name = s.name
+                    elif s["st_info"]["type"] in ("STT_FUNC", "STT_OBJECT") and s["st_shndx"] != "SHN_UNDEF":
+                        local = s["st_info"]["bind"] == "STB_LOCAL"
+                        ref_symbols.append((s.name, s["st_value"], s["st_size"], file_name if local else None))
+                self.assertTrue(len(ref_symbols) > 10)
+                self.assertEqual(ref_symbols, [(s.name, s.addr, s.size, s.file) for s in e.read_symbols()])
+
+    def test_deepcopy(self):
+        e = esptool.ELFFile(self.ELFS[0])
+        section = e.sections[0]
+        section_copy = copy.deepcopy(section)
+        self.assertEqual(section.data, section_copy.data)
+        self.assertEqual(section.name, section_copy.name)
+
 
 if __name__ == '__main__':
     print("Running image generation tests...")
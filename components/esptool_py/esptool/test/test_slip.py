@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Tests for the esptool.py SLIP decoder. Does not require an ESP8266.
+
+Run with the "--benchmark" argument to also time decoding of a
+synthetic multi-megabyte SLIP stream from a fake serial port.
+"""
+from __future__ import division, print_function
+
+import os
+import os.path
+import random
+import sys
+import time
+import unittest
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+try:
+    ESPTOOL_PY = os.environ["ESPTOOL_PY"]
+except KeyError:
+    ESPTOOL_PY = os.path.join(TEST_DIR, "..", "esptool.py")
+
+# import the version of esptool we are testing with
+sys.path.append(os.path.dirname(ESPTOOL_PY))
+import esptool
+
+if not hasattr(unittest.TestCase, "assertRaisesRegex"):  # Python 2
+    unittest.TestCase.assertRaisesRegex = unittest.TestCase.assertRaisesRegexp
+
+
+def slip_encode(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+class FakeSerialPort(object):
+    """ Minimal stand-in for a pyserial port which hands out 'data' in
+    reads of at most 'chunk_size' bytes, then times out (returns b'') """
+    def __init__(self, data, chunk_size=4096):
+        self._data = data
+        self._offs = 0
+        self._chunk_size = chunk_size
+
+    def inWaiting(self):
+        return min(self._chunk_size, len(self._data) - self._offs)
+
+    def read(self, size=1):
+        result = self._data[self._offs:self._offs + size]
+        self._offs += len(result)
+        return result
+
+
+def no_trace(message, *format_args):
+    pass
+
+
+def random_packets(count, max_len, seed=0):
+    rand = random.Random(seed)
+    # bias the content towards the bytes which need escaping
+    alphabet = bytearray(b'\xc0\xdb\xdc\xdd\x00\x01\xff')
+    return [bytes(bytearray(rand.choice(alphabet) for _ in range(rand.randint(0, max_len))))
+            for _ in range(count)]
+
+
+class SlipReaderTests(unittest.TestCase):
+
+    def decode(self, stream, count, chunk_size=4096):
+        reader = esptool.slip_reader(FakeSerialPort(stream, chunk_size), no_trace)
+        return [next(reader) for _ in range(count)]
+
+    def test_roundtrip(self):
+        packets = random_packets(200, 300)
+        stream = b''.join(slip_encode(p) for p in packets)
+        for chunk_size in [1, 2, 3, 7, 64, len(stream)]:
+            self.assertEqual(packets, self.decode(stream, len(packets), chunk_size))
+
+    def test_escape_split_across_reads(self):
+        stream = slip_encode(b'\xc0\xdb')
+        for split in range(1, len(stream)):
+            self.assertEqual([b'\xc0\xdb'], self.decode(stream, 1, split))
+
+    def test_timeout_header(self):
+        with self.assertRaisesRegex(esptool.FatalError, "Timed out waiting for packet header"):
+            self.decode(b'', 1)
+
+    def test_timeout_content(self):
+        with self.assertRaisesRegex(esptool.FatalError, "Timed out waiting for packet content"):
+            self.decode(b'\xc0\x01\x02', 1)
+
+    def test_invalid_head(self):
+        with self.assertRaisesRegex(esptool.FatalError, r"Invalid head of packet \(0x55\)"):
+            self.decode(b'\x55\xc0\xc0', 1)
+
+    def test_invalid_escape(self):
+        with self.assertRaisesRegex(esptool.FatalError, r"Invalid SLIP escape \(0xdb, 0x01\)"):
+            self.decode(b'\xc0\xdb\xdc\xdb\x01\xc0', 1)
+
+    def test_escape_before_delimiter(self):
+        with self.assertRaisesRegex(esptool.FatalError, r"Invalid SLIP escape \(0xdb, 0xC0\)"):
+            self.decode(b'\xc0\x01\xdb\xc0', 1)
+
+
+def benchmark(total_mb=8, packet_len=0x1000):
+    """ Time decoding of a synthetic read_flash-sized SLIP stream """
+    rand = random.Random(1)
+    packet = bytes(bytearray(rand.randint(0, 255) for _ in range(packet_len)))
+    count = total_mb * 1024 * 1024 // packet_len
+    stream = slip_encode(packet) * count
+    for chunk_size in [256, 4096, 65536]:
+        reader = esptool.slip_reader(FakeSerialPort(stream, chunk_size), no_trace)
+        t = time.time()
+        for _ in range(count):
+            next(reader)
+        t = time.time() - t
+        print("Decoded %d MB in reads of %d bytes: %.3f seconds (%.1f MB/s)"
+              % (total_mb, chunk_size, t, total_mb / t if t > 0 else float('inf')))
+
+
+if __name__ == '__main__':
+    if "--benchmark" in sys.argv:
+        sys.argv.remove("--benchmark")
+        benchmark()
+    unittest.main(buffer=True)
@@ -20,7 +20,6 @@ from __future__ import print_function, division
 import argparse
 import os
 import sys
-import subprocess
 import tempfile
 import re
 import gen_esp32part as gen
@@ -29,7 +28,7 @@ import gen_esp32part as gen
 __version__ = '2.0'
 
 COMPONENTS_PATH = os.path.expandvars(os.path.join("$IDF_PATH", "components"))
-ESPTOOL_PY = os.path.join(COMPONENTS_PATH, "esptool_py", "esptool", "esptool.py")
+ESPTOOL_DIR = os.path.join(COMPONENTS_PATH, "esptool_py", "esptool")
 
 PARTITION_TABLE_OFFSET = 0x8000
 
@@ -66,11 +65,16 @@ PARTITION_BOOT_DEFAULT = _PartitionId()
 
 
 class ParttoolTarget():
+    """ Partitions of a device, or of a partition table file. The device is connected to once, on the first
+    operation which needs it, and every following operation runs in the same esptool.FlashSession. Call close()
+    (or use the target in a 'with' statement) after the last operation, to reset the device as --after says.
+    With ESPTOOL_SESSION set, the operations run in that serve_session instead, which stays connected. """
 
     def __init__(self, port=None, baud=None, partition_table_offset=PARTITION_TABLE_OFFSET, partition_table_file=None,
                  esptool_args=[], esptool_write_args=[], esptool_read_args=[], esptool_erase_args=[]):
         self.port = port
         self.baud = baud
+        self._session = None
 
         gen.offset_part_table = partition_table_offset
 
@@ -108,13 +112,34 @@ class ParttoolTarget():
                 self._call_esptool(["read_flash", str(partition_table_offset), str(gen.MAX_PARTITION_LENGTH), temp_file.name])
                 with open(temp_file.name, "rb") as f:
                     partition_table = gen.PartitionTable.from_binary(f.read())
+            except Exception:
+                self.close()
+                raise
             finally:
                 os.unlink(temp_file.name)
 
         self.partition_table = partition_table
 
     def _call_esptool(self, args, out=None):
-        esptool_args = [sys.executable, ESPTOOL_PY] + self.esptool_args
+        """ Run the esptool command line 'args' in the session with the device, without its output """
+        stdout = sys.stdout
+        with open(os.devnull, "w") as null_file:
+            sys.stdout = null_file
+            try:
+                if self._session is None:
+                    self._session = self._connect()
+                self._session.run(args)
+            finally:
+                sys.stdout = stdout
+
+    def _connect(self):
+        """ FlashSession with the device, or a SessionClient if ESPTOOL_SESSION (or --session in the esptool
+        arguments) gives a running serve_session """
+        if ESPTOOL_DIR not in sys.path:
+            sys.path.insert(0, ESPTOOL_DIR)  # the bundled esptool, rather than any other installed one
+        import esptool
+
+        esptool_args = list(self.esptool_args)
 
         if self.port:
             esptool_args += ["--port", self.port]
@@ -122,10 +147,25 @@ class ParttoolTarget():
         if self.baud:
             esptool_args += ["--baud", str(self.baud)]
 
-        esptool_args += args
+        return esptool.FlashSession.connect(esptool_args)
 
-        with open(os.devnull, "w") as null_file:
-            subprocess.check_call(esptool_args, stdout=null_file, stderr=null_file)
+    def close(self):
+        """ End the session with the device, if there is one """
+        if self._session is not None:
+            stdout = sys.stdout
+            with open(os.devnull, "w") as null_file:
+                sys.stdout = null_file
+                try:
+                    self._session.close()
+                finally:
+                    sys.stdout = stdout
+                    self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get_partition_info(self, partition_id):
         partition = None
@@ -167,6 +207,11 @@ class ParttoolTarget():
 
         self._call_esptool(["write_flash", str(partition.offset), input] + self.esptool_write_args)
 
+    def verify_partition(self, partition_id, input):
+        """ Check the partition starts with the contents of file 'input', raises an exception if not """
+        partition = self.get_partition_info(partition_id)
+        self._call_esptool(["verify_flash", str(partition.offset), input])
+
 
 def _write_partition(target, partition_id, input):
     target.write_partition(partition_id, input)
@@ -324,14 +369,17 @@ def main():
     for op_arg in op_args:
         common_args.update({op_arg:vars(args)[op_arg]})
 
-    if quiet:
-        # If exceptions occur, suppress and exit quietly
-        try:
+    try:
+        if quiet:
+            # If exceptions occur, suppress and exit quietly
+            try:
+                op(**common_args)
+            except Exception:
+                sys.exit(2)
+        else:
             op(**common_args)
-        except Exception:
-            sys.exit(2)
-    else:
-        op(**common_args)
+    finally:
+        target.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Tests for ParttoolTarget and OtatoolTarget against the emulated stub loader of
+esptool's test_flash_data.py, so does not require a device (but does require a
+platform with os.openpty()).
+"""
+from __future__ import print_function, division
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(TEST_DIR, ".."))
+sys.path.append(os.path.join(TEST_DIR, "..", "..", "app_update"))
+sys.path.append(os.path.join(TEST_DIR, "..", "..", "esptool_py", "esptool", "test"))
+from test_flash_data import EmulatedLoaderTestCase, ESPTOOL_PY, esptool
+import gen_esp32part as gen
+from parttool import ParttoolTarget, PartitionName, PARTITION_TABLE_OFFSET
+from otatool import OtatoolTarget
+
+PARTITIONS_CSV = """
+# Name,   Type, SubType, Offset,   Size
+nvs,      data, nvs,     0x9000,   0x4000
+otadata,  data, ota,     0xd000,   0x2000
+phy_init, data, phy,     0xf000,   0x1000
+ota_0,    app,  ota_0,   0x10000,  0x70000
+ota_1,    app,  ota_1,   0x80000,  0x70000
+"""
+
+ESPTOOL_ARGS = ["chip=esp8266", "before=no_reset", "after=no_reset"]
+ESPTOOL_WRITE_ARGS = ["flash_size=1MB"]
+
+
+class ParttoolTestCase(EmulatedLoaderTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.loader, self.port = self.start_device(1)
+        table = gen.PartitionTable.from_csv(PARTITIONS_CSV).to_binary()
+        self.loader.flash[PARTITION_TABLE_OFFSET:PARTITION_TABLE_OFFSET + len(table)] = table
+
+        # count the connections to the device by the stub uploads
+        run_stub = esptool.ESPLoader.run_stub
+        self.stubs = []
+
+        def counting_run_stub(*args):
+            self.stubs.append(args)
+            return run_stub(*args)
+        esptool.ESPLoader.run_stub = counting_run_stub
+        self.addCleanup(setattr, esptool.ESPLoader, "run_stub", run_stub)
+
+    def file(self, name, contents):
+        path = os.path.join(self.tempdir, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        return path
+
+    def read_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def target(self, cls=ParttoolTarget, port=None):
+        return cls(port or self.port, esptool_args=ESPTOOL_ARGS, esptool_write_args=ESPTOOL_WRITE_ARGS)
+
+
+class ParttoolTargetTests(ParttoolTestCase):
+
+    def test_one_connection(self):
+        image = self.image(0x3000)
+        with self.target() as target:
+            target.write_partition(PartitionName("nvs"), self.file("nvs.bin", image))
+            target.verify_partition(PartitionName("nvs"), self.file("nvs.bin", image))
+            target.read_partition(PartitionName("nvs"), os.path.join(self.tempdir, "read.bin"))
+            target.erase_partition(PartitionName("phy_init"))
+        self.assertEqual(1, len(self.stubs))
+        self.assertEqual(image + b"\xff" * 0x1000, self.read_file(os.path.join(self.tempdir, "read.bin")))
+        self.assertEqual(image, bytes(self.loader.flash[0x9000:0x9000 + len(image)]))
+
+    def test_verify_partition(self):
+        image = self.image(0x1000)
+        with self.target() as target:
+            target.write_partition(PartitionName("ota_1"), self.file("app.bin", image))
+            target.verify_partition(PartitionName("ota_1"), self.file("app.bin", image))
+            self.loader.flash[0x80010] ^= 0xff
+            with self.assertRaisesRegex(esptool.FatalError, "Verify failed"):
+                target.verify_partition(PartitionName("ota_1"), self.file("app.bin", image))
+
+
+class OtatoolTargetTests(ParttoolTestCase):
+
+    def otadata(self):
+        return bytes(self.loader.flash[0xd000:0xf000])
+
+    def test_otadata_cache(self):
+        image = self.image(0x2000)
+        with self.target(OtatoolTarget) as target:
+            self.assertEqual(self.otadata(), target.otadata)
+            target.write_ota_partition(1, self.file("app.bin", image))
+            target.switch_ota_partition(1)
+            self.assertEqual(self.otadata(), target.otadata)
+            target.verify_ota_partition(1, self.file("app.bin", image))
+            target.switch_ota_partition(0)
+            self.assertEqual(self.otadata(), target.otadata)
+            switched = target.otadata
+            target.erase_otadata()
+            self.assertEqual(b"\xff" * 0x2000, self.otadata())
+            self.assertEqual(self.otadata(), target.otadata)
+        self.assertEqual(1, len(self.stubs))
+
+        # the same as switching from the otadata on the device, with a new target
+        with self.target(OtatoolTarget) as target:
+            target.switch_ota_partition(1)
+        with self.target(OtatoolTarget) as target:
+            target.switch_ota_partition(0)
+        self.assertEqual(switched, self.otadata())
+
+
+class SessionTests(ParttoolTestCase):
+
+    def setUp(self):
+        super(SessionTests, self).setUp()
+        esptool_py = [sys.executable, ESPTOOL_PY, "--chip", "esp8266", "--before", "no_reset", "--after", "no_reset"]
+        self.server = subprocess.Popen(esptool_py + ["--port", self.port, "serve_session", "--listen", "localhost:0"],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.addCleanup(self.server.stdout.close)
+        self.addCleanup(self.stop_server)
+        output = b""
+        while b"Serving session" not in output:
+            line = self.server.stdout.readline()
+            self.assertTrue(line, output)
+            output += line
+        self.session = re.search(br"ESPTOOL_SESSION=([0-9a-f]+@[^ ]+)", output).group(1).decode()
+        self.close_session = esptool_py + ["--session", self.session, "close_session"]
+
+    def stop_server(self):
+        if self.server.poll() is None:
+            self.server.kill()
+        self.server.wait()
+
+    def test_session_reuse(self):
+        image = self.image(0x2000)
+        os.environ["ESPTOOL_SESSION"] = self.session
+        try:
+            # the port is the server's, the targets don't open it
+            with self.target(OtatoolTarget, port="/dev/nonexistent") as target:
+                target.write_ota_partition(0, self.file("app.bin", image))
+                target.switch_ota_partition(0)
+                target.verify_ota_partition(0, self.file("app.bin", image))
+                self.assertEqual(bytes(self.loader.flash[0xd000:0xf000]), target.otadata)
+            with self.target(port="/dev/nonexistent") as target:
+                target.erase_partition(PartitionName("ota_0"))
+        finally:
+            del os.environ["ESPTOOL_SESSION"]
+        self.assertEqual(b"\xff" * len(image), bytes(self.loader.flash[0x10000:0x10000 + len(image)]))
+        self.assertEqual([], self.stubs)  # not in this process
+        self.assertIsNone(self.server.poll())  # closing the targets doesn't end the session
+        subprocess.check_output(self.close_session)
+        self.assertEqual(0, self.server.wait())
+
+
+if __name__ == "__main__":
+    unittest.main(buffer=True)
@@ -21,7 +21,9 @@ $(2): $(1) $(LDGEN_FRAGMENT_FILES) $(SDKCONFIG) $(BUILD_DIR_BASE)/ldgen_librarie
 		--env           "COMPONENT_KCONFIGS=$(foreach k, $(COMPONENT_KCONFIGS), $(shell cygpath -w $(k)))" \
 		--env           "COMPONENT_KCONFIGS_PROJBUILD=$(foreach k, $(COMPONENT_KCONFIGS_PROJBUILD), $(shell cygpath -w $(k)))" \
 		--env           "IDF_CMAKE=n" \
-		--objdump		$(OBJDUMP)
+		--objdump		$(OBJDUMP) \
+		--objdump-cache $(BUILD_DIR_BASE)/ldgen_objdump_cache \
+		--manifest      $(2).manifest
 endef
 else # Windows_NT
 define ldgen_process_template
@@ -40,11 +42,13 @@ $(2): $(1) $(LDGEN_FRAGMENT_FILES) $(SDKCONFIG) $(BUILD_DIR_BASE)/ldgen_librarie
 		--env           "COMPONENT_KCONFIGS=$(COMPONENT_KCONFIGS)" \
 		--env           "COMPONENT_KCONFIGS_PROJBUILD=$(COMPONENT_KCONFIGS_PROJBUILD)" \
 		--env           "IDF_CMAKE=n" \
-		--objdump		$(OBJDUMP)
+		--objdump		$(OBJDUMP) \
+		--objdump-cache $(BUILD_DIR_BASE)/ldgen_objdump_cache \
+		--manifest      $(2).manifest
 endef
 endif # Windows_NT
 
 define ldgen_create_commands
 ldgen-clean:
-	rm -f $(BUILD_DIR_BASE)/ldgen_libraries
+	rm -f $(BUILD_DIR_BASE)/ldgen_libraries $(BUILD_DIR_BASE)/ldgen_objdump_cache
 endef
\ No newline at end of file
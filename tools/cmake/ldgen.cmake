@@ -39,7 +39,9 @@ function(__ldgen_process_template template output)
     set_property(DIRECTORY "${CMAKE_CURRENT_SOURCE_DIR}"
         APPEND PROPERTY ADDITIONAL_MAKE_CLEAN_FILES
         "${build_dir}/ldgen_libraries.in"
-        "${build_dir}/ldgen_libraries")
+        "${build_dir}/ldgen_libraries"
+        "${build_dir}/ldgen_objdump_cache"
+        "${output}.manifest")
 
     idf_build_get_property(ldgen_fragment_files __LDGEN_FRAGMENT_FILES GENERATOR_EXPRESSION)
     idf_build_get_property(ldgen_depends __LDGEN_DEPENDS GENERATOR_EXPRESSION)
@@ -67,6 +69,8 @@ function(__ldgen_process_template template output)
         --env-file  "${config_env_path}"
         --libraries-file ${build_dir}/ldgen_libraries
         --objdump   ${CMAKE_OBJDUMP}
+        --objdump-cache ${build_dir}/ldgen_objdump_cache
+        --manifest  ${output}.manifest
         DEPENDS     ${template} ${ldgen_fragment_files} ${ldgen_depends} ${SDKCONFIG}
     )
 
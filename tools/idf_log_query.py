@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Queries the log lines captured by "idf_monitor.py --capture PREFIX", for example
+# the errors from the wifi tag in the last hour:
+#
+#   idf_log_query.py PREFIX --level E --tag wifi --since 1h
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import datetime
+import json
+import sys
+import time
+
+import idf_monitor
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def time_ago(duration):
+    """ Host time 'duration' ago, ie "90", "90s", "30m", "1h" or "2d" """
+    unit = DURATION_UNITS.get(duration[-1:].lower())
+    try:
+        value = float(duration[:-1] if unit else duration)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a duration like 90s, 30m, 1h or 2d" % duration)
+    return time.time() - value * (unit or 1)
+
+
+def main():
+    parser = argparse.ArgumentParser("idf_log_query - query a log captured by idf_monitor.py --capture")
+
+    parser.add_argument(
+        'prefix', help='PREFIX given to idf_monitor.py --capture')
+
+    parser.add_argument(
+        '--level', '-l',
+        help='Only show lines of this level or more severe',
+        type=lambda c: c.upper(),
+        choices=['E', 'W', 'I', 'D', 'V'])
+
+    parser.add_argument(
+        '--tag', '-t',
+        help='Only show lines from this tag')
+
+    parser.add_argument(
+        '--since',
+        help='Only show lines received in this time, ie 30m or 1h',
+        type=time_ago)
+
+    parser.add_argument(
+        '--until',
+        help='Only show lines received before this time ago',
+        type=time_ago)
+
+    parser.add_argument(
+        '--json',
+        help='Print each line as a JSON list of host time, level, tag, device tick and line',
+        action='store_true')
+
+    args = parser.parse_args()
+
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    for host_time, level, tag, tick, line in idf_monitor.query_capture(args.prefix, args.level, args.tag,
+                                                                       args.since, args.until):
+        if args.json:
+            line = json.dumps([host_time, level, tag, tick, line.decode(errors="replace")])
+        else:
+            stamp = datetime.datetime.fromtimestamp(host_time).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            line = "%s %s" % (stamp, line.decode(errors="replace"))
+        out.write((line + "\n").encode())
+
+
+if __name__ == "__main__":
+    main()
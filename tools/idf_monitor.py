@@ -35,9 +35,13 @@ from builtins import bytes
 import subprocess
 import argparse
 import codecs
+import collections
 import datetime
+import io
+import json
 import re
 import os
+import select
 try:
     import queue
 except ImportError:
@@ -100,6 +104,14 @@ DEFAULT_TOOLCHAIN_PREFIX = "xtensa-esp32-elf-"
 
 DEFAULT_PRINT_FILTER = ""
 
+# time to wait for the rest of a line before printing a partial one
+LAST_LINE_TIMEOUT = 0.1
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    monotonic = time.time
+
 
 class StoppableThread(object):
     """
@@ -245,6 +257,11 @@ class LineMatcher(object):
     Assembles a dictionary of filtering rules based on the --print_filter
     argument of idf_monitor. Then later it is used to match lines and
     determine whether they should be shown on screen or not.
+
+    Lines are matched as bytes, and the decision for each level & tag pair is
+    only worked out once. Optionally, lines can also be filtered by a regular
+    expression on the message ('message_filter', bytes) and limited to a number
+    per second for each tag ('rate_limit', a string of "tag:lines" items).
     """
     LEVEL_N = 0
     LEVEL_E = 1
@@ -256,9 +273,15 @@ class LineMatcher(object):
     level = {'N': LEVEL_N, 'E': LEVEL_E, 'W': LEVEL_W, 'I': LEVEL_I, 'D': LEVEL_D,
              'V': LEVEL_V, '*': LEVEL_V, '': LEVEL_V}
 
-    def __init__(self, print_filter):
+    # more different (level, tag) pairs than this probably means the tags are garbage
+    MAX_CACHED_DECISIONS = 1000
+
+    # ESP_LOG* line, optionally colored: level, device tick and tag
+    LOG_LINE_RE = re.compile(br'(?:\033\[[01];?[0-9]+m?)?([EWIDV]) \(([0-9]+)\) ([^:]+): ')
+
+    def __init__(self, print_filter, message_filter=None, rate_limit=""):
         self._dict = dict()
-        self._re = re.compile(r'^(?:\033\[[01];?[0-9]+m?)?([EWIDV]) \([0-9]+\) ([^:]+): ')
+        self._re = self.LOG_LINE_RE
         items = print_filter.split()
         if len(items) == 0:
             self._dict["*"] = self.LEVEL_V  # default is to print everything
@@ -278,20 +301,292 @@ class LineMatcher(object):
                 raise ValueError('Missing ":" in filter ' + f)
             self._dict[s[0]] = lev
 
+        self._message_re = re.compile(message_filter) if message_filter else None
+        self._rate_limits = {}
+        for f in rate_limit.split():
+            s = f.split(':')
+            try:
+                tag, lines = s
+                lines = float(lines)
+            except ValueError:
+                raise ValueError('Rate limit should be "tag:lines per second", not ' + f)
+            if len(tag) == 0 or lines <= 0:
+                raise ValueError('Bad rate limit ' + f)
+            self._rate_limits[tag.encode()] = lines
+        self._buckets = {}  # tag -> [lines allowed now, time]
+
+        # We need something more than "*.N" for printing lines which weren't written with ESP_LOG*
+        self._print_other = self._dict.get("*", self.LEVEL_N) > self.LEVEL_N
+        self._pass_all = (self._message_re is None and not self._rate_limits and
+                          all(lev == self.LEVEL_V for lev in self._dict.values()) and "*" in self._dict)
+        self._decisions = {}  # (level, tag) -> bool
+
     def match(self, line):
-        try:
-            m = self._re.search(line)
-            if m:
-                lev = self.level[m.group(1)]
-                if m.group(2) in self._dict:
-                    return self._dict[m.group(2)] >= lev
-                return self._dict.get("*", self.LEVEL_N) >= lev
-        except (KeyError, IndexError):
+        if self._pass_all:
+            return True
+        if isinstance(line, type(u'')):
+            line = line.encode('utf-8')
+        m = self._re.match(line)
+        if m is None:
             # Regular line written with something else than ESP_LOG*
             # or an empty line.
-            pass
-        # We need something more than "*.N" for printing.
-        return self._dict.get("*", self.LEVEL_N) > self.LEVEL_N
+            return self._print_other and (self._message_re is None or self._message_re.search(line) is not None)
+        key = m.group(1, 3)
+        try:
+            decision = self._decisions[key]
+        except KeyError:
+            decision = self._decide(*key)
+            if len(self._decisions) >= self.MAX_CACHED_DECISIONS:
+                self._decisions.clear()
+            self._decisions[key] = decision
+        if decision and self._message_re is not None:
+            decision = self._message_re.search(line, m.end()) is not None
+        if decision and self._rate_limits:
+            decision = self._within_rate_limit(key[1])
+        return decision
+
+    def _decide(self, level, tag):
+        lev = self.level[level.decode()]
+        tag = tag.decode(errors="ignore")
+        if tag in self._dict:
+            return self._dict[tag] >= lev
+        return self._dict.get("*", self.LEVEL_N) >= lev
+
+    def _within_rate_limit(self, tag):
+        """ Token bucket for each tag, allowing up to its limit of lines per second """
+        limit = self._rate_limits.get(tag, self._rate_limits.get(b"*"))
+        if limit is None:
+            return True
+        now = monotonic()
+        bucket = self._buckets.get(tag)
+        if bucket is None:
+            bucket = self._buckets[tag] = [limit, now]
+        bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+
+class Addr2Line(object):
+    """
+    Looks up code addresses in the ELF file with a single long-running addr2line
+    process, keeping the most recently used results in a cache.
+
+    The process and the cache are thrown away when the ELF file changes (ie it has
+    been rebuilt).
+    """
+    CACHE_SIZE = 4096
+    # addr2line can't resolve this, its output marks the end of a batch of addresses
+    END_MARKER = "0x0"
+
+    def __init__(self, elf_file, toolchain_prefix=DEFAULT_TOOLCHAIN_PREFIX):
+        self.elf_file = elf_file
+        self.cmd = ["%saddr2line" % toolchain_prefix, "-pfiaC", "-e", elf_file]
+        self._process = None
+        self._elf_mtime = None
+        self._cache = collections.OrderedDict()  # address -> addr2line output, oldest first
+
+    def lookup(self, addresses):
+        """
+        Returns a dict mapping each of 'addresses' (strings, ie '0x40080400') to its addr2line
+        output, or None if the address isn't in the ELF file. Addresses which aren't cached
+        are looked up together. Raises OSError if addr2line can't be run.
+        """
+        self._check_elf_file()
+        result = {}
+        uncached = []
+        for address in addresses:
+            key = int(address, 16)
+            if key in self._cache:
+                result[address] = self._cache[key] = self._cache.pop(key)  # now most recently used
+            elif address not in uncached:
+                uncached.append(address)
+        if uncached:
+            for address, translation in zip(uncached, self._translate(uncached)):
+                if b"?? ??:0" in translation:
+                    translation = None
+                else:
+                    translation = translation.decode(errors="ignore")
+                result[address] = self._cache[int(address, 16)] = translation
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def _check_elf_file(self):
+        try:
+            mtime = os.path.getmtime(self.elf_file)
+        except OSError:
+            mtime = None
+        if mtime != self._elf_mtime:
+            self.close()
+            self._cache.clear()
+            self._elf_mtime = mtime
+
+    def _translate(self, addresses):
+        """ Returns the addr2line output for each address, as bytes """
+        if self._process is None:
+            self._process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=".")
+        try:
+            self._process.stdin.write("\n".join(addresses + [self.END_MARKER, ""]).encode())
+            self._process.stdin.flush()
+            translations = []
+            while True:
+                line = self._process.stdout.readline()
+                if not line:
+                    raise OSError("addr2line exited unexpectedly")
+                if line.startswith(b"0x"):  # first line of the output for an address
+                    if len(translations) == len(addresses):
+                        return translations  # this is the output for END_MARKER
+                    translations.append(line)
+                elif translations:
+                    translations[-1] += line  # ie "(inlined by) ..."
+        except (IOError, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        if self._process is not None:
+            process = self._process
+            self._process = None
+            try:
+                process.stdin.close()
+                process.wait()
+                process.stdout.close()
+            except Exception:
+                pass
+
+
+class LogCapture(object):
+    """
+    Captures serial output for querying later, into three append-only files:
+
+    - <prefix>.log: the data exactly as received.
+    - <prefix>.records: one JSON list per ESP_LOG* line, [host time, level, tag, device tick,
+      offset of the line in <prefix>.log, length of the line].
+    - <prefix>.index: one JSON object per block of BLOCK_RECORDS records, with the first and
+      last host time of the block, its offset and size in <prefix>.records, and the levels
+      seen for each tag. Queries only read the blocks which can match (see query_capture()).
+    """
+    BLOCK_RECORDS = 1024
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._log = open(prefix + ".log", "ab")
+        self._records = open(prefix + ".records", "ab")
+        self._index = open(prefix + ".index", "ab")
+        self._line = b""  # incomplete last line
+        self._log.seek(0, os.SEEK_END)  # which Python 2 file.seek() doesn't return
+        self._line_offset = self._log.tell()
+        self._records.seek(0, os.SEEK_END)
+        self._records_offset = self._records.tell()
+        self._block = None
+
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        timestamp = round(timestamp, 3)
+        self._log.write(data)
+        lines = data.split(b"\n")
+        lines[0] = self._line + lines[0]
+        self._line = lines.pop()
+        offset = self._line_offset
+        for line in lines:
+            self._add_record(line, offset, timestamp)
+            offset += len(line) + 1
+        self._line_offset = offset
+
+    def _add_record(self, line, offset, timestamp):
+        m = LineMatcher.LOG_LINE_RE.match(line)
+        if m is None:
+            return
+        level = m.group(1).decode()
+        tag = m.group(3).decode(errors="replace")
+        record = ('[%.3f,"%s",%s,%s,%d,%d]\n' % (timestamp, level, json.dumps(tag), m.group(2).decode(),
+                                                 offset, len(line.rstrip(b"\r")))).encode()
+        if self._block is None:
+            self._block = {"first": timestamp, "offset": self._records_offset, "records": 0, "tags": {}}
+        self._records.write(record)
+        self._records_offset += len(record)
+        block = self._block
+        block["last"] = timestamp
+        block["records"] += 1
+        levels = block["tags"].get(tag, "")
+        if level not in levels:
+            block["tags"][tag] = levels + level
+        if block["records"] >= self.BLOCK_RECORDS:
+            self._write_block()
+
+    def _write_block(self):
+        block = self._block
+        self._block = None
+        block["size"] = self._records_offset - block["offset"]
+        # the index must never point past the data
+        self._log.flush()
+        self._records.flush()
+        self._index.write((json.dumps(block, sort_keys=True) + "\n").encode())
+        self._index.flush()
+
+    def close(self):
+        if self._line:
+            self._add_record(self._line, self._line_offset, round(time.time(), 3))
+            self._line_offset += len(self._line)
+            self._line = b""
+        if self._block is not None:
+            self._write_block()
+        for f in (self._log, self._records, self._index):
+            f.close()
+
+
+def query_capture(prefix, level=None, tag=None, since=None, until=None):
+    """
+    Yields (host time, level, tag, device tick, line) for each ESP_LOG* line captured by LogCapture
+    into 'prefix' with 'level' or a more severe one, from 'tag', and logged between the host times
+    'since' and 'until' (all optional).
+
+    Only the blocks of records which the index says can match are read, and then only the matching
+    lines of the log. Records written after the last index entry (ie if the monitor didn't exit
+    cleanly) are always read.
+    """
+    levels = "EWIDV"[:LineMatcher.level[level.upper()] if level else LineMatcher.LEVEL_V]
+    ranges = []  # [offset, size] in the records file
+    indexed_end = 0
+    try:
+        with open(prefix + ".index", "rb") as f:
+            for entry in f:
+                try:
+                    block = json.loads(entry.decode())
+                except ValueError:
+                    break  # the last entry was only partly written
+                indexed_end = block["offset"] + block["size"]
+                if (since is not None and block["last"] < since) or (until is not None and block["first"] > until):
+                    continue
+                block_levels = block["tags"].get(tag, "") if tag is not None else "".join(block["tags"].values())
+                if not any(lev in levels for lev in block_levels):
+                    continue
+                if ranges and ranges[-1][0] + ranges[-1][1] == block["offset"]:
+                    ranges[-1][1] += block["size"]
+                else:
+                    ranges.append([block["offset"], block["size"]])
+    except IOError:
+        pass  # nothing has been indexed yet
+    ranges.append([indexed_end, -1])
+
+    with open(prefix + ".records", "rb") as records, open(prefix + ".log", "rb") as log:
+        for offset, size in ranges:
+            records.seek(offset)
+            for entry in records.read(size).splitlines():
+                try:
+                    r_time, r_level, r_tag, r_tick, r_offset, r_length = json.loads(entry.decode())
+                except ValueError:
+                    continue  # the last record was only partly written
+                if r_level not in levels or (tag is not None and r_tag != tag):
+                    continue
+                if (since is not None and r_time < since) or (until is not None and r_time > until):
+                    continue
+                log.seek(r_offset)
+                yield r_time, r_level, r_tag, r_tick, log.read(r_length)
 
 
 class SerialStopException(Exception):
@@ -310,7 +605,8 @@ class Monitor(object):
 
     Main difference is that all event processing happens in the main thread, not the worker threads.
     """
-    def __init__(self, serial_instance, elf_file, print_filter, make="make", toolchain_prefix=DEFAULT_TOOLCHAIN_PREFIX, eol="CRLF"):
+    def __init__(self, serial_instance, elf_file, print_filter, make="make", toolchain_prefix=DEFAULT_TOOLCHAIN_PREFIX, eol="CRLF",
+                 print_regex=None, print_rate_limit="", capture=None):
         super(Monitor, self).__init__()
         self.event_queue = queue.Queue()
         self.console = miniterm.Console()
@@ -339,6 +635,7 @@ class Monitor(object):
         else:
             self.make = make
         self.toolchain_prefix = toolchain_prefix
+        self._addr2line = Addr2Line(elf_file, toolchain_prefix)
         self.menu_key = CTRL_T
         self.exit_key = CTRL_RBRACKET
 
@@ -353,36 +650,39 @@ class Monitor(object):
         self._last_line_part = b""
         self._gdb_buffer = b""
         self._pc_address_buffer = b""
-        self._line_matcher = LineMatcher(print_filter)
-        self._invoke_processing_last_line_timer = None
+        self._line_matcher = LineMatcher(print_filter, print_regex, print_rate_limit)
+        self._last_line_deadline = None
         self._force_line_print = False
         self._output_enabled = True
         self._serial_check_exit = socket_mode
         self._log_file = None
-
-    def invoke_processing_last_line(self):
-        self.event_queue.put((TAG_SERIAL_FLUSH, b''), False)
+        self._capture = LogCapture(capture) if capture else None
 
     def main_loop(self):
         self.console_reader.start()
         self.serial_reader.start()
         try:
             while self.console_reader.alive and self.serial_reader.alive:
-                (event_tag, data) = self.event_queue.get()
+                try:
+                    if self._last_line_deadline is None:
+                        (event_tag, data) = self.event_queue.get()
+                    else:
+                        (event_tag, data) = self.event_queue.get(True, max(0, self._last_line_deadline - monotonic()))
+                except queue.Empty:
+                    # No further data was received in LAST_LINE_TIMEOUT, so finish
+                    # the last line. This is fix for handling lines sent without EOL.
+                    (event_tag, data) = (TAG_SERIAL_FLUSH, b'')
                 if event_tag == TAG_KEY:
                     self.handle_key(data)
                 elif event_tag == TAG_SERIAL:
+                    self.capture(data)
                     self.handle_serial_input(data)
-                    if self._invoke_processing_last_line_timer is not None:
-                        self._invoke_processing_last_line_timer.cancel()
-                    self._invoke_processing_last_line_timer = threading.Timer(0.1, self.invoke_processing_last_line)
-                    self._invoke_processing_last_line_timer.start()
-                    # If no futher data is received in the next short period
-                    # of time then the _invoke_processing_last_line_timer
-                    # generates an event which will result in the finishing of
-                    # the last line. This is fix for handling lines sent
-                    # without EOL.
+                    if self._last_line_part != b"":
+                        self._last_line_deadline = monotonic() + LAST_LINE_TIMEOUT
+                    else:
+                        self._last_line_deadline = None
                 elif event_tag == TAG_SERIAL_FLUSH:
+                    self._last_line_deadline = None
                     self.handle_serial_input(data, finalize_line=True)
                 else:
                     raise RuntimeError("Bad event data %r" % ((event_tag,data),))
@@ -393,9 +693,8 @@ class Monitor(object):
                 self.console_reader.stop()
                 self.serial_reader.stop()
                 self.stop_logging()
-                # Cancelling _invoke_processing_last_line_timer is not
-                # important here because receiving empty data doesn't matter.
-                self._invoke_processing_last_line_timer = None
+                self.stop_capture()
+                self._addr2line.close()
             except Exception:
                 pass
             sys.stderr.write(ANSI_NORMAL + "\n")
@@ -431,7 +730,7 @@ class Monitor(object):
             if line != b"":
                 if self._serial_check_exit and line == self.exit_key.encode('latin-1'):
                     raise SerialStopException()
-                if self._force_line_print or self._line_matcher.match(line.decode(errors="ignore")):
+                if self._force_line_print or self._line_matcher.match(line):
                     self._print(line + b'\n')
                     self.handle_possible_pc_address_in_line(line)
                 self.check_gdbstub_trigger(line)
@@ -441,7 +740,7 @@ class Monitor(object):
         # of the line. But after some time when we didn't received it we need
         # to make a decision.
         if self._last_line_part != b"":
-            if self._force_line_print or (finalize_line and self._line_matcher.match(self._last_line_part.decode(errors="ignore"))):
+            if self._force_line_print or (finalize_line and self._line_matcher.match(self._last_line_part)):
                 self._force_line_print = True
                 self._print(self._last_line_part)
                 self.handle_possible_pc_address_in_line(self._last_line_part)
@@ -462,8 +761,9 @@ class Monitor(object):
     def handle_possible_pc_address_in_line(self, line):
         line = self._pc_address_buffer + line
         self._pc_address_buffer = b""
-        for m in re.finditer(MATCH_PCADDR, line.decode(errors="ignore")):
-            self.lookup_pc_address(m.group())
+        addresses = MATCH_PCADDR.findall(line.decode(errors="ignore"))
+        if addresses:
+            self.lookup_pc_addresses(addresses)
 
     def handle_menu_key(self, c):
         if c == self.exit_key or c == self.menu_key:  # send verbatim
@@ -575,14 +875,17 @@ class Monitor(object):
                 self.output_enable(True)
 
     def lookup_pc_address(self, pc_addr):
-        cmd = ["%saddr2line" % self.toolchain_prefix,
-               "-pfiaC", "-e", self.elf_file, pc_addr]
+        self.lookup_pc_addresses([pc_addr])
+
+    def lookup_pc_addresses(self, pc_addrs):
         try:
-            translation = subprocess.check_output(cmd, cwd=".")
-            if b"?? ??:0" not in translation:
-                self._print(translation.decode(), console_printer=yellow_print)
+            translations = self._addr2line.lookup(pc_addrs)
         except OSError as e:
-            red_print("%s: %s" % (" ".join(cmd), e))
+            red_print("%s: %s" % (" ".join(self._addr2line.cmd), e))
+            return
+        for pc_addr in pc_addrs:
+            if translations[pc_addr] is not None:
+                self._print(translations[pc_addr], console_printer=yellow_print)
 
     def check_gdbstub_trigger(self, line):
         line = self._gdb_buffer + line
@@ -661,6 +964,23 @@ class Monitor(object):
             finally:
                 self._log_file = None
 
+    def capture(self, data):
+        if self._capture:
+            try:
+                self._capture.write(data)
+            except Exception as e:
+                red_print("\nCannot write to capture {}: {}".format(self._capture.prefix, e))
+                self.stop_capture()
+
+    def stop_capture(self):
+        if self._capture:
+            try:
+                self._capture.close()
+            except Exception as e:
+                red_print("\nCapture cannot be closed: {}".format(e))
+            finally:
+                self._capture = None
+
     def _print(self, string, console_printer=None):
         if console_printer is None:
             console_printer = self.console.write_bytes
@@ -677,15 +997,190 @@ class Monitor(object):
                 self.stop_logging()
 
 
+class HeadlessPort(object):
+    """
+    One of the ports watched by HeadlessMonitor, with its own line filtering and (optionally)
+    capture of everything received.
+    """
+    READ_SIZE = 4096
+
+    def __init__(self, serial_instance, label, line_matcher, capture=None):
+        self.serial = serial_instance
+        self.label = label
+        self.prefix = "[{}] ".format(label).encode()
+        self.deadline = None  # when to give up waiting for the rest of the last line
+        self.stopped = False
+        self._line_matcher = line_matcher
+        self._capture_prefix = capture
+        self._capture = None
+        self._last_line_part = b""
+        self._check_exit = serial_instance.port.startswith("socket://")  # testing hook, as in Monitor
+
+    def open(self):
+        self.serial.timeout = 0  # only read what has already arrived
+        if not self.serial.is_open:
+            self.serial.rts = True  # Force an RTS reset on open
+            self.serial.open()
+            self.serial.rts = False
+        if self._capture_prefix:
+            self._capture = LogCapture(self._capture_prefix)
+
+    def fileno(self):
+        """ For select(), raises AttributeError or io.UnsupportedOperation if the port doesn't support it """
+        return self.serial.fileno()
+
+    def read(self):
+        """ Returns the complete lines received which pass the filter """
+        data = self.serial.read(self.READ_SIZE)
+        if self._capture:
+            self._capture.write(data)
+        lines = (self._last_line_part + data).split(b"\n")
+        self._last_line_part = lines.pop()
+        self.deadline = monotonic() + LAST_LINE_TIMEOUT if self._last_line_part else None
+        return self._filter(lines)
+
+    def flush(self):
+        """ Returns the incomplete last line, if it passes the filter. Any rest of the line will be another line. """
+        line = self._last_line_part
+        self._last_line_part = b""
+        self.deadline = None
+        return self._filter([line])
+
+    def _filter(self, lines):
+        result = []
+        for line in lines:
+            if line != b"":
+                if self._check_exit and line == CTRL_RBRACKET.encode('latin-1'):
+                    self.stopped = True
+                    break
+                if self._line_matcher.match(line):
+                    result.append(line)
+        return result
+
+    def close(self):
+        try:
+            self.serial.close()
+        finally:
+            if self._capture:
+                self._capture.close()
+                self._capture = None
+
+
+class HeadlessMonitor(object):
+    """
+    Monitors many HeadlessPorts from a single thread without a console, printing each line with
+    the label of its port and decoding code addresses with one shared Addr2Line. Meant for soak
+    tests of many devices, where a Monitor for each device would need two threads each.
+
+    Ports which work with select() (serial ports except on Windows, and socket:// ports) are
+    waited for together, any others are polled every POLL_INTERVAL. Runs until every port has
+    been closed or has failed, or until interrupted.
+    """
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, ports, elf_file, toolchain_prefix=DEFAULT_TOOLCHAIN_PREFIX, output=None):
+        self.ports = ports
+        self.output = output if output is not None else getattr(sys.stdout, "buffer", sys.stdout)
+        self._addr2line = Addr2Line(elf_file, toolchain_prefix)
+        self._selectable = []
+        self._polled = []
+
+    def main_loop(self):
+        for port in self.ports:
+            try:
+                port.open()
+            except (serial.SerialException, IOError) as e:
+                red_print("--- {}: {}".format(port.label, e))
+                continue
+            try:
+                port.fileno()
+                self._selectable.append(port)
+            except (AttributeError, io.UnsupportedOperation):
+                self._polled.append(port)
+        try:
+            while self._selectable or self._polled:
+                timeout = None
+                deadlines = [p.deadline for p in self._selectable + self._polled if p.deadline is not None]
+                if deadlines:
+                    timeout = max(0, min(deadlines) - monotonic())
+                if self._polled:
+                    timeout = self.POLL_INTERVAL if timeout is None else min(timeout, self.POLL_INTERVAL)
+                if self._selectable:
+                    ready, _, _ = select.select(self._selectable, [], [], timeout)
+                else:
+                    time.sleep(timeout)
+                    ready = []
+                ready += [p for p in self._polled if p.serial.in_waiting]
+                for port in ready:
+                    self._handle(port, port.read)
+                now = monotonic()
+                for port in self._selectable + self._polled:
+                    if port.deadline is not None and port.deadline <= now:
+                        self._handle(port, port.flush)
+                self.output.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for port in self._selectable + self._polled:
+                self._close(port)
+            self._addr2line.close()
+
+    def _handle(self, port, get_lines):
+        try:
+            lines = get_lines()
+        except (serial.SerialException, IOError) as e:
+            red_print("--- {}: {}".format(port.label, e))
+            self._close(port)
+            return
+        for line in lines:
+            self.output.write(port.prefix + line + b"\n")
+            addresses = MATCH_PCADDR.findall(line.decode(errors="ignore"))
+            if addresses:
+                self._print_pc_addresses(port, addresses)
+        if port.stopped:
+            self._close(port)
+
+    def _print_pc_addresses(self, port, addresses):
+        try:
+            translations = self._addr2line.lookup(addresses)
+        except OSError as e:
+            red_print("%s: %s" % (" ".join(self._addr2line.cmd), e))
+            return
+        for address in addresses:
+            if translations[address] is not None:
+                for line in translations[address].splitlines():
+                    self.output.write(port.prefix + (ANSI_YELLOW + line + ANSI_NORMAL).encode() + b"\n")
+
+    def _close(self, port):
+        for ports in (self._selectable, self._polled):
+            if port in ports:
+                ports.remove(port)
+        try:
+            port.close()
+        except Exception as e:
+            red_print("--- {}: {}".format(port.label, e))
+
+
+def regex_argument(regex):
+    """ Command line regular expression as bytes, to match the bytes read from the port. On Python 2 the
+    arguments are bytes already, on Python 3 they are encoded back as the filesystem encoding decoded them """
+    return regex if isinstance(regex, bytes) else os.fsencode(regex)
+
+
 def main():
     parser = argparse.ArgumentParser("idf_monitor - a serial output monitor for esp-idf")
 
     parser.add_argument(
         '--port', '-p',
-        help='Serial port device',
-        default=os.environ.get('ESPTOOL_PORT', '/dev/ttyUSB0')
+        help='Serial port device. Can be repeated with --headless.',
+        action='append'
     )
 
+    parser.add_argument(
+        '--headless',
+        help="Print the output of every --port, each line labelled with its port, without a console or menu",
+        action='store_true')
+
     parser.add_argument(
         '--baud', '-b',
         help='Serial port baud rate',
@@ -718,8 +1213,47 @@ def main():
         help="Filtering string",
         default=DEFAULT_PRINT_FILTER)
 
+    parser.add_argument(
+        '--print_regex',
+        help="Only print lines whose log message matches this regular expression",
+        type=regex_argument)
+
+    parser.add_argument(
+        '--print_rate_limit',
+        help='Space separated list of "tag:lines" items, limiting the log lines printed per second for each tag ("*" for other tags)',
+        default="")
+
+    parser.add_argument(
+        '--capture',
+        help="Capture everything received into PREFIX.log, with an index of the log lines for idf_log_query.py",
+        metavar="PREFIX")
+
     args = parser.parse_args()
 
+    if args.port is None:
+        args.port = [os.environ.get('ESPTOOL_PORT', '/dev/ttyUSB0')]
+    elif len(args.port) > 1 and not args.headless:
+        parser.error("--port can only be given more than once with --headless")
+
+    args.elf_file.close()  # don't need this as a file
+
+    if args.headless:
+        ports = []
+        for port in args.port:
+            serial_instance = serial.serial_for_url(port, args.baud, do_not_open=True)
+            serial_instance.dtr = False
+            serial_instance.rts = False
+            capture = None
+            if args.capture:
+                capture = args.capture
+                if len(args.port) > 1:
+                    capture += "." + re.sub(r"[^\w.-]+", "_", port)
+            ports.append(HeadlessPort(serial_instance, port,
+                                      LineMatcher(args.print_filter, args.print_regex, args.print_rate_limit), capture))
+        HeadlessMonitor(ports, args.elf_file.name, args.toolchain_prefix).main_loop()
+        return
+
+    args.port = args.port[0]
     if args.port.startswith("/dev/tty."):
         args.port = args.port.replace("/dev/tty.", "/dev/cu.")
         yellow_print("--- WARNING: Serial ports accessed as /dev/tty.* will hang gdb if launched.")
@@ -730,8 +1264,6 @@ def main():
     serial_instance.dtr = False
     serial_instance.rts = False
 
-    args.elf_file.close()  # don't need this as a file
-
     # remove the parallel jobserver arguments from MAKEFLAGS, as any
     # parent make is only running 1 job (monitor), so we can re-spawn
     # all of the child makes we need (the -j argument remains part of
@@ -743,7 +1275,8 @@ def main():
     except KeyError:
         pass  # not running a make jobserver
 
-    monitor = Monitor(serial_instance, args.elf_file.name, args.print_filter, args.make, args.toolchain_prefix, args.eol)
+    monitor = Monitor(serial_instance, args.elf_file.name, args.print_filter, args.make, args.toolchain_prefix, args.eol,
+                      args.print_regex, args.print_rate_limit, args.capture)
 
     yellow_print('--- idf_monitor on {p.name} {p.baudrate} ---'.format(
         p=serial_instance))
@@ -754,6 +1287,8 @@ def main():
         key_description(CTRL_H)))
     if args.print_filter != DEFAULT_PRINT_FILTER:
         yellow_print('--- Print filter: {} ---'.format(args.print_filter))
+    if args.capture:
+        yellow_print('--- Capturing into {}.log ---'.format(args.capture))
 
     monitor.main_loop()
 
@@ -25,7 +25,10 @@ from __future__ import unicode_literals
 from __future__ import division
 import argparse
 import collections
+import hashlib
+import io
 import json
+import multiprocessing
 import os.path
 import re
 import sys
@@ -41,6 +44,16 @@ CHIP_SIZES = {
     }
 }
 
+# Memory Configuration of the ESP8266 linker script (esp8266.ld), for ELF files loaded without a map file.
+# IRAM is 0x8000 bytes instead when the whole instruction cache is enabled.
+DEFAULT_MEMORY_CONFIG = {
+    "iram0_0_seg": {"name": "iram0_0_seg", "origin": 0x40100000, "length": 0xC000},
+    "dram0_0_seg": {"name": "dram0_0_seg", "origin": 0x3FFE8000, "length": 0x18000},
+}
+
+# archive of every Source loaded from an ELF file, which doesn't record archives
+ELF_ARCHIVE = "(elf)"
+
 
 def _json_dump(obj):
     """ Pretty-print JSON object to stdout """
@@ -56,19 +69,114 @@ def scan_to_header(f, header_line):
     raise RuntimeError("Didn't find line '%s' in file" % header_line)
 
 
-def load_map_data(map_file):
+# Version of the parsed map data format stored in the cache file, bump if it changes
+CACHE_VERSION = 2
+
+
+def _cache_key(map_file, cache_dir):
+    """ Returns (cache file path in 'cache_dir', key identifying this version of the map file), or (None, None)
+    if the map file can't be cached """
+    try:
+        st = os.fstat(map_file.fileno())
+        path = os.path.abspath(map_file.name)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None, None
+    if not os.path.isfile(path):
+        return None, None  # ie stdin or a pipe
+    name = "%s-%s.json" % (os.path.basename(path), hashlib.md5(path.encode("utf-8")).hexdigest()[:16])
+    return os.path.join(cache_dir, name), [CACHE_VERSION, path, st.st_size, st.st_mtime]
+
+
+def _load_cache(cache_path, key):
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached["key"] != key:
+            return None
+        return cached["memory_config"], _sections_from_lists(cached["sections"])
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None  # no cache, or not readable by this version of idf_size
+
+
+def _save_cache(cache_path, key, memory_config, sections):
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path, "w") as f:
+            json.dump({"key": key, "memory_config": memory_config, "sections": _sections_to_lists(sections)}, f)
+    except (IOError, OSError):
+        pass  # caching is only an optimisation
+
+
+def _sections_to_lists(sections):
+    """ Copy of 'sections' with the sources as plain lists, for the cache file and for the results of
+    other processes, which don't depend on the module name of Source """
+    result = {}
+    for name, section in sections.items():
+        result[name] = dict(section)
+        result[name]["sources"] = [list(s) for s in section["sources"]]
+    return result
+
+
+def _sections_from_lists(sections):
+    for section in sections.values():
+        section["sources"] = [Source._make(s) for s in section["sources"]]
+    return sections
+
+
+def load_map_data(map_file, cache_dir=None):
+    """ Load memory config and sections from the map file. If 'cache_dir' is set, the result is cached
+    there as JSON, and used again while the map file's size and mtime are the same. """
+    cache_path, key = _cache_key(map_file, cache_dir) if cache_dir else (None, None)
+    if cache_path is not None:
+        cached = _load_cache(cache_path, key)
+        if cached is not None:
+            return cached
     memory_config = load_memory_config(map_file)
-    sections  = load_sections(map_file)
+    sections = load_sections(map_file)
+    if cache_path is not None:
+        _save_cache(cache_path, key, memory_config, sections)
     return memory_config, sections
 
 
+def _load_map_path(path_and_cache_dir):
+    """ load_map_data() for a path, for a worker process of load_map_files() """
+    path, cache_dir = path_and_cache_dir
+    with open(path, "r") as f:
+        memory_config, sections = load_map_data(f, cache_dir)
+    return memory_config, _sections_to_lists(sections)
+
+
+def load_map_files(map_files, cache_dir=None):
+    """ load_map_data() for each of 'map_files', parsing those which are files on disk in parallel processes.
+    Returns a list of (memory_config, sections). """
+    paths = [f.name for f in map_files if os.path.isfile(getattr(f, "name", ""))]
+    loaded = {}
+    if len(paths) > 1:
+        try:
+            pool = multiprocessing.Pool(min(len(paths), multiprocessing.cpu_count()))
+        except (OSError, NotImplementedError, ImportError):
+            pool = None  # ie no working semaphores on this platform, parse them one at a time
+        if pool is not None:
+            try:
+                for path, (memory_config, sections) in zip(paths, pool.map(_load_map_path, [(p, cache_dir) for p in paths])):
+                    loaded[path] = (memory_config, _sections_from_lists(sections))
+            finally:
+                pool.close()
+                pool.join()
+    return [loaded[f.name] if f.name in loaded else load_map_data(f, cache_dir) for f in map_files]
+
+
+RE_MEMORY_SECTION = re.compile(r"(?P<name>[^ ]+) +0x(?P<origin>[\da-f]+) +0x(?P<length>[\da-f]+)")
+
+
 def load_memory_config(map_file):
     """ Memory Configuration section is the total size of each output section """
     result = {}
     scan_to_header(map_file, "Memory Configuration")
-    RE_MEMORY_SECTION = r"(?P<name>[^ ]+) +0x(?P<origin>[\da-f]+) +0x(?P<length>[\da-f]+)"
     for line in map_file:
-        m = re.match(RE_MEMORY_SECTION, line)
+        m = RE_MEMORY_SECTION.match(line)
         if m is None:
             if len(result) == 0:
                 continue  # whitespace or a header, before the content we want
@@ -84,66 +192,123 @@ def load_memory_config(map_file):
     raise RuntimeError("End of file while scanning memory configuration?")
 
 
+# One input section linked into an output section, from a source file line of the map file.
+# 'file' is "archive:object_file", archive is "(exe)" for object files linked directly.
+Source = collections.namedtuple("Source", ["sym_name", "address", "size", "archive", "object_file", "file"])
+
+# output section header, ie '.iram0.text     0x0000000040080400    0x129a5'
+RE_SECTION_HEADER = re.compile(r"(?P<name>[^ ]+) +0x(?P<address>[\da-f]+) +0x(?P<size>[\da-f]+)$")
+
+# source file line, ie
+# 0x0000000040080400       0xa4 /home/gus/esp/32/idf/examples/get-started/hello_world/build/esp32/libesp32.a(cpu_start.o)
+# optionally with the input section name first
+RE_SOURCE_LINE = re.compile(r"\s*(?:(?P<sym_name>\S+) +)?0x(?P<address>[\da-f]+) +0x(?P<size>[\da-f]+) (?P<path>.+)")
+RE_ARCHIVE_MEMBER = re.compile(r"(?P<archive>.+\.a)\((?P<object_file>.+\.ob?j?)\)")
+# cmake build system links some object files directly, not part of any archive
+RE_OBJECT_FILE = re.compile(r"(?P<object_file>.+\.ob?j?)")
+
+# In some cases the section name appears on the previous line
+RE_SYMBOL_ONLY_LINE = re.compile(r" (?P<sym_name>\S*)$")
+
+
 def load_sections(map_file):
     """ Load section size information from the MAP file.
 
     Returns a dict of 'sections', where each key is a section name and the value
-    is a dict with details about this section, including a "sources" key which holds a list of source file line
-    information for each symbol linked into the section.
+    is a dict with details about this section, including a "sources" key which holds a list of
+    Source records for each symbol linked into the section.
     """
     scan_to_header(map_file, "Linker script and memory map")
     sections = {}
     section = None
     sym_backup = None
+    # path in the map file -> (archive, object_file, file), so each is only split once and the strings are shared
+    objects = {}
     for line in map_file:
-        # output section header, ie '.iram0.text     0x0000000040080400    0x129a5'
-        RE_SECTION_HEADER = r"(?P<name>[^ ]+) +0x(?P<address>[\da-f]+) +0x(?P<size>[\da-f]+)$"
-        m = re.match(RE_SECTION_HEADER, line)
-        if m is not None:  # start of a new section
-            section = {
-                "name": m.group("name"),
-                "address": int(m.group("address"), 16),
-                "size": int(m.group("size"), 16),
-                "sources": [],
-            }
-            sections[section["name"]] = section
+        if line[:1] != " ":
+            m = RE_SECTION_HEADER.match(line)
+            if m is not None:  # start of a new section
+                section = {
+                    "name": m.group("name"),
+                    "address": int(m.group("address"), 16),
+                    "size": int(m.group("size"), 16),
+                    "sources": [],
+                }
+                sections[section["name"]] = section
             continue
 
-        # source file line, ie
-        # 0x0000000040080400       0xa4 /home/gus/esp/32/idf/examples/get-started/hello_world/build/esp32/libesp32.a(cpu_start.o)
-        RE_SOURCE_LINE = r"\s*(?P<sym_name>\S*).* +0x(?P<address>[\da-f]+) +0x(?P<size>[\da-f]+) (?P<archive>.+\.a)\((?P<object_file>.+\.ob?j?)\)"
-
-        m = re.match(RE_SOURCE_LINE, line, re.M)
-        if not m:
-            # cmake build system links some object files directly, not part of any archive
-            RE_SOURCE_LINE = r"\s*(?P<sym_name>\S*).* +0x(?P<address>[\da-f]+) +0x(?P<size>[\da-f]+) (?P<object_file>.+\.ob?j?)"
-            m = re.match(RE_SOURCE_LINE, line)
-        if section is not None and m is not None:  # input source file details=ma,e
-            sym_name = m.group("sym_name") if len(m.group("sym_name")) > 0 else sym_backup
-            try:
-                archive = m.group("archive")
-            except IndexError:
-                archive = "(exe)"
+        m = RE_SOURCE_LINE.match(line)
+        if m is None:
+            m = RE_SYMBOL_ONLY_LINE.match(line)
+            if m is not None:
+                sym_backup = m.group("sym_name")
+            continue
+        if section is None:
+            continue
 
-            source = {
-                "size": int(m.group("size"), 16),
-                "address": int(m.group("address"), 16),
-                "archive": os.path.basename(archive),
-                "object_file": os.path.basename(m.group("object_file")),
-                "sym_name": sym_name,
-            }
-            source["file"] = "%s:%s" % (source["archive"], source["object_file"])
-            section["sources"] += [source]
-
-        # In some cases the section name appears on the previous line, back it up in here
-        RE_SYMBOL_ONLY_LINE = r"^ (?P<sym_name>\S*)$"
-        m = re.match(RE_SYMBOL_ONLY_LINE, line)
-        if section is not None and m is not None:
-            sym_backup = m.group("sym_name")
+        path = m.group("path")
+        try:
+            obj = objects[path]
+        except KeyError:
+            member = RE_ARCHIVE_MEMBER.match(path)
+            if member is not None:
+                archive = os.path.basename(member.group("archive"))
+                object_file = os.path.basename(member.group("object_file"))
+            else:
+                member = RE_OBJECT_FILE.match(path)
+                archive = "(exe)"
+                object_file = os.path.basename(member.group("object_file")) if member is not None else None
+            obj = objects[path] = (archive, object_file, "%s:%s" % (archive, object_file))
+        if obj[1] is None:
+            continue  # not an object file, ie a '*fill*' line
+        section["sources"].append(Source(m.group("sym_name") or sym_backup,
+                                         int(m.group("address"), 16),
+                                         int(m.group("size"), 16),
+                                         *obj))
 
     return sections
 
 
+def load_elf_data(elf_path, memory_config=None):
+    """ Load the sections of an ELF file and the symbols in each, in the format of load_sections(),
+    so the summary and symbol reports don't need the map file.
+
+    Each section loaded into memory (including .bss) has a Source for every function and data symbol in it,
+    with archive ELF_ARCHIVE and the source file of local symbols as object file. Returns (memory_config,
+    sections), where memory_config is DEFAULT_MEMORY_CONFIG unless given, ie from load_memory_config().
+    """
+    try:
+        import esptool
+    except ImportError:
+        esptool_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "components", "esptool_py", "esptool")
+        sys.path.append(os.path.abspath(esptool_dir))
+        import esptool
+
+    with esptool.ELFFile(elf_path) as elf:
+        sections = {}
+        by_index = {}
+        for i, header in enumerate(elf.section_headers):
+            if header.flags & esptool.ELFFile.SEC_FLAG_ALLOC and header.name not in sections:
+                section = by_index[i] = sections[header.name] = {
+                    "name": header.name,
+                    "address": header.addr,
+                    "size": header.size,
+                    "sources": [],
+                }
+        files = {}
+        for sym in elf.read_symbols():
+            section = by_index.get(sym.section)
+            if section is None:
+                continue  # absolute, common or not loaded
+            try:
+                obj = files[sym.file]
+            except KeyError:
+                object_file = sym.file or ""
+                obj = files[sym.file] = (ELF_ARCHIVE, object_file, "%s:%s" % (ELF_ARCHIVE, object_file))
+            section["sources"].append(Source(sym.name, sym.addr, sym.size, *obj))
+    return memory_config or DEFAULT_MEMORY_CONFIG, sections
+
+
 def sizes_by_key(sections, key):
     """ Takes a dict of sections (from load_sections) and returns
     a dict keyed by 'key' with aggregate output size information.
@@ -153,15 +318,74 @@ def sizes_by_key(sections, key):
     result = {}
     for section in sections.values():
         for s in section["sources"]:
-            if not s[key] in result:
-                result[s[key]] = {}
-            archive = result[s[key]]
+            k = getattr(s, key)
+            if k not in result:
+                result[k] = {}
+            archive = result[k]
             if not section["name"] in archive:
                 archive[section["name"]] = 0
-            archive[section["name"]] += s["size"]
+            archive[section["name"]] += s.size
     return result
 
 
+class SizeIndex(object):
+    """ Sizes of the sources of 'sections' (from load_sections()) totalled per archive, per object file
+    and per symbol in each section. The reports all read from this, so asking for several of them
+    doesn't walk the sources again for each one.
+
+    The archive and file totals take one pass over the sources. The first request for symbols groups
+    the sources by archive in another, and the symbol names of an archive are only stripped of their
+    section prefix when its symbols are asked for, as that costs as much again as the rest.
+    """
+
+    def __init__(self, sections):
+        self._sections = sections
+        self.archives = {}  # archive -> {section name: size}, as sizes_by_key(sections, "archive")
+        self.files = {}  # archive:object_file -> {section name: size}, as sizes_by_key(sections, "file")
+        self._archive_sources = None  # archive -> [(section name, sources)] for ARCHIVE_SYMBOLS_SECTIONS
+        self._symbols = {}  # archive -> {section name: {symbol: size}}
+        for name, section in sections.items():
+            archive_sizes = {}
+            file_sizes = {}
+            for _, _, size, archive, _, file in section["sources"]:
+                archive_sizes[archive] = archive_sizes.get(archive, 0) + size
+                file_sizes[file] = file_sizes.get(file, 0) + size
+            for totals, sizes in [(self.archives, archive_sizes), (self.files, file_sizes)]:
+                for k, size in sizes.items():
+                    totals.setdefault(k, {})[name] = size
+
+    def symbols(self, archive):
+        """ {section name: {symbol: size}} of the symbols from 'archive' in ARCHIVE_SYMBOLS_SECTIONS """
+        try:
+            return self._symbols[archive]
+        except KeyError:
+            pass
+        if self._archive_sources is None:
+            self._archive_sources = {}
+            for name in ARCHIVE_SYMBOLS_SECTIONS:
+                by_archive = {}
+                for s in self._sections.get(name, {"sources": []})["sources"]:
+                    try:
+                        by_archive[s.archive].append(s)
+                    except KeyError:
+                        by_archive[s.archive] = [s]
+                for a, sources in by_archive.items():
+                    self._archive_sources.setdefault(a, []).append((name, sources))
+        result = self._symbols[archive] = {}
+        for name, sources in self._archive_sources.get(archive, []):
+            sizes = result[name] = {}
+            for s in sources:
+                sym_name = s.sym_name
+                if sym_name.startswith("."):  # an input section name from the map file, not a symbol from the ELF
+                    sym_name = RE_SECTION_PREFIX.sub("", sym_name)
+                sizes[sym_name] = sizes.get(sym_name, 0) + s.size
+        return result
+
+    def by_key(self, key):
+        """ Same as sizes_by_key(sections, key), for key "archive" or "file" """
+        return {"archive": self.archives, "file": self.files}[key]
+
+
 def main():
     parser = argparse.ArgumentParser("idf_size - a tool to print IDF elf file sizes")
 
@@ -176,8 +400,15 @@ def main():
         action="store_true")
 
     parser.add_argument(
-        'map_file', help='MAP file produced by linker',
-        type=argparse.FileType('r'))
+        'map_file', help='MAP file produced by linker. Optional with --elf, where only its memory configuration is used',
+        type=argparse.FileType('r'), nargs='?')
+
+    parser.add_argument(
+        '--elf', help='Read the section and symbol sizes from this ELF file instead of the MAP file. '
+        'Without a MAP file, the memory sizes of the ESP8266 linker script are assumed.')
+
+    parser.add_argument(
+        '--symbols', help='With --elf, print the size of every symbol', action='store_true')
 
     parser.add_argument(
         '--archives', help='Print per-archive sizes', action='store_true')
@@ -188,21 +419,74 @@ def main():
     parser.add_argument(
         '--files', help='Print per-file sizes', action='store_true')
 
+    parser.add_argument(
+        '--all', help='Print the summary, per-archive and per-file sizes and the symbols of every archive. '
+        'With --json, as one JSON object.', action='store_true')
+
+    parser.add_argument(
+        '--cache-dir', help='Cache the parsed map files in this directory (ie the build directory), '
+        'and use them again while the map files are unchanged', metavar='DIR')
+
+    parser.add_argument(
+        '--diff', help='Print the changes in sizes compared with this MAP file. Can be repeated, to compare with each.',
+        metavar='REFERENCE_MAP_FILE', type=argparse.FileType('r'), action='append')
+
+    parser.add_argument(
+        '--max-increase', help='With --diff, exit with an error if this size increases by more than BYTES. '
+        'NAME is one of the --json summary items (ie total_size, used_dram), or "archive" or "file" for the '
+        'largest increase of any archive or object file. Can be repeated.',
+        metavar='NAME=BYTES', type=parse_threshold, action='append', default=[])
+
     args = parser.parse_args()
 
-    memory_config, sections = load_map_data(args.map_file)
+    if args.max_increase and not args.diff:
+        parser.error("--max-increase needs --diff")
+
+    if args.elf:
+        if args.archives or args.files or args.archive_details or args.all or args.diff:
+            parser.error("--elf only prints the summary and --symbols")
+        memory_config = load_memory_config(args.map_file) if args.map_file else None
+        memory_config, sections = load_elf_data(args.elf, memory_config)
+        if not args.json or not args.symbols:
+            print_summary(memory_config, sections, args.json)
+        if args.symbols:
+            print_elf_symbols(sections, args.json)
+        return
+
+    if args.symbols:
+        parser.error("--symbols needs --elf")
+    if args.map_file is None:
+        parser.error("the MAP file is required without --elf")
+
+    if args.diff:
+        loaded = load_map_files([args.map_file] + args.diff, args.cache_dir)
+        over = []
+        for reference_file, reference in zip(args.diff, loaded[1:]):
+            over += print_diff(loaded[0], reference, args.map_file.name, reference_file.name, args.archives, args.files,
+                               args.archive_details, dict(args.max_increase), args.json)
+        if over:
+            sys.exit(1)
+        return
+
+    memory_config, sections = load_map_data(args.map_file, args.cache_dir)
+    index = SizeIndex(sections)
+    if args.all:
+        print_all_reports(memory_config, sections, args.json, index)
+        return
+
     if not args.json or not (args.archives or args.files or args.archive_details):
         print_summary(memory_config, sections, args.json)
 
     if args.archives:
-        print_detailed_sizes(sections, "archive", "Archive File", args.json)
+        print_detailed_sizes(sections, "archive", "Archive File", args.json, index)
     if args.files:
-        print_detailed_sizes(sections, "file", "Object File", args.json)
+        print_detailed_sizes(sections, "file", "Object File", args.json, index)
     if args.archive_details:
-        print_archive_symbols(sections, args.archive_details, args.json)
+        print_archive_symbols(sections, args.archive_details, args.json, index)
 
 
-def print_summary(memory_config, sections, as_json=False):
+def summary_sizes(memory_config, sections):
+    """ Returns an OrderedDict of the overall memory use, as printed by print_summary() """
     def get_size(section):
         try:
             return sections[section]["size"]
@@ -228,35 +512,43 @@ def print_summary(memory_config, sections, as_json=False):
     flash_rodata = get_size(".flash.rodata")
     total_size = used_data + used_iram + flash_code + flash_rodata
 
+    return collections.OrderedDict([
+        ("dram_data", used_data),
+        ("dram_bss", used_bss),
+        ("used_dram", used_dram),
+        ("available_dram", total_dram - used_dram),
+        ("used_dram_ratio", used_dram_ratio),
+        ("used_iram", used_iram),
+        ("available_iram", total_iram - used_iram),
+        ("used_iram_ratio", used_iram_ratio),
+        ("flash_code", flash_code),
+        ("flash_rodata", flash_rodata),
+        ("total_size", total_size)
+    ])
+
+
+def print_summary(memory_config, sections, as_json=False):
+    summary = summary_sizes(memory_config, sections)
+
     if as_json:
-        _json_dump(collections.OrderedDict([
-            ("dram_data", used_data),
-            ("dram_bss", used_bss),
-            ("used_dram", used_dram),
-            ("available_dram", total_dram - used_dram),
-            ("used_dram_ratio", used_dram_ratio),
-            ("used_iram", used_iram),
-            ("available_iram", total_iram - used_iram),
-            ("used_iram_ratio", used_iram_ratio),
-            ("flash_code", flash_code),
-            ("flash_rodata", flash_rodata),
-            ("total_size", total_size)
-        ]))
+        _json_dump(summary)
     else:
         print("Total sizes:")
-        print(" DRAM .data size: %7d bytes" % used_data)
-        print(" DRAM .bss  size: %7d bytes" % used_bss)
+        print(" DRAM .data size: %7d bytes" % summary["dram_data"])
+        print(" DRAM .bss  size: %7d bytes" % summary["dram_bss"])
         print("Used static DRAM: %7d bytes (%7d available, %.1f%% used)" %
-              (used_dram, total_dram - used_dram, 100.0 * used_dram_ratio))
+              (summary["used_dram"], summary["available_dram"], 100.0 * summary["used_dram_ratio"]))
         print("Used static IRAM: %7d bytes (%7d available, %.1f%% used)" %
-              (used_iram, total_iram - used_iram, 100.0 * used_iram_ratio))
-        print("      Flash code: %7d bytes" % flash_code)
-        print("    Flash rodata: %7d bytes" % flash_rodata)
-        print("Total image size:~%7d bytes (.bin may be padded larger)" % (total_size))
+              (summary["used_iram"], summary["available_iram"], 100.0 * summary["used_iram_ratio"]))
+        print("      Flash code: %7d bytes" % summary["flash_code"])
+        print("    Flash rodata: %7d bytes" % summary["flash_rodata"])
+        print("Total image size:~%7d bytes (.bin may be padded larger)" % (summary["total_size"]))
 
 
-def print_detailed_sizes(sections, key, header, as_json=False):
-    sizes = sizes_by_key(sections, key)
+def detailed_sizes(sections, key, index=None):
+    """ Returns a list of (key, OrderedDict of sizes in each kind of memory) from the SizeIndex of
+    'sections' ('index', if it has already been built), largest total first """
+    sizes = (index or SizeIndex(sections)).by_key(key)
 
     result = {}
     for k in sizes:
@@ -278,48 +570,51 @@ def print_detailed_sizes(sections, key, header, as_json=False):
     s = sorted(list(result.items()), key=return_header)
 
     # do a secondary sort in order to have consistent order (for diff-ing the output)
-    s = sorted(s, key=return_total_size, reverse=True)
+    return sorted(s, key=return_total_size, reverse=True)
+
+
+DETAILED_SIZES_HEADINGS = ("DRAM .data", "& .bss", "IRAM", "Flash code", "& rodata", "Total")
+
+
+def _print_detailed_rows(rows, key, header, header_format):
+    print(header_format.replace("+", "").replace("d", "s") % ((header,) + DETAILED_SIZES_HEADINGS))
+
+    for k,v in rows:
+        if ":" in k:  # print subheadings for key of format archive:file
+            sh,k = k.split(":")
+        print(header_format % (k[:24],
+                               v["data"],
+                               v["bss"],
+                               v["iram"],
+                               v["flash_text"],
+                               v["flash_rodata"],
+                               v["total"]))
+
+
+def print_detailed_sizes(sections, key, header, as_json=False, index=None):
+    s = detailed_sizes(sections, key, index)
 
     if as_json:
         _json_dump(collections.OrderedDict(s))
     else:
         print("Per-%s contributions to ELF file:" % key)
-        headings = (header,
-                    "DRAM .data",
-                    "& .bss",
-                    "IRAM",
-                    "Flash code",
-                    "& rodata",
-                    "Total")
-        header_format = "%24s %10d %6d %6d %10d %8d %7d"
-        print(header_format.replace("d", "s") % headings)
-
-        for k,v in s:
-            if ":" in k:  # print subheadings for key of format archive:file
-                sh,k = k.split(":")
-            print(header_format % (k[:24],
-                                   v["data"],
-                                   v["bss"],
-                                   v["iram"],
-                                   v["flash_text"],
-                                   v["flash_rodata"],
-                                   v["total"]))
-
-
-def print_archive_symbols(sections, archive, as_json=False):
-    interested_sections = [".dram0.data", ".dram0.bss", ".iram0.text", ".iram0.vectors", ".flash.text", ".flash.rodata"]
+        _print_detailed_rows(s, key, header, "%24s %10d %6d %6d %10d %8d %7d")
+
+
+RE_SECTION_PREFIX = re.compile("(.text.|.literal.|.data.|.bss.|.rodata.)")
+
+
+ARCHIVE_SYMBOLS_SECTIONS = [".dram0.data", ".dram0.bss", ".iram0.text", ".iram0.vectors", ".flash.text", ".flash.rodata"]
+
+
+def archive_symbols(sections, archive, index=None):
+    """ Returns an OrderedDict of each section, where each entry is an OrderedDict of the sizes
+    of the symbols from 'archive' in that section, largest first """
+    interested_sections = ARCHIVE_SYMBOLS_SECTIONS
+    symbols = (index or SizeIndex(sections)).symbols(archive)
     result = {}
     for t in interested_sections:
-        result[t] = {}
-    for section in sections.values():
-        section_name = section["name"]
-        if section_name not in interested_sections:
-            continue
-        for s in section["sources"]:
-            if archive != s["archive"]:
-                continue
-            s["sym_name"] = re.sub("(.text.|.literal.|.data.|.bss.|.rodata.)", "", s["sym_name"])
-            result[section_name][s["sym_name"]] = result[section_name].get(s["sym_name"], 0) + s["size"]
+        result[t] = symbols.get(t, {})
 
     # build a new ordered dict of each section, where each entry is an ordereddict of symbols to sizes
     section_symbols = collections.OrderedDict()
@@ -328,18 +623,175 @@ def print_archive_symbols(sections, archive, as_json=False):
         # do a secondary sort in order to have consistent order (for diff-ing the output)
         s = sorted(s, key=lambda k_v: k_v[1], reverse=True)
         section_symbols[t] = collections.OrderedDict(s)
+    return section_symbols
+
+
+def _print_section_symbols(section_symbols, value_format):
+    for t,s in section_symbols.items():
+        section_total = 0
+        print("\nSymbols from section:", t)
+        for key, val in s.items():
+            print(("%s(" + value_format + ")") % (key.replace(t + ".", ""), val), end=' ')
+            section_total += val
+        print(("\nSection total: " + value_format) % section_total)
+
+
+def print_archive_symbols(sections, archive, as_json=False, index=None):
+    section_symbols = archive_symbols(sections, archive, index)
 
     if as_json:
         _json_dump(section_symbols)
     else:
         print("Symbols within the archive: %s (Not all symbols may be reported)" % (archive))
-        for t,s in section_symbols.items():
-            section_total = 0
-            print("\nSymbols from section:", t)
-            for key, val in s.items():
-                print(("%s(%d)" % (key.replace(t + ".", ""), val)), end=' ')
-                section_total += val
-            print("\nSection total:",section_total)
+        _print_section_symbols(section_symbols, "%d")
+
+
+def print_elf_symbols(sections, as_json=False):
+    """ Print the sizes of the symbols of sections from load_elf_data(), as print_archive_symbols() """
+    section_symbols = archive_symbols(sections, ELF_ARCHIVE)
+
+    if as_json:
+        _json_dump(section_symbols)
+    else:
+        print("Symbols within the ELF file (Not all symbols may be reported)")
+        _print_section_symbols(section_symbols, "%d")
+
+
+def print_all_reports(memory_config, sections, as_json=False, index=None):
+    """ Print the summary, per-archive and per-file sizes and the symbols of every archive """
+    index = index or SizeIndex(sections)
+    archives = sorted(index.archives)
+    if as_json:
+        _json_dump(collections.OrderedDict([
+            ("summary", summary_sizes(memory_config, sections)),
+            ("archives", collections.OrderedDict(detailed_sizes(sections, "archive", index))),
+            ("files", collections.OrderedDict(detailed_sizes(sections, "file", index))),
+            ("archive_symbols", collections.OrderedDict((a, archive_symbols(sections, a, index)) for a in archives)),
+        ]))
+    else:
+        print_summary(memory_config, sections)
+        print_detailed_sizes(sections, "archive", "Archive File", index=index)
+        print_detailed_sizes(sections, "file", "Object File", index=index)
+        for archive in archives:
+            print_archive_symbols(sections, archive, index=index)
+
+
+# summary_sizes() items compared by print_diff()
+SUMMARY_DIFF_ITEMS = collections.OrderedDict([
+    ("dram_data", " DRAM .data size"),
+    ("dram_bss", " DRAM .bss  size"),
+    ("used_dram", "Used static DRAM"),
+    ("used_iram", "Used static IRAM"),
+    ("flash_code", "      Flash code"),
+    ("flash_rodata", "    Flash rodata"),
+    ("total_size", "Total image size"),
+])
+
+# --max-increase names for the largest increase of any single archive or object file
+THRESHOLD_DETAILS = {"archive": "archive", "file": "object file"}
+
+
+def diff_detailed_sizes(sections, reference_sections, key, index=None, reference_index=None):
+    """ detailed_sizes() of 'sections' minus those of 'reference_sections', for the keys which changed.
+    Largest increase first, largest decrease last. """
+    current = dict(detailed_sizes(sections, key, index))
+    reference = dict(detailed_sizes(reference_sections, key, reference_index))
+    result = []
+    for k in set(current) | set(reference):
+        cur = current.get(k)
+        ref = reference.get(k)
+        columns = (cur or ref).keys()
+        delta = collections.OrderedDict((c, (cur[c] if cur else 0) - (ref[c] if ref else 0)) for c in columns)
+        if any(delta.values()):
+            result.append((k, delta))
+    result.sort(key=lambda k_v: k_v[0])
+    return sorted(result, key=lambda k_v: k_v[1]["total"], reverse=True)
+
+
+def diff_archive_symbols(sections, reference_sections, archive, index=None, reference_index=None):
+    """ archive_symbols() of 'sections' minus those of 'reference_sections', for the symbols which changed """
+    current = archive_symbols(sections, archive, index)
+    reference = archive_symbols(reference_sections, archive, reference_index)
+    section_symbols = collections.OrderedDict()
+    for t in current:
+        delta = [(sym, current[t].get(sym, 0) - reference[t].get(sym, 0)) for sym in set(current[t]) | set(reference[t])]
+        s = sorted([d for d in delta if d[1] != 0], key=lambda k_v: k_v[0])
+        section_symbols[t] = collections.OrderedDict(sorted(s, key=lambda k_v: k_v[1], reverse=True))
+    return section_symbols
+
+
+def check_thresholds(summary, details, max_increase):
+    """ Returns a message for each increase over its limit in 'max_increase', a dict of summary item or
+    THRESHOLD_DETAILS names to bytes. 'summary' is a dict of item to (reference, current, delta), 'details'
+    a dict of THRESHOLD_DETAILS name to diff_detailed_sizes() result. """
+    over = []
+    for name, limit in sorted(max_increase.items()):
+        if name in THRESHOLD_DETAILS:
+            over += ["%s %s increased by %d bytes (limit %d)" % (THRESHOLD_DETAILS[name], k, v["total"], limit)
+                     for k, v in details[name] if v["total"] > limit]
+        elif summary[name][2] > limit:
+            over.append("%s increased by %d bytes (limit %d)" % (name, summary[name][2], limit))
+    return over
+
+
+def print_diff(current, reference, current_name, reference_name, archives=False, files=False, archive_details=None,
+               max_increase=None, as_json=False):
+    """ Print the differences in sizes between 'current' and 'reference' (both (memory_config, sections)).
+    Returns the messages from check_thresholds(). """
+    max_increase = max_increase or {}
+    current_summary = summary_sizes(*current)
+    reference_summary = summary_sizes(*reference)
+    summary = collections.OrderedDict((k, (reference_summary[k], current_summary[k], current_summary[k] - reference_summary[k]))
+                                      for k in SUMMARY_DIFF_ITEMS)
+    index = SizeIndex(current[1])
+    reference_index = SizeIndex(reference[1])
+    details = {}
+    for key in THRESHOLD_DETAILS:
+        if (key == "archive" and archives) or (key == "file" and files) or key in max_increase:
+            details[key] = diff_detailed_sizes(current[1], reference[1], key, index, reference_index)
+    symbols = None
+    if archive_details:
+        symbols = diff_archive_symbols(current[1], reference[1], archive_details, index, reference_index)
+    over = check_thresholds(summary, details, max_increase)
+
+    if as_json:
+        result = collections.OrderedDict([("reference", reference_name), ("current", current_name)])
+        result["summary"] = collections.OrderedDict((k, collections.OrderedDict(zip(("reference", "current", "delta"), v)))
+                                                    for k, v in summary.items())
+        if archives:
+            result["archives"] = collections.OrderedDict(details["archive"])
+        if files:
+            result["files"] = collections.OrderedDict(details["file"])
+        if symbols is not None:
+            result["archive_symbols"] = symbols
+        result["over_threshold"] = over
+        _json_dump(result)
+    else:
+        print("Total sizes of %s compared with %s:" % (current_name, reference_name))
+        for k, heading in SUMMARY_DIFF_ITEMS.items():
+            print("%s: %7d bytes (%+d)" % (heading, summary[k][1], summary[k][2]))
+        for key, header, enabled in [("archive", "Archive File", archives), ("file", "Object File", files)]:
+            if enabled:
+                print("Per-%s changes in contributions to ELF file:" % key)
+                _print_detailed_rows(details[key], key, header, "%24s %+10d %+6d %+6d %+10d %+8d %+7d")
+        if symbols is not None:
+            print("Changed symbols within the archive: %s (Not all symbols may be reported)" % (archive_details))
+            _print_section_symbols(symbols, "%+d")
+        for message in over:
+            print("Over threshold: %s" % message)
+    return over
+
+
+def parse_threshold(threshold):
+    """ argparse type for --max-increase, returns (name, bytes) """
+    try:
+        name, limit = threshold.split("=")
+        limit = int(limit, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not NAME=BYTES" % threshold)
+    if name not in SUMMARY_DIFF_ITEMS and name not in THRESHOLD_DETAILS:
+        raise argparse.ArgumentTypeError("%s is not one of %s" % (name, ", ".join(list(SUMMARY_DIFF_ITEMS) + sorted(THRESHOLD_DETAILS))))
+    return name, limit
 
 
 if __name__ == "__main__":
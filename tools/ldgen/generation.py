@@ -20,9 +20,9 @@ import os
 import fnmatch
 
 from fragments import Sections, Scheme, Mapping, Fragment
-from pyparsing import Suppress, White, ParseException, Literal, Group, ZeroOrMore
-from pyparsing import Word, OneOrMore, nums, alphanums, alphas, Optional, LineEnd, printables
-from ldgen_common import LdGenFailure
+from pyparsing import Suppress, White, ParseException, Literal
+from pyparsing import Word, LineEnd, printables
+from ldgen_common import LdGenFailure, objects_sections
 
 
 class PlacementRule():
@@ -247,6 +247,79 @@ class PlacementRule():
         raise StopIteration
 
 
+class PlacementRuleIndex():
+    """
+    Indexes placement rules by archive, object and symbol, from the most general to the most specific,
+    so that the rules nesting with a rule can be looked up without going through all the rules.
+    Rules are returned in the order they were indexed.
+    """
+
+    ENTITIES = (PlacementRule.ARCHIVE_SPECIFICITY, PlacementRule.OBJECT_SPECIFICITY, PlacementRule.SYMBOL_SPECIFICITY)
+
+    def __init__(self, rules):
+        # archive -> object -> symbol -> [(position, rule)], with the entities beyond the
+        # specificity of the rule, which are never compared, indexed as None
+        self.root = dict()
+
+        for (position, rule) in enumerate(rules):
+            keys = [rule[e] if e <= rule.specificity else None for e in PlacementRuleIndex.ENTITIES]
+            node = self.root
+            for key in keys[:-1]:
+                node = node.setdefault(key, dict())
+            node.setdefault(keys[-1], list()).append((position, rule))
+
+    def _find(self, entity_keys):
+        # entity_keys has, for each entity, the keys to follow; None follows all keys
+        nodes = [self.root]
+
+        for keys in entity_keys:
+            next_nodes = []
+            for node in nodes:
+                if keys is None:
+                    next_nodes.extend(node.values())
+                else:
+                    next_nodes.extend(node[key] for key in keys if key in node)
+            nodes = next_nodes
+
+        return sorted(itertools.chain.from_iterable(nodes), key=lambda r: r[0])
+
+    def get_more_specific_rules(self, rule):
+        """
+        Returns the rules that are possibly more specific than rule, see PlacementRule.is_more_specific_rule_of.
+        """
+        entity_keys = []
+        for entity_index in PlacementRuleIndex.ENTITIES:
+            entity = rule[entity_index]
+            entity_keys.append([entity] if entity_index <= rule.specificity and entity is not None else None)
+
+        return [r for (_, r) in self._find(entity_keys) if r.specificity > rule.specificity]
+
+    def get_more_general_rules(self, rule):
+        """
+        Returns the rules that rule is possibly more specific of, see PlacementRule.is_more_specific_rule_of.
+        """
+        entity_keys = [{rule[entity_index], None} for entity_index in PlacementRuleIndex.ENTITIES]
+
+        return [r for (_, r) in self._find(entity_keys) if r.specificity < rule.specificity]
+
+    def get_same_entities_rules(self, rule):
+        """
+        Returns the rules indexed after rule that possibly map the same entities, see PlacementRule.maps_same_entities_as.
+        """
+        entity_keys = []
+        for entity_index in PlacementRuleIndex.ENTITIES:
+            entity = rule[entity_index]
+            if entity_index > rule.specificity:
+                entity_keys.append(None)
+            else:
+                entity_keys.append({entity, None})
+
+        found = self._find(entity_keys)
+        position = next(p for (p, r) in found if r is rule)
+
+        return [r for (p, r) in found if p > position and r.specificity == rule.specificity]
+
+
 class GenerationModel:
     """
     Implements generation of placement rules based on collected sections, scheme and mapping fragment.
@@ -371,10 +444,14 @@ class GenerationModel:
     def _detect_conflicts(self, rules):
         (archive, rules_list) = rules
 
+        rules_index = PlacementRuleIndex(rules_list)
+
         for specificity in range(0, PlacementRule.OBJECT_SPECIFICITY + 1):
             rules_with_specificity = filter(lambda r: r.specificity == specificity, rules_list)
 
-            for rule_a, rule_b in itertools.combinations(rules_with_specificity, 2):
+            # Only compare each rule with the rules after it mapping the same entities, in the same order
+            # as going through all the pairs of rules would.
+            for (rule_a, rule_b) in ((a, b) for a in rules_with_specificity for b in rules_index.get_same_entities_rules(a)):
                 intersections = rule_a.get_sections_intersection(rule_b)
 
                 if intersections and rule_a.maps_same_entities_as(rule_b):
@@ -388,12 +465,15 @@ class GenerationModel:
         rules_to_process = sorted(rules, key=lambda r: r.specificity)
         symbol_specific_rules = list(filter(lambda r: r.specificity == PlacementRule.SYMBOL_SPECIFICITY, rules_to_process))
 
+        rules_index = PlacementRuleIndex(rules_to_process)
+
         extra_rules = dict()
 
         for symbol_specific_rule in symbol_specific_rules:
             extra_rule_candidate = {s: None for s in symbol_specific_rule.get_section_names()}
 
-            super_rules = filter(lambda r: symbol_specific_rule.is_more_specific_rule_of(r), rules_to_process)
+            super_rules = filter(lambda r: symbol_specific_rule.is_more_specific_rule_of(r),
+                                 rules_index.get_more_general_rules(symbol_specific_rule))
 
             # Take a look at the existing rules that are more general than the current symbol-specific rule.
             # Only generate an extra rule if there is no existing object specific rule for that section
@@ -438,13 +518,14 @@ class GenerationModel:
         sorted_rules = sorted(rules, key=lambda r: r.specificity)
 
         # Now that the rules have been sorted, loop through each rule, and then loop
-        # through rules below it (higher indeces), adding exclusions whenever appropriate.
+        # through the more specific rules nested in it, most specific first, adding exclusions
+        # whenever appropriate.
+        rules_index = PlacementRuleIndex(list(reversed(sorted_rules)))
+
         for general_rule in sorted_rules:
-            for specific_rule in reversed(sorted_rules):
-                if (specific_rule.specificity > general_rule.specificity and
-                    specific_rule.specificity != PlacementRule.SYMBOL_SPECIFICITY) or \
-                    (specific_rule.specificity == PlacementRule.SYMBOL_SPECIFICITY and
-                     general_rule.specificity == PlacementRule.OBJECT_SPECIFICITY):
+            for specific_rule in rules_index.get_more_specific_rules(general_rule):
+                if specific_rule.specificity != PlacementRule.SYMBOL_SPECIFICITY or \
+                        general_rule.specificity == PlacementRule.OBJECT_SPECIFICITY:
                     general_rule.add_exclusion(specific_rule, sections_info)
 
     def add_fragments_from_file(self, fragment_file):
@@ -594,43 +675,20 @@ class SectionsInfo(dict):
         self.sections[archive] = SectionsInfo.__info(sections_info_dump.name, sections_info_dump.read())
 
     def _get_infos_from_file(self, info):
-        # Object file line: '{object}:  file format elf32-xtensa-le'
-        object = Fragment.ENTITY.setResultsName("object") + Literal(":").suppress() + Literal("file format elf32-xtensa-le").suppress()
-
-        # Sections table
-        header = Suppress(Literal("Sections:") + Literal("Idx") + Literal("Name") + Literal("Size") + Literal("VMA") +
-                          Literal("LMA") + Literal("File off") + Literal("Algn"))
-        entry = Word(nums).suppress() + Fragment.ENTITY + Suppress(OneOrMore(Word(alphanums, exact=8)) +
-                                                                   Word(nums + "*") + ZeroOrMore(Word(alphas.upper()) +
-                                                                   Optional(Literal(","))))
-
-        # Content is object file line + sections table
-        content = Group(object + header + Group(ZeroOrMore(entry)).setResultsName("sections"))
-
-        parser = Group(ZeroOrMore(content)).setResultsName("contents")
-
-        sections_info_text = info.content
-        results = None
-
-        try:
-            results = parser.parseString(sections_info_text)
-        except ParseException as p:
-            raise ParseException("Unable to parse section info file " + info.filename + ". " + p.message)
-
-        return results
+        """
+        Returns a dict of the section names of each object file in the objdump output
+        """
+        return objects_sections(info.content, info.filename)
 
     def get_obj_sections(self, archive, obj):
         stored = self.sections[archive]
 
         # Parse the contents of the sections file
         if not isinstance(stored, dict):
-            parsed = self._get_infos_from_file(stored)
-            stored = dict()
-            for content in parsed.contents:
-                sections = list(map(lambda s: s, content.sections))
-                stored[content.object] = sections
+            stored = self._get_infos_from_file(stored)
             self.sections[archive] = stored
 
-        for obj_key in stored.keys():
-            if obj_key == obj + ".o" or obj_key == obj + ".c.obj":
-                return stored[obj_key]
+        try:
+            return stored[obj + ".o"]
+        except KeyError:
+            return stored.get(obj + ".c.obj")
@@ -16,20 +16,21 @@
 #
 
 import argparse
+import hashlib
 import json
 import sys
 import tempfile
 import subprocess
 import os
 import errno
+from multiprocessing.pool import ThreadPool
 
-from fragments import FragmentFile
-from sdkconfig import SDKConfig
-from generation import GenerationModel, TemplateModel, SectionsInfo
-from ldgen_common import LdGenFailure
-from pyparsing import ParseException, ParseFatalException
+from ldgen_common import LdGenFailure, objects_sections
 from io import StringIO
 
+# The modules parsing the fragments and the configuration (and so pyparsing and kconfiglib) are only
+# imported when the linker script needs to be generated, not when it is found up to date
+
 
 def _update_environment(args):
     env = [(name, value) for (name,value) in (e.split("=",1) for e in args.env)]
@@ -42,6 +43,259 @@ def _update_environment(args):
         os.environ.update(env)
 
 
+# Version of the --objdump-cache file format, change to discard the files of older versions
+OBJDUMP_CACHE_VERSION = 1
+
+
+def _load_objdump_cache(cache_path, objdump):
+    """ Entries of the objdump cache file for each library path, or an empty dict if there is no
+    usable cache (missing, corrupt, another version or dumped by another objdump) """
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if cache["version"] == OBJDUMP_CACHE_VERSION and cache["objdump"] == objdump:
+            return cache["libraries"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+
+def _save_json(path, contents):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(contents, f)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    os.rename(temp_path, path)
+
+
+def _save_objdump_cache(cache_path, objdump, libraries):
+    _save_json(cache_path, {"version": OBJDUMP_CACHE_VERSION, "objdump": objdump, "libraries": libraries})
+
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(0x10000), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _objdump_library(objdump_and_library):
+    objdump, library = objdump_and_library
+    return subprocess.check_output([objdump, "-h", library]).decode()
+
+
+def load_library_dumps(objdump, libraries, cache_path=None, jobs=None):
+    """ The 'objdump -h' output of each library, as a dict. The libraries are dumped by a pool of 'jobs'
+    (default: number of CPUs) objdump processes. With 'cache_path', the output for each library is kept in that
+    file with the library's mtime, size and MD5, and only libraries which changed since are dumped again. """
+    cache = _load_objdump_cache(cache_path, objdump) if cache_path else {}
+    entries = {}
+    changed = []
+    for library in libraries:
+        stat = os.stat(library)
+        entry = cache.get(library)
+        if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            entries[library] = entry
+            continue
+        md5 = _file_md5(library)
+        if entry is not None and entry["size"] == stat.st_size and entry["md5"] == md5:
+            entry["mtime"] = stat.st_mtime  # rebuilt, but the same contents
+            entries[library] = entry
+            continue
+        entries[library] = {"mtime": stat.st_mtime, "size": stat.st_size, "md5": md5, "dump": None}
+        changed.append(library)
+
+    if changed:
+        pool = ThreadPool(jobs)
+        try:
+            dumps = pool.map(_objdump_library, [(objdump, library) for library in changed])
+        finally:
+            pool.close()
+            pool.join()
+        for library, dump in zip(changed, dumps):
+            entries[library]["dump"] = dump
+
+    if cache_path and (changed or len(entries) != len(cache)):
+        _save_objdump_cache(cache_path, objdump, entries)
+
+    return dict((library, entry["dump"]) for library, entry in entries.items())
+
+
+def load_sections_infos(objdump, libraries, cache_path=None, jobs=None):
+    """ SectionsInfo of the 'objdump -h' output of each library, see load_library_dumps() """
+    return _sections_infos(libraries, load_library_dumps(objdump, libraries, cache_path, jobs))
+
+
+def _sections_infos(libraries, dumps):
+    from generation import SectionsInfo
+
+    sections_infos = SectionsInfo()
+    for library in libraries:
+        dump = StringIO(dumps[library])
+        dump.name = library
+        sections_infos.add_sections_info(dump)
+    return sections_infos
+
+
+# Version of the --manifest file format, change to regenerate the linker scripts after changes to the generation
+MANIFEST_VERSION = 2
+
+
+def _read_sdkconfig_values(sdkconfig_file, names):
+    """ Values of the config options 'names' as written in the sdkconfig file (without the CONFIG_ prefix),
+    None for the options not in the file """
+    values = dict.fromkeys(names)
+    with open(sdkconfig_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("CONFIG_") and "=" in line:
+                (name, value) = line[len("CONFIG_"):].split("=", 1)
+            elif line.startswith("# CONFIG_") and line.endswith(" is not set"):
+                (name, value) = (line[len("# CONFIG_"):-len(" is not set")], "n")
+            else:
+                continue
+            if name in values:
+                values[name] = value
+    return values
+
+
+def _library_fingerprints(args, libraries, known=(), dumps=None):
+    """ [library, mtime, size, MD5 of the section names of each of its object files] of each library. The section
+    names are the only part of a library the output depends on, so a library rebuilt with other code but the same
+    section names keeps the same fingerprint. Libraries with the same mtime and size as in the 'known' fingerprints aren't
+    dumped again, nor those in 'dumps' (the output of load_library_dumps()). """
+    known = dict((entry[0], entry) for entry in known)
+    fingerprints = []
+    changed = []
+    for library in libraries:
+        stat = os.stat(library)
+        entry = known.get(library)
+        if entry is None or entry[1:3] != [stat.st_mtime, stat.st_size]:
+            entry = [library, stat.st_mtime, stat.st_size, None]
+            changed.append(entry)
+        fingerprints.append(entry)
+
+    if changed:
+        if dumps is None:
+            # with the cache, dump all of them, so that it keeps the unchanged libraries (which it doesn't dump again)
+            dumps = load_library_dumps(args.objdump, libraries if args.objdump_cache else [e[0] for e in changed],
+                                       args.objdump_cache)
+        for entry in changed:
+            sections = sorted(objects_sections(dumps[entry[0]], entry[0]).items())
+            entry[3] = hashlib.md5(json.dumps(sections).encode()).hexdigest()
+    return fingerprints
+
+
+def _input_fingerprint(args, library_fingerprints, config_names):
+    """ Everything the output of ldgen depends on: the contents of the template, fragment files, environment
+    file and output, the values of the config options 'config_names' (the options evaluated by the fragments'
+    conditions), the section names of the libraries and the command line """
+    def file_entry(path):
+        return [path, _file_md5(path) if os.path.exists(path) else None]
+
+    return {
+        "version": MANIFEST_VERSION,
+        "input": file_entry(args.input.name),
+        "fragments": [file_entry(fragment_file.name) for fragment_file in args.fragments or []],
+        "libraries": library_fingerprints,
+        "objdump": args.objdump,
+        "kconfig": args.kconfig,
+        "env": args.env,
+        "env_file": file_entry(args.env_file.name) if args.env_file else None,
+        "config": args.config,
+        "config_values": _read_sdkconfig_values(args.config, config_names),
+        "output": file_entry(args.output),
+    }
+
+
+def _without_library_stats(fingerprint):
+    """ Copy of 'fingerprint' without the mtimes and sizes of the libraries, which only decide which
+    libraries to dump again """
+    fingerprint = dict(fingerprint)
+    fingerprint["libraries"] = [[entry[0], entry[3]] for entry in fingerprint["libraries"]]
+    return fingerprint
+
+
+def _check_manifest(manifest_path, args, libraries):
+    """ Returns whether the fingerprint of the inputs saved in the manifest file is the same as the current one,
+    and the current fingerprints of the libraries. The manifest file is updated if only the stats of
+    libraries changed, ie they were rebuilt with the same section names. """
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != MANIFEST_VERSION:
+            return False, []
+        library_fingerprints = _library_fingerprints(args, libraries, manifest["libraries"])
+        fingerprint = _input_fingerprint(args, library_fingerprints, manifest["config_values"].keys())
+        if _without_library_stats(manifest) != _without_library_stats(fingerprint):
+            return False, library_fingerprints
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError, IndexError):
+        return False, []
+    if manifest != fingerprint:
+        _save_json(manifest_path, fingerprint)
+    return True, library_fingerprints
+
+
+def _generate(args, libraries):
+    """ Generates the output linker script, returns the names of the config options evaluated on the way and
+    the objdump output of the libraries """
+    from fragments import FragmentFile
+    from sdkconfig import SDKConfig
+    from generation import GenerationModel, TemplateModel
+    from pyparsing import ParseException, ParseFatalException
+
+    input_file = args.input
+    fragment_files = [] if not args.fragments else args.fragments
+    config_file = args.config
+    output_path = args.output
+    kconfig_file = args.kconfig
+    objdump = args.objdump
+
+    dumps = load_library_dumps(objdump, libraries, args.objdump_cache)
+    sections_infos = _sections_infos(libraries, dumps)
+
+    generation_model = GenerationModel()
+
+    _update_environment(args)  # assign args.env and args.env_file to os.environ
+
+    sdkconfig = SDKConfig(kconfig_file, config_file)
+
+    for fragment_file in fragment_files:
+        try:
+            fragment_file = FragmentFile(fragment_file, sdkconfig)
+        except (ParseException, ParseFatalException) as e:
+            # ParseException is raised on incorrect grammar
+            # ParseFatalException is raised on correct grammar, but inconsistent contents (ex. duplicate
+            # keys, key unsupported by fragment, unexpected number of values, etc.)
+            raise LdGenFailure("failed to parse %s\n%s" % (fragment_file.name, str(e)))
+        generation_model.add_fragments_from_file(fragment_file)
+
+    mapping_rules = generation_model.generate_rules(sections_infos)
+
+    script_model = TemplateModel(input_file)
+    script_model.fill(mapping_rules)
+
+    with tempfile.TemporaryFile("w+") as output:
+        script_model.write(output)
+        output.seek(0)
+
+        if not os.path.exists(os.path.dirname(output_path)):
+            try:
+                os.makedirs(os.path.dirname(output_path))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+        with open(output_path, "w") as f:  # only create output file after generation has suceeded
+            f.write(output.read())
+
+    return sdkconfig.evaluated_symbols, dumps
+
+
 def main():
 
     argparser = argparse.ArgumentParser(description="ESP-IDF linker script generator")
@@ -88,61 +342,32 @@ def main():
         "--objdump",
         help="Path to toolchain objdump")
 
-    args = argparser.parse_args()
+    argparser.add_argument(
+        "--objdump-cache",
+        help="File to keep the objdump output of each library in, so only the libraries which changed are dumped again")
 
-    input_file = args.input
-    fragment_files = [] if not args.fragments else args.fragments
-    libraries_file = args.libraries_file
-    config_file = args.config
-    output_path = args.output
-    kconfig_file = args.kconfig
-    objdump = args.objdump
+    argparser.add_argument(
+        "--manifest",
+        help="File to keep the fingerprint of the inputs in, so the output is only generated again when they changed")
 
-    try:
-        sections_infos = SectionsInfo()
-        for library in libraries_file:
-            library = library.strip()
-            if library:
-                dump = StringIO(subprocess.check_output([objdump, "-h", library]).decode())
-                dump.name = library
-                sections_infos.add_sections_info(dump)
+    args = argparser.parse_args()
 
-        generation_model = GenerationModel()
+    try:
+        libraries = [library.strip() for library in args.libraries_file if library.strip()]
 
-        _update_environment(args)  # assign args.env and args.env_file to os.environ
+        if args.manifest:
+            (up_to_date, library_fingerprints) = _check_manifest(args.manifest, args, libraries)
+            if up_to_date:
+                os.utime(args.output, None)  # so that the build system sees the output as generated again
+                return
 
-        sdkconfig = SDKConfig(kconfig_file, config_file)
+        (config_names, dumps) = _generate(args, libraries)
 
-        for fragment_file in fragment_files:
-            try:
-                fragment_file = FragmentFile(fragment_file, sdkconfig)
-            except (ParseException, ParseFatalException) as e:
-                # ParseException is raised on incorrect grammar
-                # ParseFatalException is raised on correct grammar, but inconsistent contents (ex. duplicate
-                # keys, key unsupported by fragment, unexpected number of values, etc.)
-                raise LdGenFailure("failed to parse %s\n%s" % (fragment_file.name, str(e)))
-            generation_model.add_fragments_from_file(fragment_file)
-
-        mapping_rules = generation_model.generate_rules(sections_infos)
-
-        script_model = TemplateModel(input_file)
-        script_model.fill(mapping_rules)
-
-        with tempfile.TemporaryFile("w+") as output:
-            script_model.write(output)
-            output.seek(0)
-
-            if not os.path.exists(os.path.dirname(output_path)):
-                try:
-                    os.makedirs(os.path.dirname(output_path))
-                except OSError as exc:
-                    if exc.errno != errno.EEXIST:
-                        raise
-
-            with open(output_path, "w") as f:  # only create output file after generation has suceeded
-                f.write(output.read())
+        if args.manifest:
+            library_fingerprints = _library_fingerprints(args, libraries, library_fingerprints, dumps)
+            _save_json(args.manifest, _input_fingerprint(args, library_fingerprints, config_names))
     except LdGenFailure as e:
-        print("linker script generation failed for %s\nERROR: %s" % (input_file.name, e))
+        print("linker script generation failed for %s\nERROR: %s" % (args.input.name, e))
         sys.exit(1)
 
 
@@ -14,6 +14,8 @@
 # limitations under the License.
 #
 
+import re
+
 
 class LdGenFailure(RuntimeError):
     """
@@ -21,3 +23,34 @@ class LdGenFailure(RuntimeError):
     """
     def __init__(self, message):
         super(LdGenFailure, self).__init__(message)
+
+
+# Object file line: '{object}:     file format elf32-xtensa-le'
+OBJECT_LINE = re.compile(r"(?P<object>\S+):\s+file format \S+$")
+
+
+def objects_sections(dump, filename):
+    """
+    Returns a dict of the section names of each object file in the 'objdump -h' output of a library. Line by
+    line, as this is the only part of the output used: a section table entry line starts with its index, then
+    its name.
+    """
+    objects = dict()
+    sections = None
+
+    for line in dump.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+
+        m = OBJECT_LINE.match(line)
+        if m:
+            sections = objects[m.group("object")] = list()
+        elif fields[0].isdigit() and len(fields) > 2:
+            # Sections table entry: '  0 .text         00000000  00000000  00000000  00000034  2**0'
+            if sections is None:
+                raise LdGenFailure("Unable to parse section info file %s. Section %s before any object file."
+                                   % (filename, fields[1]))
+            sections.append(fields[1])
+
+    return objects
@@ -15,6 +15,7 @@
 #
 
 import os
+import re
 from pyparsing import Word, alphanums, printables, Combine, Literal, hexnums, quotedString, Optional, nums, removeQuotes, oneOf, Group, infixNotation, opAssoc
 
 import sys
@@ -50,8 +51,36 @@ class SDKConfig:
         self.config = kconfiglib.Kconfig(kconfig_file)
         self.config.load_config(sdkconfig_file)
 
+        # Names of the symbols expressions have been evaluated on
+        self.evaluated_symbols = set()
+
+        # Parsed expressions and the names of the symbols in them, by expression text
+        self.expressions = dict()
+
+    def _parse_expression(self, expression):
+        # Parses the expression the way kconfiglib.Kconfig.eval_string() does, but without evaluating it,
+        # so that it does not need to be tokenized and parsed again for each evaluation
+        self.config._filename = None
+        self.config._line = "if " + expression
+        self.config._tokenize()
+        self.config._line = expression
+        del self.config._tokens[0]
+
+        return self.config._parse_expr(True)
+
     def evaluate_expression(self, expression):
-        result = self.config.eval_string(expression)
+        try:
+            (parsed, symbols) = self.expressions[expression]
+        except KeyError:
+            parsed = self._parse_expression(expression)
+            # Tokenizing adds the undefined names (numbers as well) to syms, without menu nodes
+            symbols = set(n for n in re.findall(r"\w+", expression) if n in self.config.syms and self.config.syms[n].nodes)
+            self.expressions[expression] = (parsed, symbols)
+
+        self.evaluated_symbols.update(symbols)
+
+        # Symbol values are resolved once by kconfiglib and kept until they are set again
+        result = kconfiglib.expr_value(parsed)
 
         if result == 0:  # n
             return False
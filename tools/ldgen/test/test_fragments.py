@@ -14,7 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+
+# Set LDGEN_BENCHMARK=<number of runs> to also time parsing the linker fragment files of all the components.
+
+import os
+import re
 import sys
+import time
 import unittest
 
 from io import StringIO
@@ -978,5 +984,52 @@ entries:
                          fragment_file.fragments[1].entries)
 
 
+class SDKConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sdkconfig = SDKConfig("data/Kconfig", "data/sdkconfig")
+
+    def test_expression_cache(self):
+        self.assertTrue(self.sdkconfig.evaluate_expression("PERFORMANCE_LEVEL = 0 && A"))
+        self.assertFalse(self.sdkconfig.evaluate_expression("PERFORMANCE_LEVEL = 0 && B"))
+        self.assertTrue(self.sdkconfig.evaluate_expression("PERFORMANCE_LEVEL = 0 && A"))
+        self.assertEqual({"PERFORMANCE_LEVEL = 0 && A", "PERFORMANCE_LEVEL = 0 && B"}, set(self.sdkconfig.expressions))
+        self.assertEqual({"PERFORMANCE_LEVEL", "A", "B"}, self.sdkconfig.evaluated_symbols)
+
+        # cached expressions are evaluated on the current values
+        self.sdkconfig.config.syms["PERFORMANCE_LEVEL"].set_value("1")
+        self.assertFalse(self.sdkconfig.evaluate_expression("PERFORMANCE_LEVEL = 0 && A"))
+        self.assertTrue(self.sdkconfig.evaluate_expression("PERFORMANCE_LEVEL = 1 && A"))
+
+    @unittest.skipUnless(os.environ.get("LDGEN_BENCHMARK"), "set LDGEN_BENCHMARK=<number of runs> to run")
+    def test_benchmark(self):
+        fragment_files = []
+        for (root, dirs, files) in os.walk(os.path.join("..", "..", "..", "components")):
+            fragment_files.extend(os.path.join(root, f) for f in files if f.endswith(".lf"))
+        contents = []
+        for path in fragment_files:
+            with open(path) as f:
+                contents.append((path, f.read()))
+        conditions = re.findall(r"^\s*(?:if|elif)\s+(.*):\s*$", "".join(c for (_, c) in contents), re.MULTILINE)
+        runs = int(os.environ["LDGEN_BENCHMARK"])
+
+        # the fragments reference options not in the test Kconfig
+        self.sdkconfig.config.disable_warnings()
+
+        print("\n%d fragment files, %d conditions, %d runs" % (len(fragment_files), len(conditions), runs))
+        t = time.time()
+        for _ in range(runs):
+            for (path, text) in contents:
+                FragmentFile(FragmentTest.create_fragment_file(text.decode() if bytes is str else text, path), self.sdkconfig)
+        print("%24s: %.3f seconds" % ("FragmentFile", time.time() - t))
+        for name, evaluate in [("Kconfig.eval_string", self.sdkconfig.config.eval_string),
+                               ("SDKConfig", self.sdkconfig.evaluate_expression)]:
+            t = time.time()
+            for _ in range(runs):
+                for condition in conditions:
+                    evaluate(condition)
+            print("%24s: %.3f seconds" % (name, time.time() - t))
+
+
 if __name__ == "__main__":
     unittest.main()
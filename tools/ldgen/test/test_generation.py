@@ -15,8 +15,13 @@
 # limitations under the License.
 #
 
+# Set LDGEN_BENCHMARK=<number of object files> to also time parsing the sections of a synthetic archive.
+
 import unittest
+import os
+import re
 import sys
+import time
 
 try:
     from generation import PlacementRule
@@ -28,11 +33,14 @@ from generation import GenerationException
 from generation import SectionsInfo
 from generation import TemplateModel
 from generation import GenerationModel
+from generation import PlacementRuleIndex
 
 from fragments import FragmentFile
 
 from sdkconfig import SDKConfig
 from io import StringIO
+from pyparsing import Suppress, Literal, Group, ZeroOrMore, Word, OneOrMore, nums, alphanums, alphas, Optional
+from fragments import Fragment
 
 
 class GenerationModelTest(unittest.TestCase):
@@ -1350,5 +1358,116 @@ entries:
             self.compare_rules(expected, actual)
 
 
+def pyparsing_obj_sections(sections_info_text):
+    """ The objdump section tables parser SectionsInfo used before, as reference """
+    object = Fragment.ENTITY.setResultsName("object") + Literal(":").suppress() + Literal("file format elf32-xtensa-le").suppress()
+
+    header = Suppress(Literal("Sections:") + Literal("Idx") + Literal("Name") + Literal("Size") + Literal("VMA") +
+                      Literal("LMA") + Literal("File off") + Literal("Algn"))
+    entry = Word(nums).suppress() + Fragment.ENTITY + Suppress(OneOrMore(Word(alphanums, exact=8)) +
+                                                               Word(nums + "*") + ZeroOrMore(Word(alphas.upper()) +
+                                                               Optional(Literal(","))))
+
+    content = Group(object + header + Group(ZeroOrMore(entry)).setResultsName("sections"))
+
+    parser = Group(ZeroOrMore(content)).setResultsName("contents")
+
+    results = parser.parseString(sections_info_text)
+    return dict((content.object, list(content.sections)) for content in results.contents)
+
+
+def synthetic_sections_info(n_objects):
+    """ objdump -h output of an archive of 'n_objects' object files, made from those of data/sections.info """
+    with open("data/sections.info") as f:
+        f.readline()
+        text = f.read()
+    objects = re.split(r"\n(?=\S+:\s+file format)", text.strip("\n"))
+    lines = ["In archive libsynthetic.a:", ""]
+    for i in range(n_objects):
+        lines.append("o%d_" % i + objects[i % len(objects)])
+    return "\n".join(lines) + "\n"
+
+
+class SectionsInfoTest(unittest.TestCase):
+
+    def load(self, text):
+        sections_info = SectionsInfo()
+        dump = StringIO(text)
+        dump.name = "test"
+        sections_info.add_sections_info(dump)
+        return sections_info
+
+    def test_same_as_pyparsing(self):
+        for text in [open("data/sections.info").read(), synthetic_sections_info(100)]:
+            sections_info = self.load(text)
+            archive = list(sections_info.sections)[0]
+            info = sections_info.sections[archive]
+            parsed = sections_info._get_infos_from_file(info)
+            self.assertEqual(pyparsing_obj_sections(info.content), parsed)
+            self.assertTrue(all(parsed.values()))
+
+    def test_object_after_flags(self):
+        # the pyparsing grammar took the capital letters starting an object name as flags of the previous section
+        text = synthetic_sections_info(2).replace("o1_croutine", "Croutine")
+        sections_info = self.load(text)
+        self.assertIn(".text.xCoRoutineCreate", sections_info.get_obj_sections("libsynthetic.a", "Croutine"))
+
+    def test_get_obj_sections(self):
+        sections_info = self.load(open("data/sections.info").read())
+        sections = sections_info.get_obj_sections("libfreertos.a", "croutine")
+        self.assertIn(".text.xCoRoutineCreate", sections)
+        self.assertIs(sections, sections_info.get_obj_sections("libfreertos.a", "croutine"))
+        self.assertIsNone(sections_info.get_obj_sections("libfreertos.a", "nonexistent"))
+
+        sections_info = self.load(synthetic_sections_info(30).replace("o18_croutine.c.obj:", "o18_croutine.o:"))
+        self.assertEqual(sections, sections_info.get_obj_sections("libsynthetic.a", "o18_croutine"))
+        self.assertEqual(sections, sections_info.get_obj_sections("libsynthetic.a", "o1_croutine"))
+
+    @unittest.skipUnless(os.environ.get("LDGEN_BENCHMARK"), "set LDGEN_BENCHMARK=<number of object files> to run")
+    def test_benchmark(self):
+        text = synthetic_sections_info(int(os.environ["LDGEN_BENCHMARK"]))
+        sections_info = self.load(text)
+        info = sections_info.sections["libsynthetic.a"]
+        print("\n%d lines of objdump output" % len(text.splitlines()))
+        for name, parse in [("pyparsing", lambda: pyparsing_obj_sections(info.content)),
+                            ("SectionsInfo", lambda: sections_info._get_infos_from_file(info))]:
+            t = time.time()
+            parse()
+            print("%16s: %.3f seconds" % (name, time.time() - t))
+
+
+class PlacementRuleIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = [PlacementRule(None, None, None, [".text"], "flash_text")]
+        for archive in ["liba.a", "libb.a", "*"]:
+            self.rules.append(PlacementRule(archive, "*", None, [".text"], "iram0_text"))
+            for obj in ["x", "y"]:
+                self.rules.append(PlacementRule(archive, obj, None, [".text"], "iram0_text"))
+                self.rules.append(PlacementRule(archive, obj, None, [".text"], "rtc_text"))
+                for symbol in ["f", "g"]:
+                    self.rules.append(PlacementRule(archive, obj, symbol, [".text"], "iram0_text"))
+            self.rules.append(PlacementRule(archive, "*", "f", [".text"], "iram0_text"))
+        self.index = PlacementRuleIndex(self.rules)
+
+    def test_more_specific_rules(self):
+        for rule in self.rules:
+            expected = [id(r) for r in self.rules if r.is_more_specific_rule_of(rule)]
+            found = self.index.get_more_specific_rules(rule)
+            self.assertEqual(expected, [id(r) for r in found if r.is_more_specific_rule_of(rule)])
+
+    def test_more_general_rules(self):
+        for rule in self.rules:
+            expected = [id(r) for r in self.rules if rule.is_more_specific_rule_of(r)]
+            found = self.index.get_more_general_rules(rule)
+            self.assertEqual(expected, [id(r) for r in found if rule.is_more_specific_rule_of(r)])
+
+    def test_same_entities_rules(self):
+        for (position, rule) in enumerate(self.rules):
+            expected = [id(r) for r in self.rules[position + 1:] if rule.maps_same_entities_as(r)]
+            found = self.index.get_same_entities_rules(rule)
+            self.assertEqual(expected, [id(r) for r in found if rule.maps_same_entities_as(r)])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import ldgen
+except ImportError:
+    sys.path.append('../')
+    import ldgen
+
+# Stands in for objdump: logs the library it was run for, and prints the section headers of
+# data/sections.info as if they were in that library. A library whose contents start with "." has
+# them as the name of another section of the last object file.
+FAKE_OBJDUMP = """#!%s
+import sys
+with open(%r, "a") as log:
+    log.write(sys.argv[2] + "\\n")
+with open(%r) as f:
+    f.readline()
+    sys.stdout.write("In archive " + sys.argv[2] + ":\\n" + f.read())
+with open(sys.argv[2]) as f:
+    contents = f.read()
+if contents.startswith("."):
+    sys.stdout.write("999 %%s 00000000  00000000  00000000  00000034  2**0\\n" %% contents)
+"""
+
+
+class FakeObjdumpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.log = os.path.join(self.tempdir, "objdump.log")
+        self.objdump = os.path.join(self.tempdir, "objdump")
+        with open(self.objdump, "w") as f:
+            f.write(FAKE_OBJDUMP % (sys.executable, self.log, os.path.abspath("data/sections.info")))
+        os.chmod(self.objdump, stat.S_IRWXU)
+        self.libraries = []
+
+    def write_library(self, i, contents):
+        with open(self.libraries[i], "wb") as f:
+            f.write(contents)
+
+
+class LoadSectionsInfosTest(FakeObjdumpTestCase):
+
+    def setUp(self):
+        super(LoadSectionsInfosTest, self).setUp()
+        for i in range(8):
+            self.libraries.append(os.path.join(self.tempdir, "lib%d.a" % i))
+            self.write_library(i, b"contents")
+        self.cache = os.path.join(self.tempdir, "objdump_cache")
+
+    def load(self, cache=True):
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        sections_infos = ldgen.load_sections_infos(self.objdump, self.libraries, self.cache if cache else None, jobs=4)
+        dumped = []
+        if os.path.exists(self.log):
+            with open(self.log) as f:
+                dumped = sorted(f.read().split())
+        return sections_infos, dumped
+
+    def test_without_cache(self):
+        sections_infos, dumped = self.load(cache=False)
+        self.assertEqual(sorted(self.libraries), dumped)
+        self.assertEqual(["lib%d.a" % i for i in range(8)], sorted(sections_infos.sections))
+        self.assertIn(".text.xCoRoutineCreate", sections_infos.get_obj_sections("lib3.a", "croutine"))
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_cache(self):
+        sections_infos, dumped = self.load()
+        self.assertEqual(sorted(self.libraries), dumped)
+        sections_infos, dumped = self.load()
+        self.assertEqual([], dumped)
+        self.assertIn(".text.xCoRoutineCreate", sections_infos.get_obj_sections("lib3.a", "croutine"))
+
+        # rebuilt with the same contents
+        self.write_library(1, b"contents")
+        os.utime(self.libraries[1], (0, 0))
+        # changed, with the same size
+        self.write_library(2, b"CONTENTS")
+        os.utime(self.libraries[2], (0, 0))
+        self.assertEqual([self.libraries[2]], self.load()[1])
+        self.assertEqual([], self.load()[1])
+
+        # a library which isn't built any more is dropped from the cache, a new one added
+        del self.libraries[5]
+        self.libraries.append(os.path.join(self.tempdir, "new.a"))
+        self.write_library(-1, b"new")
+        self.assertEqual([self.libraries[-1]], self.load()[1])
+        self.assertNotIn(os.path.join(self.tempdir, "lib5.a"), ldgen._load_objdump_cache(self.cache, self.objdump))
+
+    def test_bad_cache(self):
+        self.load()
+        self.assertEqual({}, ldgen._load_objdump_cache(self.cache, "other-objdump"))
+        with open(self.cache, "w") as f:
+            f.write("{")
+        self.assertEqual(sorted(self.libraries), self.load()[1])
+        self.assertEqual([], self.load()[1])
+
+
+# Runs ldgen, and prints which of the modules it only needs to generate the output were imported
+RUN_LDGEN = """import sys
+sys.path.insert(0, %r)
+import ldgen
+sys.argv = ["ldgen.py"] + sys.argv[1:]
+ldgen.main()
+sys.stdout.write(" ".join(m for m in ("pyparsing", "kconfiglib") if m in sys.modules))
+""" % os.path.abspath("..")
+
+FRAGMENT = """
+[mapping:test]
+archive: libfreertos.a
+entries:
+    if PERFORMANCE_LEVEL = 1:
+        croutine (noflash)
+    else:
+        * (default)
+"""
+
+
+class ManifestTest(FakeObjdumpTestCase):
+
+    def setUp(self):
+        super(ManifestTest, self).setUp()
+        self.libraries = [os.path.join(self.tempdir, "libfreertos.a")]
+        self.write_library(0, b"contents")
+        with open(os.path.join(self.tempdir, "libraries"), "w") as f:
+            f.write(self.libraries[0] + "\n")
+        with open(os.path.join(self.tempdir, "test.lf"), "w") as f:
+            f.write(FRAGMENT)
+        shutil.copy("data/sdkconfig", os.path.join(self.tempdir, "sdkconfig"))
+        self.output = os.path.join(self.tempdir, "out", "template.ld")
+        self.extra_args = []
+
+    def set_config(self, name, value):
+        config = os.path.join(self.tempdir, "sdkconfig")
+        with open(config) as f:
+            lines = [line for line in f if not line.startswith("CONFIG_%s=" % name)]
+        with open(config, "w") as f:
+            f.writelines(lines + ["\nCONFIG_%s=%s\n" % (name, value)])
+
+    def run_ldgen(self):
+        """ Runs ldgen, returns whether it generated the output (and so imported the modules for that).
+        The libraries it dumped are in self.dumped. """
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        imported = subprocess.check_output([sys.executable, "-c", RUN_LDGEN,
+                                            "--input", "data/template.ld",
+                                            "--fragments", "data/sample.lf", os.path.join(self.tempdir, "test.lf"),
+                                            "--libraries-file", os.path.join(self.tempdir, "libraries"),
+                                            "--output", self.output,
+                                            "--config", os.path.join(self.tempdir, "sdkconfig"),
+                                            "--kconfig", "data/Kconfig",
+                                            "--objdump", self.objdump,
+                                            "--manifest", os.path.join(self.tempdir, "manifest")] + self.extra_args)
+        self.dumped = []
+        if os.path.exists(self.log):
+            with open(self.log) as f:
+                self.dumped = f.read().split()
+        return bool(imported.split())
+
+    def output_contents(self):
+        with open(self.output) as f:
+            return f.read()
+
+    def test_manifest(self):
+        self.assertTrue(self.run_ldgen())
+        output = self.output_contents()
+        self.assertNotIn("croutine", output)
+        self.assertFalse(self.run_ldgen())
+        self.assertEqual(output, self.output_contents())
+
+        # options not evaluated by the fragments don't matter
+        self.set_config("TEST_POSITIVE_INT", "111")
+        self.assertFalse(self.run_ldgen())
+
+        self.set_config("PERFORMANCE_LEVEL", "1")
+        self.assertTrue(self.run_ldgen())
+        self.assertIn("croutine", self.output_contents())
+        self.assertFalse(self.run_ldgen())
+
+        self.write_library(0, b".text.added")
+        self.assertTrue(self.run_ldgen())
+        self.assertFalse(self.run_ldgen())
+        self.assertEqual([], self.dumped)
+
+        with open(os.path.join(self.tempdir, "test.lf"), "a") as f:
+            f.write("\n")
+        self.assertTrue(self.run_ldgen())
+
+        output = self.output_contents()
+        os.remove(self.output)
+        self.assertTrue(self.run_ldgen())
+        self.assertEqual(output, self.output_contents())
+
+    def test_rebuilt_library(self):
+        self.assertTrue(self.run_ldgen())
+        self.assertEqual(self.libraries, self.dumped)
+
+        # rebuilt with other code, but the same section names
+        self.write_library(0, b"rebuilt")
+        os.utime(self.libraries[0], (0, 0))
+        self.assertFalse(self.run_ldgen())
+        self.assertEqual(self.libraries, self.dumped)
+        # the manifest has the library's new stats
+        self.assertFalse(self.run_ldgen())
+        self.assertEqual([], self.dumped)
+
+        self.write_library(0, b".text.added")
+        self.assertTrue(self.run_ldgen())
+
+
+class ManifestObjdumpCacheTest(ManifestTest):
+    """ ManifestTest with --objdump-cache, as the build runs ldgen """
+
+    def setUp(self):
+        super(ManifestObjdumpCacheTest, self).setUp()
+        self.extra_args = ["--objdump-cache", os.path.join(self.tempdir, "objdump_cache")]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import serial
+
+import idf_monitor
+
+IDF_MONITOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "idf_monitor.py")
+
+# Stands in for addr2line, resolving addresses ending in 0 as a function with an inlined call
+# and appending every address it is asked for to <ELF file>.log
+FAKE_ADDR2LINE = """#!{python}
+import sys
+elf_file = sys.argv[sys.argv.index("-e") + 1]
+with open(elf_file + ".log", "a") as log:
+    log.write("start\\n")
+for line in iter(sys.stdin.readline, ""):
+    address = int(line, 16)
+    with open(elf_file + ".log", "a") as log:
+        log.write("0x%x\\n" % address)
+    if address % 16 == 0:
+        sys.stdout.write("0x%08x: func_%x at main.c:%d\\n (inlined by) caller at main.c:1\\n" % (address, address, address % 1000))
+    else:
+        sys.stdout.write("0x%08x: ?? ??:0\\n" % address)
+    sys.stdout.flush()
+"""
+
+
+class LineMatcherTests(unittest.TestCase):
+
+    def test_print_everything(self):
+        for print_filter in ["", "*", "*:V", "wifi:V *:V"]:
+            matcher = idf_monitor.LineMatcher(print_filter)
+            self.assertTrue(matcher._pass_all)
+            self.assertTrue(matcher.match(b"E (1) wifi: error"))
+            self.assertTrue(matcher.match(b"\xff not even text"))
+
+    def test_levels(self):
+        matcher = idf_monitor.LineMatcher("wifi:W main *:E")
+        self.assertFalse(matcher._pass_all)
+        self.assertTrue(matcher.match(b"\033[0;33mW (123) wifi: warning"))
+        self.assertFalse(matcher.match(b"I (123) wifi: info"))
+        self.assertTrue(matcher.match(b"V (123) main: verbose"))
+        self.assertTrue(matcher.match(b"E (123) other: error"))
+        self.assertFalse(matcher.match(b"W (123) other: warning"))
+        self.assertTrue(matcher.match(b"not a log line"))
+        self.assertTrue(matcher.match("W (123) wifi: as str"))
+        self.assertEqual({(b"W", b"wifi"): True, (b"I", b"wifi"): False, (b"V", b"main"): True,
+                          (b"E", b"other"): True, (b"W", b"other"): False}, matcher._decisions)
+        self.assertFalse(idf_monitor.LineMatcher("*:N").match(b"not a log line"))
+
+    def test_message_filter(self):
+        matcher = idf_monitor.LineMatcher("", br"disconnect|reason=\d+")
+        self.assertTrue(matcher.match(b"W (123) wifi: disconnected"))
+        self.assertTrue(matcher.match(b"I (123) wifi: reason=8"))
+        self.assertFalse(matcher.match(b"I (123) wifi: connected"))
+        self.assertFalse(matcher.match(b"I (123) disconnect: the tag isn't the message"))
+        self.assertTrue(matcher.match(b"plain line, disconnect"))
+
+    def test_regex_argument(self):
+        pattern = u"d\u00e9connect\u00e9".encode("utf-8")
+        self.assertEqual(pattern, idf_monitor.regex_argument(pattern))
+        if sys.version_info[0] >= 3 and sys.getfilesystemencoding().lower().replace("-", "") == "utf8":
+            self.assertEqual(pattern, idf_monitor.regex_argument(u"d\u00e9connect\u00e9"))
+
+    def test_rate_limit(self):
+        now = [100.0]
+        monotonic = idf_monitor.monotonic
+        idf_monitor.monotonic = lambda: now[0]
+        try:
+            matcher = idf_monitor.LineMatcher("", rate_limit="wifi:2 *:5")
+            self.assertEqual([True, True, False], [matcher.match(b"I (1) wifi: x") for _ in range(3)])
+            self.assertEqual(5, sum(matcher.match(b"I (1) other: x") for _ in range(10)))
+            self.assertEqual(5, sum(matcher.match(b"I (1) another: x") for _ in range(10)))
+            self.assertTrue(matcher.match(b"not a log line"))
+            now[0] += 0.5
+            self.assertEqual([True, False], [matcher.match(b"I (1) wifi: x") for _ in range(2)])
+            now[0] += 10
+            self.assertEqual([True, True, False], [matcher.match(b"I (1) wifi: x") for _ in range(3)])
+        finally:
+            idf_monitor.monotonic = monotonic
+
+    def test_bad_filters(self):
+        for print_filter in ["wifi:X", ":W", "a:b:c"]:
+            with self.assertRaises(ValueError):
+                idf_monitor.LineMatcher(print_filter)
+        for rate_limit in ["wifi", "wifi:x", "wifi:0", ":3"]:
+            with self.assertRaises(ValueError):
+                idf_monitor.LineMatcher("", rate_limit=rate_limit)
+
+
+class Addr2LineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        tool = os.path.join(self.tempdir, "fake-addr2line")
+        with open(tool, "w") as f:
+            f.write(FAKE_ADDR2LINE.format(python=sys.executable))
+        os.chmod(tool, os.stat(tool).st_mode | stat.S_IEXEC)
+        self.elf_file = os.path.join(self.tempdir, "app.elf")
+        open(self.elf_file, "w").close()
+        self.addr2line = idf_monitor.Addr2Line(self.elf_file, os.path.join(self.tempdir, "fake-"))
+        self.addCleanup(self.addr2line.close)
+
+    def requests(self):
+        """ Returns the addresses addr2line was asked for, with 'start' when it was started """
+        with open(self.elf_file + ".log") as f:
+            return f.read().split()
+
+    def test_backtrace(self):
+        backtrace = ["0x%08x" % (0x40080000 + i * 0x10) for i in range(30)]
+        t = time.time()
+        result = self.addr2line.lookup(backtrace + ["0x40080001"])
+        self.assertEqual(31, len(result))
+        self.assertEqual("0x40080010: func_40080010 at main.c:128\n (inlined by) caller at main.c:1\n", result["0x40080010"])
+        self.assertIsNone(result["0x40080001"])
+        # one addr2line process looked everything up at once
+        self.assertEqual(["start"] + [hex(int(a, 16)) for a in backtrace] + ["0x40080001", "0x0"], self.requests())
+
+        self.assertEqual(result, self.addr2line.lookup(backtrace + ["0x40080001"]))
+        self.assertEqual(33, len(self.requests()))  # all cached
+        self.assertLess(time.time() - t, 5)
+
+    def test_cache_eviction(self):
+        self.addr2line.CACHE_SIZE = 2
+        self.addr2line.lookup(["0x40080000", "0x40080010"])
+        self.addr2line.lookup(["0x40080000"])  # now most recently used
+        self.addr2line.lookup(["0x40080020"])
+        self.addr2line.lookup(["0x40080000", "0x40080010"])
+        self.assertEqual(["start", "0x40080000", "0x40080010", "0x0", "0x40080020", "0x0", "0x40080010", "0x0"], self.requests())
+
+    def test_elf_file_changed(self):
+        self.addr2line.lookup(["0x40080000"])
+        mtime = os.path.getmtime(self.elf_file) + 10
+        os.utime(self.elf_file, (mtime, mtime))
+        self.addr2line.lookup(["0x40080000"])
+        self.assertEqual(["start", "0x40080000", "0x0", "start", "0x40080000", "0x0"], self.requests())
+
+    def test_no_addr2line(self):
+        addr2line = idf_monitor.Addr2Line(self.elf_file, os.path.join(self.tempdir, "missing-"))
+        with self.assertRaises(OSError):
+            addr2line.lookup(["0x40080000"])
+
+
+class CaptureTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.prefix = os.path.join(self.tempdir, "soak")
+
+    def capture(self, start_time=1000, hours=3):
+        """ Capture one log line a second, alternating between tags and levels, split into
+        chunks like serial data. Returns the data and the lines expected from each tag. """
+        capture = idf_monitor.LogCapture(self.prefix)
+        capture.BLOCK_RECORDS = 100
+        expected = {}
+        data = []
+        for second in range(hours * 3600):
+            tag, level = [("wifi", "I"), ("wifi", "E"), ("main", "W"), ("main", "D")][second % 4]
+            line = "\033[0;31m%s (%d) %s: event %d\033[0m" % (level, second * 1000, tag, second)
+            if second % 10 == 0:
+                data.append(b"boot noise %d\r\n" % second)
+                capture.write(data[-1], start_time + second)
+            data.append(line.encode() + b"\r\n")
+            expected.setdefault(tag, []).append((float(start_time + second), level, tag, second * 1000, line.encode()))
+            capture.write(data[-1][:7], start_time + second)
+            capture.write(data[-1][7:], start_time + second)
+        capture.close()
+        return b"".join(data), expected
+
+    def test_capture(self):
+        data, expected = self.capture()
+        with open(self.prefix + ".log", "rb") as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(expected["wifi"], list(idf_monitor.query_capture(self.prefix, tag="wifi")))
+        all_lines = sorted(expected["wifi"] + expected["main"])
+        self.assertEqual(all_lines, list(idf_monitor.query_capture(self.prefix)))
+        self.assertEqual([r for r in all_lines if r[1] in "EW"], list(idf_monitor.query_capture(self.prefix, "W")))
+        self.assertEqual([r for r in expected["wifi"] if r[1] == "E" and 2000 <= r[0] <= 2100],
+                         list(idf_monitor.query_capture(self.prefix, "e", "wifi", 2000, 2100)))
+        self.assertEqual([], list(idf_monitor.query_capture(self.prefix, "E", "main")))
+        self.assertEqual([], list(idf_monitor.query_capture(self.prefix, tag="other")))
+
+    def test_reads_only_matching_blocks(self):
+        self.capture()
+        reads = []
+        records_open = idf_monitor.open
+
+        def open_counting_reads(name, mode="r"):
+            f = records_open(name, mode)
+            if name.endswith(".records"):
+                read = f.read
+                f.read = lambda size=-1: reads.append(read(size)) or reads[-1]
+            return f
+        idf_monitor.open = open_counting_reads
+        try:
+            lines = list(idf_monitor.query_capture(self.prefix, "E", "wifi", since=1000 + 3 * 3600 - 60))
+        finally:
+            idf_monitor.open = records_open
+        self.assertEqual(15, len(lines))
+        self.assertLessEqual(sum(len(r) for r in reads), 2 * os.path.getsize(self.prefix + ".records") // 100)
+
+    def test_append_and_unindexed_records(self):
+        self.capture(hours=1)
+        capture = idf_monitor.LogCapture(self.prefix)
+        capture.write(b"E (1) wifi: after restart\nI (2) wifi: no end of line", 99999)
+        # not closed, so the last block isn't in the index yet
+        capture._records.flush()
+        capture._log.flush()
+        lines = list(idf_monitor.query_capture(self.prefix, "E", "wifi", since=99999))
+        self.assertEqual([(99999.0, "E", "wifi", 1, b"E (1) wifi: after restart")], lines)
+        capture.close()
+        lines = list(idf_monitor.query_capture(self.prefix, tag="wifi", since=99999))
+        self.assertEqual(b"I (2) wifi: no end of line", lines[-1][-1])
+
+    def test_query_command(self):
+        self.capture(start_time=time.time() - 3600, hours=1)
+        output = subprocess.check_output([sys.executable, os.path.join(os.path.dirname(IDF_MONITOR), "idf_log_query.py"),
+                                          self.prefix, "--level", "E", "--tag", "wifi", "--since", "2h"])
+        lines = output.decode().splitlines()
+        self.assertEqual(900, len(lines))
+        self.assertTrue(all(" wifi: event " in line and "\033[0;31mE (" in line for line in lines))
+
+
+class HeadlessTests(unittest.TestCase):
+    """ Runs a HeadlessMonitor in a thread, with socket:// ports and the test as the devices """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.elf_file = os.path.join(self.tempdir, "app.elf")
+        open(self.elf_file, "w").close()
+        tool = os.path.join(self.tempdir, "fake-addr2line")
+        with open(tool, "w") as f:
+            f.write(FAKE_ADDR2LINE.format(python=sys.executable))
+        os.chmod(tool, os.stat(tool).st_mode | stat.S_IEXEC)
+        self.output = io.BytesIO()
+
+    def start(self, n_ports, print_filter="", capture=False, extra_ports=()):
+        servers = []
+        ports = []
+        for i in range(n_ports):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.addCleanup(server.close)
+            server.bind(("localhost", 0))
+            server.listen(1)
+            servers.append(server)
+            serial_instance = serial.serial_for_url("socket://localhost:%d" % server.getsockname()[1], do_not_open=True)
+            ports.append(idf_monitor.HeadlessPort(serial_instance, "dev%d" % i, idf_monitor.LineMatcher(print_filter),
+                                                  os.path.join(self.tempdir, "dev%d" % i) if capture else None))
+        ports += extra_ports
+        self.monitor = idf_monitor.HeadlessMonitor(ports, self.elf_file, os.path.join(self.tempdir, "fake-"), self.output)
+        self.threads = threading.active_count()
+        self.thread = threading.Thread(target=self.monitor.main_loop)
+        self.thread.start()
+        self.addCleanup(self.thread.join, 10)
+        devices = []
+        for server in servers:
+            server.settimeout(10)
+            device, _ = server.accept()
+            self.addCleanup(device.close)
+            devices.append(device)
+        # opening a socket:// port discards anything already received
+        deadline = time.time() + 10
+        while len(self.monitor._selectable) < n_ports and time.time() < deadline:
+            time.sleep(0.01)
+        return devices
+
+    def stop(self, devices):
+        for device in devices:
+            device.sendall(b"\n\x1d\n")  # see HeadlessPort._filter
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        return self.output.getvalue().splitlines()
+
+    def test_many_ports(self):
+        devices = self.start(20, print_filter="*:I", capture=True)
+        self.assertEqual(self.threads + 1, threading.active_count())  # just the monitor's thread, for every port
+        for n in range(50):
+            for i, device in enumerate(devices):
+                device.sendall(b"I (%d) main: line %d from device %d\nD (%d) main: filtered\n" % (n, n, i, n))
+        lines = self.stop(devices)
+        self.assertEqual(20 * 50, len(lines))
+        for i in range(20):
+            self.assertEqual([b"[dev%d] I (%d) main: line %d from device %d" % (i, n, n, i) for n in range(50)],
+                             [line for line in lines if line.startswith(b"[dev%d] " % i)])
+            # the filtered lines were still captured
+            self.assertEqual(100, len(list(idf_monitor.query_capture(os.path.join(self.tempdir, "dev%d" % i), "D"))))
+
+    def test_partial_line_and_addresses(self):
+        device, = self.start(1)
+        device.sendall(b"Backtrace: 0x40080010:0x3ffb0000 0x40080001:0x3ffb0010\nno end of line")
+        deadline = time.time() + 5
+        while b"no end of line" not in self.output.getvalue() and time.time() < deadline:
+            time.sleep(0.05)
+        device.sendall(b", the rest\n")
+        self.assertEqual([b"[dev0] Backtrace: 0x40080010:0x3ffb0000 0x40080001:0x3ffb0010",
+                          b"[dev0] \033[0;33m0x40080010: func_40080010 at main.c:128\033[0m",
+                          b"[dev0] \033[0;33m (inlined by) caller at main.c:1\033[0m",
+                          b"[dev0] no end of line",
+                          b"[dev0] , the rest"], self.stop([device]))
+
+    def test_polled_and_failed_ports(self):
+        loop = serial.serial_for_url("loop://", do_not_open=True)
+        polled = idf_monitor.HeadlessPort(loop, "loop", idf_monitor.LineMatcher(""))
+        polled._check_exit = True
+        missing = idf_monitor.HeadlessPort(serial.serial_for_url(os.path.join(self.tempdir, "no-such-port"), do_not_open=True),
+                                           "missing", idf_monitor.LineMatcher(""))
+        device, = self.start(1, extra_ports=[polled, missing])
+        deadline = time.time() + 5
+        while polled not in self.monitor._polled and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertNotIn(missing, self.monitor._selectable + self.monitor._polled)
+        loop.write(b"looped back\n\x1d\n")
+        device.sendall(b"from the socket\n")
+        self.assertEqual([b"[dev0] from the socket", b"[loop] looped back"], sorted(self.stop([device])))
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs a pty for the monitor's console")
+class SocketPortTests(unittest.TestCase):
+    """ Runs idf_monitor.py with a socket:// port, with the test as the device """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        elf_file = os.path.join(self.tempdir, "app.elf")
+        open(elf_file, "w").close()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(("localhost", 0))
+        server.listen(1)
+        # the monitor's console needs a terminal for stdin, even though it isn't used in socket mode
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.output_path = os.path.join(self.tempdir, "output")
+        with open(self.output_path, "wb") as output, open(os.devnull, "wb") as devnull:
+            self.monitor = subprocess.Popen([sys.executable, IDF_MONITOR, "--port", "socket://localhost:%d" % server.getsockname()[1],
+                                             "--toolchain-prefix", os.path.join(self.tempdir, "none-"), elf_file],
+                                            stdin=slave, stdout=output, stderr=devnull)
+        os.close(slave)
+        self.addCleanup(self.monitor.wait)
+        self.addCleanup(self.monitor.kill)
+        server.settimeout(30)
+        self.device, _ = server.accept()
+        self.addCleanup(self.device.close)
+        # the monitor discards anything received before it has finished opening the port
+        self.output_start = 0
+        deadline = time.time() + 10
+        while b"ready\n" not in self.output() and time.time() < deadline:
+            self.device.sendall(b"ready\n")
+            time.sleep(0.1)
+        self.output_start = len(self.output())
+
+    def output(self):
+        with open(self.output_path, "rb") as f:
+            f.seek(self.output_start)
+            return f.read()
+
+    def stop_monitor(self):
+        self.device.sendall(b"\n\x1d\n")  # see Monitor._serial_check_exit
+        self.assertEqual(0, self.monitor.wait())
+
+    def test_partial_line(self):
+        self.device.sendall(b"first line\nno end of line")
+        deadline = time.time() + 5
+        while b"no end of line" not in self.output() and time.time() < deadline:
+            time.sleep(0.05)
+        # printed once nothing more arrived for LAST_LINE_TIMEOUT
+        self.assertEqual(b"first line\nno end of line", self.output())
+
+    def test_throughput(self):
+        line = b"I (1234) wifi: some log line of a typical length, with a counter %08d\n"
+        data = b"".join(line % i for i in range(5000))
+        t = time.time()
+        self.device.sendall(data)
+        self.stop_monitor()
+        t = time.time() - t
+        print("\n%d KB through the monitor in %.2f seconds (%.0f KB/s)" % (len(data) // 1024, t, len(data) / 1024 / t),
+              file=sys.stderr)
+        self.assertEqual(data, self.output())
+
+
+if __name__ == "__main__":
+    unittest.main()
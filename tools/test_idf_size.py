@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Espressif Systems (Shanghai) PTE LTD
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Set IDF_SIZE_BENCHMARK=<size in MB> to also time parsing a synthetic map file of that size.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import idf_size
+
+MAP_HEADER = """Archive member included to satisfy reference by file (symbol)
+
+/build/esp8266/libesp8266.a(startup.o)
+                              (call_user_start)
+
+Memory Configuration
+
+Name             Origin             Length             Attributes
+iram0_0_seg      0x0000000040100000 0x000000000000c000 xr
+iram0_2_seg      0x0000000040201010 0x00000000000f0000 xr
+dram0_0_seg      0x000000003ffe8000 0x0000000000018000 rw
+*default*        0x0000000000000000 0xffffffffffffffff
+
+Linker script and memory map
+
+LOAD /build/esp8266/libesp8266.a
+START GROUP
+LOAD /build/main/libmain.a
+END GROUP
+"""
+
+SECTIONS = [".iram0.vectors", ".iram0.text", ".dram0.data", ".dram0.bss", ".flash.text", ".flash.rodata"]
+
+SAMPLE_MAP = MAP_HEADER + """
+.iram0.vectors  0x0000000040100000       0xa4
+                0x0000000040100000                _init_start = ABSOLUTE (.)
+ *(.iram1 .iram1.*)
+ .iram1.literal
+                0x0000000040100000       0x24 /build/esp8266/libesp8266.a(startup.o)
+ .iram1         0x0000000040100024       0x80 /build/esp8266/libesp8266.a(startup.o)
+                0x0000000040100024                call_user_start
+
+.dram0.data     0x000000003ffe8000       0x14
+ .data.counter  0x000000003ffe8000        0x4 /build/CMakeFiles/app.elf.dir/project_elf_src.c.obj
+ *fill*         0x000000003ffe8004        0xc
+ .data          0x000000003ffe8010        0x4 /build/main/libmain.a(main.o)
+
+.flash.text     0x0000000040201010       0x10
+ .text.app_main_with_a_very_long_name
+                0x0000000040201010       0x10 /build/main/libmain.a(main.o)
+                0x0000000040201010                app_main_with_a_very_long_name
+"""
+
+
+def write_map(f, n_objects, seed=0):
+    """ Write a synthetic map file with 'n_objects' object files, each contributing one input section to each
+    output section. Returns the expected Source records in each section. """
+    rand = random.Random(seed)
+    f.write(MAP_HEADER)
+    expected = {}
+    for i, name in enumerate(SECTIONS):
+        address = 0x40000000 + i * 0x1000000
+        sources = []
+        for n in range(n_objects):
+            archive = "lib%d.a" % (n % 97)
+            object_file = "obj%d.%s" % (n, "obj" if n % 5 == 0 else "o")
+            sources.append(idf_size.Source("%s.sym%d" % (name, n), address, rand.randint(0, 0x800),
+                                           archive, object_file, "%s:%s" % (archive, object_file)))
+            address += sources[-1].size
+        expected[name] = sources
+        f.write("\n%-15s 0x%016x %10s\n" % (name, sources[0].address, "0x%x" % (address - sources[0].address)))
+        f.write(" *(%s %s.*)\n" % (name, name))
+        for n, s in enumerate(sources):
+            path = "/build/components/%s/%s(%s)" % (s.archive[3:-2], s.archive, s.object_file)
+            if n % 3 == 0:  # long input section names go on their own line
+                f.write(" %s\n                0x%016x %10s %s\n" % (s.sym_name, s.address, "0x%x" % s.size, path))
+            else:
+                f.write(" %-14s 0x%016x %10s %s\n" % (s.sym_name, s.address, "0x%x" % s.size, path))
+            f.write("                0x%016x                %s\n" % (s.address, s.sym_name.split(".")[-1]))
+            if n % 7 == 0:
+                f.write(" *fill*         0x%016x        0x%x \n" % (s.address + s.size, 3))
+    return expected
+
+
+class LoadMapTests(unittest.TestCase):
+
+    def test_sample_map(self):
+        memory_config, sections = idf_size.load_map_data(io.StringIO(SAMPLE_MAP))
+        self.assertEqual(["dram0_0_seg", "iram0_0_seg", "iram0_2_seg"], sorted(memory_config))
+        self.assertEqual(0x18000, memory_config["dram0_0_seg"]["length"])
+        self.assertEqual([".dram0.data", ".flash.text", ".iram0.vectors"], sorted(sections))
+        self.assertEqual(0xa4, sections[".iram0.vectors"]["size"])
+        self.assertEqual([idf_size.Source(".iram1.literal", 0x40100000, 0x24, "libesp8266.a", "startup.o", "libesp8266.a:startup.o"),
+                          idf_size.Source(".iram1", 0x40100024, 0x80, "libesp8266.a", "startup.o", "libesp8266.a:startup.o")],
+                         sections[".iram0.vectors"]["sources"])
+        self.assertEqual([idf_size.Source(".data.counter", 0x3ffe8000, 4, "(exe)", "project_elf_src.c.obj", "(exe):project_elf_src.c.obj"),
+                          idf_size.Source(".data", 0x3ffe8010, 4, "libmain.a", "main.o", "libmain.a:main.o")],
+                         sections[".dram0.data"]["sources"])
+        self.assertEqual(".text.app_main_with_a_very_long_name", sections[".flash.text"]["sources"][0].sym_name)
+
+    def test_synthetic_map(self):
+        f = io.StringIO()
+        expected = write_map(f, 500)
+        f.seek(0)
+        memory_config, sections = idf_size.load_map_data(f)
+        self.assertEqual(sorted(SECTIONS), sorted(sections))
+        for name in SECTIONS:
+            self.assertEqual(expected[name], sections[name]["sources"])
+        sizes = idf_size.sizes_by_key(sections, "archive")
+        self.assertEqual(97, len(sizes))
+        self.assertEqual(sum(s.size for s in expected[".flash.text"]), sum(v[".flash.text"] for v in sizes.values()))
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.map_path = os.path.join(self.tempdir, "app.map")
+        with io.open(self.map_path, "w") as f:
+            self.expected = write_map(f, 50)
+
+    def load(self, **kwargs):
+        with io.open(self.map_path, "r") as f:
+            return idf_size.load_map_data(f, **kwargs)
+
+    def cache_files(self, cache_dir):
+        return os.listdir(cache_dir) if os.path.isdir(cache_dir) else []
+
+    def test_cache(self):
+        cache_dir = os.path.join(self.tempdir, "cache")
+        memory_config, sections = self.load(cache_dir=cache_dir)
+        cache_files = self.cache_files(cache_dir)
+        self.assertEqual(1, len(cache_files))
+        with open(os.path.join(cache_dir, cache_files[0]), "r") as f:
+            json.load(f)
+
+        load_sections = idf_size.load_sections
+        idf_size.load_sections = None  # cached data must not be parsed again
+        try:
+            self.assertEqual((memory_config, sections), self.load(cache_dir=cache_dir))
+        finally:
+            idf_size.load_sections = load_sections
+
+        # a different map file is parsed again
+        with io.open(self.map_path, "w") as f:
+            expected = write_map(f, 60, seed=1)
+        memory_config, sections = self.load(cache_dir=cache_dir)
+        self.assertEqual(expected[".dram0.bss"], sections[".dram0.bss"]["sources"])
+
+    def test_no_cache(self):
+        self.load()
+        self.assertEqual(["app.map"], os.listdir(self.tempdir))
+
+    def test_bad_cache(self):
+        cache_dir = os.path.join(self.tempdir, "cache")
+        self.load(cache_dir=cache_dir)
+        for name in self.cache_files(cache_dir):
+            with open(os.path.join(cache_dir, name), "w") as f:
+                f.write("not a cache")
+        memory_config, sections = self.load(cache_dir=cache_dir)
+        self.assertEqual(self.expected[".flash.text"], sections[".flash.text"]["sources"])
+
+
+class CountingList(list):
+    """ List which counts how many times it is iterated over """
+    iterations = 0
+
+    def __iter__(self):
+        CountingList.iterations += 1
+        return list.__iter__(self)
+
+
+class SizeIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        f = io.StringIO()
+        write_map(f, 300)
+        f.seek(0)
+        self.memory_config, self.sections = idf_size.load_map_data(f)
+
+    def test_index(self):
+        index = idf_size.SizeIndex(self.sections)
+        self.assertEqual(idf_size.sizes_by_key(self.sections, "archive"), index.archives)
+        self.assertEqual(idf_size.sizes_by_key(self.sections, "file"), index.files)
+        expected = {}
+        for name in idf_size.ARCHIVE_SYMBOLS_SECTIONS:
+            for s in self.sections.get(name, {"sources": []})["sources"]:
+                if s.archive == "lib3.a":
+                    sym_name = idf_size.RE_SECTION_PREFIX.sub("", s.sym_name)
+                    expected.setdefault(name, {})[sym_name] = expected.get(name, {}).get(sym_name, 0) + s.size
+        self.assertEqual(expected, index.symbols("lib3.a"))
+        self.assertEqual({}, index.symbols("nosuch.a"))
+
+    def test_one_pass(self):
+        for section in self.sections.values():
+            section["sources"] = CountingList(section["sources"])
+        CountingList.iterations = 0
+        index = idf_size.SizeIndex(self.sections)
+        output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            idf_size.print_detailed_sizes(self.sections, "archive", "Archive File", index=index)
+            idf_size.print_detailed_sizes(self.sections, "file", "Object File", index=index)
+            idf_size.print_all_reports(self.memory_config, self.sections, True, index)
+        finally:
+            sys.stdout = stdout
+        # the totals, then grouping by archive for the symbols of every archive
+        self.assertEqual(2 * len(SECTIONS), CountingList.iterations)
+        self.assertEqual(97, len(json.loads(output.getvalue()[output.getvalue().index("{"):])["archive_symbols"]))
+
+
+class DiffTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.paths = []
+        for n_objects, seed in [(100, 0), (110, 1), (100, 0)]:
+            self.paths.append(os.path.join(self.tempdir, "app%d.map" % len(self.paths)))
+            with io.open(self.paths[-1], "w") as f:
+                write_map(f, n_objects, seed)
+
+    def load(self, cache_dir=None):
+        files = [io.open(p, "r") for p in self.paths]
+        try:
+            return idf_size.load_map_files(files, cache_dir)
+        finally:
+            for f in files:
+                f.close()
+
+    def test_load_map_files(self):
+        loaded = self.load()
+        for path, result in zip(self.paths, loaded):
+            with io.open(path, "r") as f:
+                self.assertEqual(idf_size.load_map_data(f), result)
+        self.assertTrue(all(isinstance(s, idf_size.Source) for s in loaded[1][1][".flash.text"]["sources"]))
+        cache_dir = os.path.join(self.tempdir, "cache")
+        self.assertEqual(loaded, self.load(cache_dir))
+        self.assertEqual(len(self.paths), len(os.listdir(cache_dir)))
+        self.assertEqual(loaded, self.load(cache_dir))
+
+    def test_diff(self):
+        current, reference, same = self.load()
+        self.assertEqual([], idf_size.diff_detailed_sizes(current[1], same[1], "archive"))
+        archives = idf_size.diff_detailed_sizes(current[1], reference[1], "archive")
+        deltas = [v["total"] for k, v in archives]
+        self.assertEqual(sorted(deltas, reverse=True), deltas)
+        self.assertNotIn(0, deltas)
+        current_sizes = dict(idf_size.detailed_sizes(current[1], "archive"))
+        reference_sizes = dict(idf_size.detailed_sizes(reference[1], "archive"))
+        for k, v in archives:
+            self.assertEqual(current_sizes[k]["iram"] - reference_sizes[k]["iram"], v["iram"])
+        symbols = idf_size.diff_archive_symbols(current[1], reference[1], "lib3.a")
+        self.assertEqual(idf_size.ARCHIVE_SYMBOLS_SECTIONS, list(symbols))
+        self.assertTrue(all(delta != 0 for s in symbols.values() for delta in s.values()))
+
+    def test_thresholds(self):
+        current, reference, same = self.load()
+        output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            self.assertEqual([], idf_size.print_diff(current, same, "app0.map", "app2.map", max_increase={"total_size": 0}))
+            over = idf_size.print_diff(reference, current, "app1.map", "app0.map", archives=True,
+                                       max_increase={"total_size": 0, "archive": 1000})
+            idf_size.print_diff(reference, current, "app1.map", "app0.map", files=True, as_json=True)
+        finally:
+            sys.stdout = stdout
+        archives = idf_size.diff_detailed_sizes(reference[1], current[1], "archive")
+        self.assertEqual(len([v for k, v in archives if v["total"] > 1000]) + 1, len(over))
+        self.assertTrue(over[-1].startswith("total_size increased by"))
+        self.assertIn("Over threshold: " + over[0], output.getvalue())
+        self.assertIn('"over_threshold": []', output.getvalue())
+
+
+class LoadElfTests(unittest.TestCase):
+    ELF = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "components", "esptool_py", "esptool",
+                       "test", "elf2image", "esp32-app-template.elf")
+
+    def test_sections_and_symbols(self):
+        memory_config, sections = idf_size.load_elf_data(self.ELF)
+        self.assertEqual(idf_size.DEFAULT_MEMORY_CONFIG, memory_config)
+        for name in idf_size.ARCHIVE_SYMBOLS_SECTIONS:
+            self.assertIn(name, sections)
+        self.assertNotIn(".symtab", sections)
+        for section in sections.values():
+            for s in section["sources"]:
+                self.assertEqual(idf_size.ELF_ARCHIVE, s.archive)
+                self.assertTrue(section["address"] <= s.address <= section["address"] + section["size"])
+        summary = idf_size.summary_sizes(memory_config, sections)
+        self.assertEqual(sections[".dram0.bss"]["size"], summary["dram_bss"])
+        self.assertTrue(summary["flash_code"] > 0)
+
+        symbols = idf_size.archive_symbols(sections, idf_size.ELF_ARCHIVE)
+        self.assertIn("app_main", symbols[".flash.text"])
+        self.assertIn("_ZL17s_nvs_next_handle", symbols[".dram0.data"])  # not stripped as if it was a section name
+        files = idf_size.sizes_by_key(sections, "file")
+        self.assertIn("(elf):cpu_start.c", files)
+
+    def test_map_memory_config(self):
+        memory_config = idf_size.load_memory_config(io.StringIO(SAMPLE_MAP))
+        self.assertIs(memory_config, idf_size.load_elf_data(self.ELF, memory_config)[0])
+
+
+@unittest.skipUnless(os.environ.get("IDF_SIZE_BENCHMARK"), "set IDF_SIZE_BENCHMARK=<size in MB> to run")
+class BenchmarkTests(unittest.TestCase):
+
+    def test_benchmark(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        map_path = os.path.join(tempdir, "app.map")
+        # each object file adds roughly 1KB of map file
+        with io.open(map_path, "w") as f:
+            write_map(f, int(os.environ["IDF_SIZE_BENCHMARK"]) * 1024)
+        print("\nMap file: %d MB" % (os.path.getsize(map_path) // (1024 * 1024)))
+        cache_dir = os.path.join(tempdir, "cache")
+        for name, cache in [("parse", None), ("parse and cache", cache_dir), ("cached", cache_dir)]:
+            t = time.time()
+            with io.open(map_path, "r") as f:
+                memory_config, sections = idf_size.load_map_data(f, cache)
+            print("%16s: %.2f seconds" % (name, time.time() - t))
+
+
+if __name__ == "__main__":
+    unittest.main()